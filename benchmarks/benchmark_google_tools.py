@@ -0,0 +1,375 @@
+# %%
+## Imports ##
+
+if __name__ != "__main__":
+    print(f"Importing {__name__}")
+
+import config_benchmarks
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+import subprocess
+import itertools
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+from utils.display_tools import print_logger, pprint_df
+from utils import google_tools
+from utils.google_fake_tools import FakeGoogleBackend
+
+# %%
+## Settings ##
+
+# every case runs in a fresh process against a fresh fake backend, so peak rss and the caches belong to that case
+# the fake answers instantly, latency_seconds stands in for the round trip to google so concurrency has something to hide
+# write workers only apply to chunked writes, so shapes below google_tools.chunked_write_min_cells are written with 1
+
+dict_sweep_full = {
+    "shapes": [(1_000, 10), (10_000, 10), (10_000, 50), (100_000, 20)],
+    "tabs": [1, 10, 50],
+    "workers": [1, 4, 8],
+    "latency_seconds": 0.02,
+}
+
+dict_sweep_quick = {
+    "shapes": [(1_000, 10), (20_000, 10)],
+    "tabs": [1, 10],
+    "workers": [1, 4],
+    "latency_seconds": 0.01,
+}
+
+loc_benchmark_results = os.path.join(config_benchmarks.data_dir, "benchmarks")
+
+book_name = "Benchmark Book"
+copy_dest_book_count = 8
+copy_tab_shape = (200, 10)
+
+
+# %%
+## Cases ##
+
+
+def get_benchmark_df(num_rows, num_cols, seed=0):
+    """
+    This function will make a frame of repeating float, int and string columns
+    :param num_rows: the number of rows
+    :param num_cols: the number of columns
+    :param seed: seed of the random values
+    :return: dataframe
+    """
+    rng = np.random.default_rng(seed)
+    dict_columns = {}
+    for col in range(num_cols):
+        if col % 3 == 0:
+            dict_columns[f"float_{col}"] = rng.random(num_rows).round(4)
+        elif col % 3 == 1:
+            dict_columns[f"int_{col}"] = rng.integers(0, 1_000_000, num_rows)
+        else:
+            dict_columns[f"str_{col}"] = [
+                f"value {i}" for i in rng.integers(0, 1000, num_rows)
+            ]
+    return pd.DataFrame(dict_columns)
+
+
+def get_sheet_rows(df):
+    return [df.columns.tolist()] + df.values.tolist()
+
+
+def get_cases(dict_sweep):
+    """
+    This function will list the cases of a sweep
+    :param dict_sweep: dict with "shapes" as (rows, columns) tuples, "tabs" and "workers" counts and "latency_seconds"
+    :return: list of case dictionaries with "kind" and its parameters
+    """
+    ls_cases = []
+    for num_rows, num_cols in dict_sweep["shapes"]:
+        is_chunked = num_rows * num_cols >= google_tools.chunked_write_min_cells
+        for workers in dict_sweep["workers"] if is_chunked else [1]:
+            ls_cases.append(
+                {
+                    "kind": "write",
+                    "rows": num_rows,
+                    "cols": num_cols,
+                    "workers": workers,
+                }
+            )
+    for num_rows, num_cols in dict_sweep["shapes"]:
+        ls_cases.append({"kind": "read", "rows": num_rows, "cols": num_cols})
+    for tabs, workers in itertools.product(dict_sweep["tabs"], dict_sweep["workers"]):
+        ls_cases.append({"kind": "copy", "tabs": tabs, "workers": workers})
+        ls_cases.append({"kind": "handles", "tabs": tabs, "workers": workers})
+
+    for dict_case in ls_cases:
+        dict_case["latency_seconds"] = dict_sweep["latency_seconds"]
+    return ls_cases
+
+
+def get_case_name(dict_case):
+    return " ".join(
+        f"{key}={value}" for key, value in dict_case.items() if key != "latency_seconds"
+    )
+
+
+def setup_case(backend, dict_case):
+    """
+    This function will create the spreadsheets a case works on directly in the backend, so it is not measured
+    :return: function with no arguments running the measured part of the case
+    """
+    kind = dict_case["kind"]
+
+    if kind == "write":
+        backend.create_spreadsheet(book_name)
+        df = get_benchmark_df(dict_case["rows"], dict_case["cols"])
+        return lambda: google_tools.WriteToSheets(
+            book_name, "Data", df, chunk_workers=dict_case["workers"]
+        )
+
+    if kind == "read":
+        df = get_benchmark_df(dict_case["rows"], dict_case["cols"])
+        backend.create_spreadsheet(book_name, {"Data": get_sheet_rows(df)})
+        return lambda: google_tools.get_book_sheet_df(book_name, "Data")
+
+    ls_tabs = [f"Tab {i}" for i in range(dict_case["tabs"])]
+    ls_rows = get_sheet_rows(get_benchmark_df(*copy_tab_shape))
+    id = backend.create_spreadsheet(book_name, {tab: ls_rows for tab in ls_tabs})
+
+    if kind == "copy":
+        ls_dest_books = [f"Destination {i}" for i in range(copy_dest_book_count)]
+        for dest_book in ls_dest_books:
+            backend.create_spreadsheet(dest_book, {tab: [["old"]] for tab in ls_tabs})
+        return lambda: google_tools.copy_sheet_book_to_book(
+            book_name, ls_tabs, ls_dest_books, max_workers=dict_case["workers"]
+        )
+
+    if kind == "handles":
+        # every tab is opened by every worker twice, the first pass misses and the rest hit the handle caches
+        def open_handles():
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=dict_case["workers"]
+            ) as executor:
+                for _ in range(2):
+                    list(
+                        executor.map(
+                            lambda tab: google_tools.get_book_sheet_from_id_name(
+                                id, tab
+                            ),
+                            ls_tabs * dict_case["workers"],
+                        )
+                    )
+            return google_tools.get_handle_cache_stats()
+
+        return open_handles
+
+    raise ValueError(f"Unknown benchmark case kind {kind}")
+
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos bytes
+    return peak_rss / 1024**2 if sys.platform == "darwin" else peak_rss / 1024
+
+
+def run_case(dict_case):
+    """
+    This function will run one case against a fresh fake backend and measure it
+    :param dict_case: the case from get_cases
+    :return: dict of the case with "wall_seconds", "requests", "bytes_sent", "bytes_received",
+        "requests_by_endpoint", "rss_before_mb" and "peak_rss_mb"
+    """
+    backend = FakeGoogleBackend(latency_seconds=dict_case["latency_seconds"], seed=0)
+    google_tools.use_fake_google_backend(backend)
+    run = setup_case(backend, dict_case)
+    rss_before_mb = get_peak_rss_mb()
+
+    backend.reset_stats()
+    start_time = time.perf_counter()
+    result = run()
+    wall_seconds = time.perf_counter() - start_time
+    google_tools.FlushSheetsCache()
+
+    dict_stats = backend.get_stats()
+    dict_result = {
+        **dict_case,
+        "wall_seconds": round(wall_seconds, 4),
+        "requests": dict_stats["requests"],
+        "bytes_sent": dict_stats["bytes_sent"],
+        "bytes_received": dict_stats["bytes_received"],
+        "requests_by_endpoint": dict_stats["by_endpoint"],
+        "rss_before_mb": rss_before_mb,
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+    if dict_case["kind"] == "handles":
+        dict_result["handle_cache_stats"] = result
+    return dict_result
+
+
+# %%
+## Runs ##
+
+
+def get_git_commit():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=config_benchmarks.parent_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=config_benchmarks.parent_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if dirty else commit
+
+
+def run_benchmarks(dict_sweep=None, kinds=None):
+    """
+    This function will run every case of a sweep, each in its own process, and save the results as json
+    :param dict_sweep: the sweep, dict_sweep_full when None
+    :param kinds: list of the case kinds to run out of "write", "read", "copy" and "handles", None for all
+    :return: the path of the results file
+    """
+    dict_sweep = dict_sweep or dict_sweep_full
+    ls_cases = [
+        dict_case
+        for dict_case in get_cases(dict_sweep)
+        if kinds is None or dict_case["kind"] in kinds
+    ]
+
+    ls_results = []
+    # spawn so no case inherits the memory or the caches of the ones before it
+    context = multiprocessing.get_context("spawn")
+    for i, dict_case in enumerate(ls_cases):
+        print_logger(
+            f"Running benchmark {i + 1} of {len(ls_cases)}: {get_case_name(dict_case)}"
+        )
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=context
+        ) as executor:
+            try:
+                dict_result = executor.submit(run_case, dict_case).result()
+            except Exception as e:
+                print_logger(f"Benchmark {get_case_name(dict_case)} failed because {e}")
+                dict_result = {**dict_case, "error": repr(e)}
+        ls_results.append(dict_result)
+
+    commit = get_git_commit()
+    dict_run = {
+        "commit": commit,
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "sweep": dict_sweep,
+        "results": ls_results,
+    }
+
+    os.makedirs(loc_benchmark_results, exist_ok=True)
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    loc_results = os.path.join(
+        loc_benchmark_results, f"google_tools_{timestamp}_{commit}.json"
+    )
+    with open(loc_results, "w") as f:
+        json.dump(dict_run, f, indent=2)
+
+    print_logger(f"Saved {len(ls_results)} benchmark results to {loc_results}")
+    return loc_results
+
+
+def get_results_df(loc_results):
+    with open(loc_results) as f:
+        dict_run = json.load(f)
+    df = pd.DataFrame(dict_run["results"])
+    df["case"] = [get_case_name(dict_case) for dict_case in dict_run["results"]]
+    return df.set_index("case")
+
+
+def compare_benchmark_results(loc_old, loc_new, threshold=0.1):
+    """
+    This function will compare two results files case by case
+    :param loc_old: the results of the baseline commit
+    :param loc_new: the results to check
+    :param threshold: the relative increase of wall time, requests or peak rss flagged as a regression
+    :return: dataframe of the cases in both files with old, new and ratio columns and a "regression" flag
+    """
+    ls_metrics = [
+        "wall_seconds",
+        "requests",
+        "bytes_sent",
+        "bytes_received",
+        "peak_rss_mb",
+    ]
+    df_old = get_results_df(loc_old)
+    df_new = get_results_df(loc_new)
+    ls_cases = [case for case in df_new.index if case in df_old.index]
+
+    df_compare = pd.DataFrame(index=ls_cases)
+    for metric in ls_metrics:
+        if metric not in df_old.columns or metric not in df_new.columns:
+            continue
+        df_compare[f"{metric}_old"] = df_old.loc[ls_cases, metric]
+        df_compare[f"{metric}_new"] = df_new.loc[ls_cases, metric]
+        df_compare[f"{metric}_ratio"] = (
+            df_compare[f"{metric}_new"] / df_compare[f"{metric}_old"]
+        ).round(3)
+
+    ls_ratio_columns = [
+        f"{metric}_ratio"
+        for metric in ["wall_seconds", "requests", "peak_rss_mb"]
+        if f"{metric}_ratio" in df_compare.columns
+    ]
+    df_compare["regression"] = (df_compare[ls_ratio_columns] > 1 + threshold).any(
+        axis=1
+    )
+
+    pprint_df(df_compare[ls_ratio_columns + ["regression"]].reset_index(names="case"))
+    print_logger(
+        f"{df_compare['regression'].sum()} of {len(df_compare)} cases regressed by more than {threshold:.0%}"
+    )
+    return df_compare
+
+
+# %%
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark google_tools against the fake google backend"
+    )
+    parser.add_argument("--quick", action="store_true", help="run the small sweep")
+    parser.add_argument(
+        "--kinds", nargs="+", choices=["write", "read", "copy", "handles"]
+    )
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two results files"
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_benchmark_results(*args.compare)
+    else:
+        run_benchmarks(
+            dict_sweep_quick if args.quick else dict_sweep_full, kinds=args.kinds
+        )
+
+
+# %%
@@ -0,0 +1,1763 @@
+# %%
+## Imports ##
+
+if __name__ != "__main__":
+    print(f"Importing {__name__}")
+
+import io
+import re
+import csv
+import json
+import copy
+import time
+import random
+import threading
+import collections
+import datetime
+import urllib.parse
+import httplib2
+import pygsheets
+from google.auth.credentials import AnonymousCredentials
+
+# %%
+## Fake Google Backend ##
+
+# an in process stand in for the parts of sheets v4 and drive v3 that pygsheets and google_tools use,
+# requests are served at the http layer so pygsheets and googleapiclient run unchanged on top of it
+#
+# not emulated: formulas are stored but never calculated, user entered dates and currency keep the text they were
+# entered as for their formatted value, pasted formulas are not shifted, formats other than notes are ignored
+
+sheets_root_url = "https://sheets.googleapis.com/v4/spreadsheets"
+drive_root_url = "https://www.googleapis.com/drive/v3"
+# the export links of the sheets web app, which have no export size limit
+docs_root_url = "https://docs.google.com/spreadsheets/d"
+
+spreadsheet_mime_type = "application/vnd.google-apps.spreadsheet"
+folder_mime_type = "application/vnd.google-apps.folder"
+shortcut_mime_type = "application/vnd.google-apps.shortcut"
+xlsx_mime_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# the cell limit of a spreadsheet
+max_cells_per_spreadsheet = 10_000_000
+# the size limit of a drive files.export
+max_export_bytes = 10 * 1024**2
+
+default_row_count = 1000
+default_column_count = 26
+
+# day zero of the serial numbers sheets stores dates as
+serial_date_epoch = datetime.datetime(1899, 12, 30)
+ls_user_entered_date_formats = [
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%m/%d/%Y",
+    "%m/%d/%Y %H:%M:%S",
+    "%m/%d/%Y %H:%M",
+]
+
+
+class FakeGoogleError(Exception):
+    """
+    An error the fake returns as an http error response like the api would
+    """
+
+    def __init__(self, status, message, headers=None, reason=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+        self.reason = reason
+
+
+def get_timestamp():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def get_column_number(letters):
+    col = 0
+    for letter in letters.upper():
+        col = col * 26 + ord(letter) - ord("A") + 1
+    return col
+
+
+def get_column_letters(col):
+    letters = ""
+    while col > 0:
+        col, remainder = divmod(col - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+
+def parse_a1_range(range_string):
+    """
+    This function will parse a range in A1 notation without the sheet title
+    :param range_string: the range like "A1:D10", "A:D", "2:5" or "A1"
+    :return: tuple of (start_row, start_col, end_row, end_col), one based and inclusive, None where open
+    """
+
+    def parse_cell(cell):
+        match = re.fullmatch(r"([A-Za-z]*)(\d*)", cell.strip())
+        if match is None or cell.strip() == "":
+            raise FakeGoogleError(400, f"Unable to parse range: {range_string}")
+        letters, digits = match.groups()
+        return (int(digits) if digits else None), (
+            get_column_number(letters) if letters else None
+        )
+
+    start, colon, end = range_string.partition(":")
+    start_row, start_col = parse_cell(start)
+    # "A5:" is rejected like the api does, only "A5" is a single cell
+    end_row, end_col = parse_cell(end) if colon else (start_row, start_col)
+    if 0 in [start_row, end_row]:
+        raise FakeGoogleError(400, f"Unable to parse range: {range_string}")
+    return start_row, start_col, end_row, end_col
+
+
+class FakeFormattedNumber(float):
+    """
+    A user entered date or currency, stored as a number that keeps the text it was entered as for its formatted value
+    """
+
+    def __new__(cls, value, text):
+        number = super().__new__(cls, value)
+        number.text = text
+        return number
+
+    def __getnewargs__(self):
+        return float(self), self.text
+
+
+def parse_user_entered_date(text):
+    """
+    This function will parse a date or date time typed into a cell as the serial number sheets stores it as
+    :param text: the text typed
+    :return: the serial number, or None if the text is not a date
+    """
+    for date_format in ls_user_entered_date_formats:
+        try:
+            date = datetime.datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+        return (date - serial_date_epoch) / datetime.timedelta(days=1)
+    return None
+
+
+def parse_user_entered_value(value):
+    """
+    This function will convert a value sent with valueInputOption USER_ENTERED like sheets would,
+    numbers, percents, booleans, dates and currency are parsed and a leading ' keeps text as text
+    :param value: the value sent
+    :return: the value stored
+    """
+    if not isinstance(value, str):
+        return value
+    if value.startswith("'"):
+        return value[1:]
+    if value.upper() in ["TRUE", "FALSE"]:
+        return value.upper() == "TRUE"
+
+    text = value.strip()
+    is_percent = text.endswith("%")
+    if is_percent:
+        text = text[:-1]
+    if re.fullmatch(r"[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?", text):
+        if is_percent:
+            return float(text) / 100
+        return int(text) if re.fullmatch(r"[+-]?\d+", text) else float(text)
+
+    match = re.fullmatch(r"([+-]?)\$(\d{1,3}(,\d{3})*|\d+)(\.\d+)?", value.strip())
+    if match is not None:
+        number = float(match.group(2).replace(",", "") + (match.group(4) or ""))
+        return FakeFormattedNumber(-number if match.group(1) == "-" else number, value)
+
+    serial = parse_user_entered_date(value.strip())
+    if serial is not None:
+        return FakeFormattedNumber(serial, value)
+    return value
+
+
+def render_value(value, value_render):
+    """
+    This function will render a stored value the way values.get returns it for a valueRenderOption
+    :param value: the stored value
+    :param value_render: "FORMATTED_VALUE", "UNFORMATTED_VALUE" or "FORMULA"
+    :return: the returned value
+    """
+    if value_render == "FORMATTED_VALUE":
+        if isinstance(value, FakeFormattedNumber):
+            return value.text
+        if isinstance(value, bool):
+            return "TRUE" if value else "FALSE"
+        if isinstance(value, float):
+            return str(int(value)) if value.is_integer() else format(value, ".15g")
+        return str(value)
+    return value
+
+
+def get_cell_data(value, note=None):
+    """
+    This function will describe a stored value as CellData of the api
+    """
+    dict_cell = {}
+    if value != "":
+        if isinstance(value, bool):
+            dict_value = {"boolValue": value}
+        elif isinstance(value, (int, float)):
+            dict_value = {"numberValue": value}
+        elif isinstance(value, str) and value.startswith("="):
+            dict_value = {"formulaValue": value}
+        else:
+            dict_value = {"stringValue": value}
+        dict_cell["userEnteredValue"] = dict_value
+        dict_cell["effectiveValue"] = dict_value
+        dict_cell["formattedValue"] = render_value(value, "FORMATTED_VALUE")
+    if note:
+        dict_cell["note"] = note
+    return dict_cell
+
+
+def get_cell_value(dict_value):
+    """
+    This function will read the value of an ExtendedValue of the api
+    """
+    if not dict_value:
+        return ""
+    for key in ["numberValue", "boolValue", "stringValue", "formulaValue"]:
+        if key in dict_value:
+            return dict_value[key]
+    return ""
+
+
+def get_query_value(dict_query, key, default=None):
+    ls_values = dict_query.get(key)
+    return ls_values[-1] if ls_values else default
+
+
+def get_field_paths(fields, prefix=""):
+    """
+    This function will expand a field mask like "gridProperties/rowCount, sheets(properties, data)" into dotted paths
+    """
+    ls_paths = []
+    depth = 0
+    field = ""
+    for char in fields + ",":
+        if char == "," and depth == 0:
+            field = field.strip().replace("/", ".")
+            match = re.fullmatch(r"([^(]*)\((.*)\)", field)
+            if match is not None:
+                ls_paths.extend(
+                    get_field_paths(match.group(2), f"{prefix}{match.group(1)}.")
+                )
+            elif field:
+                ls_paths.append(prefix + field)
+            field = ""
+            continue
+        depth += {"(": 1, ")": -1}.get(char, 0)
+        field += char
+    return ls_paths
+
+
+def get_field_names(fields):
+    """
+    This function will return the top level names of a field mask like "userEnteredValue, note"
+    """
+    return [path.split(".")[0] for path in get_field_paths(fields)]
+
+
+class FakeSheet:
+    """
+    A tab of a fake spreadsheet, values are kept as a list of rows trimmed of trailing blanks
+    """
+
+    def __init__(self, properties):
+        self.properties = properties
+        self.ls_rows = []
+        self.dict_notes = {}
+
+    @property
+    def row_count(self):
+        return self.properties["gridProperties"]["rowCount"]
+
+    @property
+    def column_count(self):
+        return self.properties["gridProperties"]["columnCount"]
+
+    def get_value(self, row, col):
+        if row < len(self.ls_rows) and col < len(self.ls_rows[row]):
+            return self.ls_rows[row][col]
+        return ""
+
+    def set_value(self, row, col, value):
+        if value is None:
+            value = ""
+        while len(self.ls_rows) <= row:
+            if value == "":
+                return
+            self.ls_rows.append([])
+        row_values = self.ls_rows[row]
+        if col >= len(row_values):
+            if value == "":
+                return
+            row_values.extend([""] * (col + 1 - len(row_values)))
+        row_values[col] = value
+
+    def trim(self):
+        for row_values in self.ls_rows:
+            while row_values and row_values[-1] == "":
+                row_values.pop()
+        while self.ls_rows and not self.ls_rows[-1]:
+            self.ls_rows.pop()
+
+    def get_bounds(self, range_string, check_grid=True):
+        """
+        This function will resolve a range of this sheet to zero based bounds, open ends run to the grid edge
+        :param range_string: the A1 range without the sheet title, None for the whole sheet
+        :param check_grid: whether a range past the grid is an error, writes grow the grid instead
+        :return: tuple of (first_row, first_col, last_row, last_col), zero based and inclusive
+        """
+        if range_string is None:
+            return 0, 0, self.row_count - 1, self.column_count - 1
+        start_row, start_col, end_row, end_col = parse_a1_range(range_string)
+        first_row = (start_row or 1) - 1
+        first_col = (start_col or 1) - 1
+        last_row = (end_row or self.row_count) - 1
+        last_col = (end_col or self.column_count) - 1
+        if check_grid and (last_row >= self.row_count or last_col >= self.column_count):
+            raise FakeGoogleError(
+                400,
+                f"Range ('{self.properties['title']}'!{range_string}) exceeds grid limits. "
+                f"Max rows: {self.row_count}, max columns: {self.column_count}",
+            )
+        return first_row, first_col, last_row, last_col
+
+    def get_range_label(self, first_row, first_col, last_row, last_col):
+        title = self.properties["title"].replace("'", "''")
+        return (
+            f"'{title}'!{get_column_letters(first_col + 1)}{first_row + 1}:"
+            f"{get_column_letters(last_col + 1)}{last_row + 1}"
+        )
+
+
+class FakeSpreadsheet:
+    """
+    A fake spreadsheet with its tabs in order
+    """
+
+    def __init__(self, spreadsheet_id, title):
+        self.spreadsheet_id = spreadsheet_id
+        self.title = title
+        self.ls_sheets = []
+
+    def get_sheet(self, sheet_id=None, title=None):
+        for sheet in self.ls_sheets:
+            if sheet_id is not None and sheet.properties["sheetId"] == sheet_id:
+                return sheet
+            if title is not None and sheet.properties["title"] == title:
+                return sheet
+        raise FakeGoogleError(
+            400,
+            (
+                f"No grid with id: {sheet_id}"
+                if sheet_id is not None
+                else f"Unable to parse range: {title}"
+            ),
+        )
+
+    def resolve_range(self, range_name):
+        """
+        This function will split a range like "'Sheet 1'!A1:B2", "Sheet1" or "A1:B2" into its sheet and A1 range
+        :return: tuple of (FakeSheet, A1 range or None for the whole sheet)
+        """
+        match = re.fullmatch(r"'((?:[^']|'')+)'(?:!(.*))?", range_name)
+        if match is not None:
+            return self.get_sheet(title=match.group(1).replace("''", "'")), match.group(
+                2
+            )
+        if "!" in range_name:
+            title, _, range_string = range_name.rpartition("!")
+            return self.get_sheet(title=title), range_string
+        for sheet in self.ls_sheets:
+            if sheet.properties["title"] == range_name:
+                return sheet, None
+        return self.ls_sheets[0], range_name
+
+    def reindex(self):
+        for i, sheet in enumerate(self.ls_sheets):
+            sheet.properties["index"] = i
+
+    def get_num_cells(self):
+        return sum(sheet.row_count * sheet.column_count for sheet in self.ls_sheets)
+
+    def get_json(self):
+        return {
+            "spreadsheetId": self.spreadsheet_id,
+            "properties": {
+                "title": self.title,
+                "locale": "en_US",
+                "timeZone": "Etc/GMT",
+                "defaultFormat": {},
+            },
+            "sheets": [
+                {"properties": copy.deepcopy(sheet.properties)}
+                for sheet in self.ls_sheets
+            ],
+            "spreadsheetUrl": f"https://docs.google.com/spreadsheets/d/{self.spreadsheet_id}",
+        }
+
+    def clone(self):
+        spreadsheet = FakeSpreadsheet(self.spreadsheet_id, self.title)
+        for sheet in self.ls_sheets:
+            new_sheet = FakeSheet(copy.deepcopy(sheet.properties))
+            new_sheet.ls_rows = [list(row) for row in sheet.ls_rows]
+            new_sheet.dict_notes = dict(sheet.dict_notes)
+            spreadsheet.ls_sheets.append(new_sheet)
+        return spreadsheet
+
+
+class FakeGoogleBackend:
+    """
+    The state of a fake google account: drive files, spreadsheets and a change log,
+    with configurable latency, injected errors and per minute quotas, shared by every client pointed at it
+    """
+
+    def __init__(
+        self,
+        latency_seconds=0.0,
+        latency_jitter_seconds=0.0,
+        error_rate_429=0.0,
+        error_rate_5xx=0.0,
+        dict_quotas_per_minute=None,
+        retry_after_seconds=None,
+        seed=None,
+    ):
+        """
+        :param latency_seconds: the delay added to every request
+        :param latency_jitter_seconds: a random delay up to this added on top of latency_seconds
+        :param error_rate_429: the share of requests answered with a 429
+        :param error_rate_5xx: the share of requests answered with a 503
+        :param dict_quotas_per_minute: dict of "sheets_read", "sheets_write" and "drive" to the requests allowed
+            in any 60 seconds before answering with 429s, None for no quotas
+        :param retry_after_seconds: the Retry-After header sent with injected and quota 429s, None to leave it out
+        :param seed: seed of the random generator of injected errors and ids
+        """
+        self.latency_seconds = latency_seconds
+        self.latency_jitter_seconds = latency_jitter_seconds
+        self.error_rate_429 = error_rate_429
+        self.error_rate_5xx = error_rate_5xx
+        self.dict_quotas_per_minute = dict_quotas_per_minute or {}
+        self.retry_after_seconds = retry_after_seconds
+
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self.dict_files = {}
+        self.dict_spreadsheets = {}
+        self.ls_change_file_ids = []
+        self.ls_forced_errors = []
+        self.dict_quota_times = collections.defaultdict(collections.deque)
+        self.reset_stats()
+
+    def __repr__(self):
+        return f"<FakeGoogleBackend {len(self.dict_spreadsheets)} spreadsheets, {len(self.dict_files)} files>"
+
+    ## Setup ##
+
+    def new_id(self, length=44):
+        alphabet = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_"
+        with self._lock:
+            return "".join(self._random.choice(alphabet) for _ in range(length))
+
+    def add_drive_file(self, name, mime_type, parents=None, id=None):
+        with self._lock:
+            id = id or self.new_id(33)
+            self.dict_files[id] = {
+                "id": id,
+                "name": name,
+                "mimeType": mime_type,
+                "parents": list(parents or ["root"]),
+                "trashed": False,
+                "createdTime": get_timestamp(),
+                "modifiedTime": get_timestamp(),
+                "kind": "drive#file",
+            }
+            self.ls_change_file_ids.append(id)
+            return id
+
+    def touch_drive_file(self, id):
+        with self._lock:
+            self.dict_files[id]["modifiedTime"] = get_timestamp()
+            self.ls_change_file_ids.append(id)
+
+    def create_folder(self, name, parent_id=None):
+        """
+        This function will add a folder to the fake drive
+        :param name: the name of the folder
+        :param parent_id: the id of the parent folder, None for the root
+        :return: the id of the folder
+        """
+        return self.add_drive_file(
+            name, folder_mime_type, parents=[parent_id] if parent_id else None
+        )
+
+    def create_spreadsheet(
+        self, title, dict_sheet_values=None, parent_id=None, id=None
+    ):
+        """
+        This function will add a spreadsheet to the fake drive
+        :param title: the name of the spreadsheet
+        :param dict_sheet_values: dict of tab name to a list of rows of values, a single "Sheet1" when None
+        :param parent_id: the id of the parent folder, None for the root
+        :param id: the id of the spreadsheet, a random one when None
+        :return: the id of the spreadsheet
+        """
+        with self._lock:
+            id = self.add_drive_file(
+                title,
+                spreadsheet_mime_type,
+                parents=[parent_id] if parent_id else None,
+                id=id or self.new_id(),
+            )
+            spreadsheet = FakeSpreadsheet(id, title)
+            self.dict_spreadsheets[id] = spreadsheet
+            for sheet_title, ls_rows in (dict_sheet_values or {"Sheet1": []}).items():
+                sheet = self.add_sheet(spreadsheet, {"title": sheet_title})
+                num_rows = max(len(ls_rows), default_row_count)
+                num_cols = max([len(row) for row in ls_rows] + [default_column_count])
+                sheet.properties["gridProperties"]["rowCount"] = num_rows
+                sheet.properties["gridProperties"]["columnCount"] = num_cols
+                sheet.ls_rows = [list(row) for row in ls_rows]
+                sheet.trim()
+            return id
+
+    def add_sheet(self, spreadsheet, properties):
+        properties = copy.deepcopy(properties)
+        title = properties.get("title") or f"Sheet{len(spreadsheet.ls_sheets) + 1}"
+        for sheet in spreadsheet.ls_sheets:
+            if sheet.properties["title"] == title:
+                raise FakeGoogleError(
+                    400,
+                    f'Invalid requests[0].addSheet: A sheet with the name "{title}" already exists. '
+                    "Please enter another name.",
+                )
+        sheet_id = properties.get("sheetId")
+        if sheet_id is None:
+            sheet_id = (
+                0 if not spreadsheet.ls_sheets else self._random.randint(1, 2**31 - 1)
+            )
+        grid = properties.get("gridProperties", {})
+        properties.update(
+            {
+                "sheetId": sheet_id,
+                "title": title,
+                "sheetType": "GRID",
+                "gridProperties": {
+                    "rowCount": grid.get("rowCount", default_row_count),
+                    "columnCount": grid.get("columnCount", default_column_count),
+                },
+            }
+        )
+        sheet = FakeSheet(properties)
+        index = properties.get("index", len(spreadsheet.ls_sheets))
+        spreadsheet.ls_sheets.insert(index, sheet)
+        spreadsheet.reindex()
+        self.check_cell_limit(spreadsheet)
+        return sheet
+
+    def get_sheet_values(self, spreadsheet_id, title):
+        """
+        This function will return the stored values of a tab, for checking what a write left behind
+        :return: list of rows, trailing blanks trimmed
+        """
+        with self._lock:
+            sheet = self.get_spreadsheet(spreadsheet_id).get_sheet(title=title)
+            return copy.deepcopy(sheet.ls_rows)
+
+    def get_spreadsheet(self, spreadsheet_id):
+        spreadsheet = self.dict_spreadsheets.get(spreadsheet_id)
+        if spreadsheet is None or self.dict_files[spreadsheet_id]["trashed"]:
+            raise FakeGoogleError(404, "Requested entity was not found.")
+        return spreadsheet
+
+    def check_cell_limit(self, spreadsheet):
+        if spreadsheet.get_num_cells() > max_cells_per_spreadsheet:
+            raise FakeGoogleError(
+                400,
+                "This action would increase the number of cells in the workbook above the limit "
+                f"of {max_cells_per_spreadsheet} cells.",
+            )
+
+    ## Faults and accounting ##
+
+    def fail_next_requests(self, status, count=1):
+        """
+        This function will answer the next requests with an error
+        :param status: the http status to answer with like 429 or 503
+        :param count: the number of requests to fail
+        :return: None
+        """
+        with self._lock:
+            self.ls_forced_errors.extend([status] * count)
+
+    def reset_stats(self):
+        with self._lock:
+            self.dict_stats = {
+                "requests": 0,
+                "bytes_sent": 0,
+                "bytes_received": 0,
+                "errors_injected": 0,
+                "quota_exceeded": 0,
+                "by_endpoint": collections.Counter(),
+                "by_bucket": collections.Counter(),
+            }
+
+    def get_stats(self):
+        """
+        This function will return the request accounting of the backend
+        :return: dict with "requests", "bytes_sent" by clients, "bytes_received" by clients, "errors_injected",
+            "quota_exceeded" and the request counts "by_endpoint" and "by_bucket"
+        """
+        with self._lock:
+            dict_stats = copy.deepcopy(self.dict_stats)
+        dict_stats["by_endpoint"] = dict(dict_stats["by_endpoint"])
+        dict_stats["by_bucket"] = dict(dict_stats["by_bucket"])
+        return dict_stats
+
+    def get_injected_error(self, bucket):
+        with self._lock:
+            if self.ls_forced_errors:
+                status = self.ls_forced_errors.pop(0)
+            elif self._random.random() < self.error_rate_429:
+                status = 429
+            elif self._random.random() < self.error_rate_5xx:
+                status = 503
+            else:
+                status = None
+
+            if status is not None:
+                self.dict_stats["errors_injected"] += 1
+                return FakeGoogleError(
+                    status,
+                    "Injected error",
+                    headers=self.get_retry_after_headers(status),
+                )
+
+            quota = self.dict_quotas_per_minute.get(bucket)
+            if quota is None:
+                return None
+            deque_times = self.dict_quota_times[bucket]
+            now = time.time()
+            while deque_times and now - deque_times[0] >= 60:
+                deque_times.popleft()
+            if len(deque_times) >= quota:
+                self.dict_stats["quota_exceeded"] += 1
+                return FakeGoogleError(
+                    429,
+                    f"Quota exceeded for quota metric '{bucket}' and limit '{quota} per minute per user'",
+                    headers=self.get_retry_after_headers(429),
+                )
+            deque_times.append(now)
+            return None
+
+    def get_retry_after_headers(self, status):
+        if status == 429 and self.retry_after_seconds is not None:
+            return {"retry-after": str(self.retry_after_seconds)}
+        return {}
+
+    ## Http ##
+
+    def handle_request(self, uri, method, body):
+        """
+        This function will serve one http request of googleapiclient
+        :param uri: the full uri of the request
+        :param method: the http method
+        :param body: the request body as bytes or str, or None
+        :return: tuple of (status, dict of headers, content bytes)
+        """
+        if isinstance(body, str):
+            body = body.encode()
+        parsed = urllib.parse.urlsplit(uri)
+        dict_query = urllib.parse.parse_qs(parsed.query)
+        url = f"{parsed.scheme}://{parsed.netloc}{parsed.path}"
+
+        if url.startswith(sheets_root_url):
+            path = url[len(sheets_root_url) :]
+            bucket = "sheets_read" if method == "GET" else "sheets_write"
+            handler = self.handle_sheets_request
+        elif url.startswith(drive_root_url):
+            path = url[len(drive_root_url) :]
+            bucket = "drive"
+            handler = self.handle_drive_request
+        elif url.startswith(docs_root_url):
+            path = url[len(docs_root_url) :]
+            bucket = "drive"
+            handler = self.handle_docs_request
+        else:
+            return 404, {}, b"Not Found"
+
+        endpoint = re.sub(r"/[^/:]{20,}", "/{id}", path)
+        endpoint = re.sub(r"/values/[^:]+", "/values/{range}", endpoint)
+        endpoint = (
+            f"{method} {re.sub(r'/sheets/[0-9]+', '/sheets/{sheetId}', endpoint)}"
+        )
+        with self._lock:
+            self.dict_stats["requests"] += 1
+            self.dict_stats["bytes_sent"] += len(body or b"")
+            self.dict_stats["by_endpoint"][endpoint] += 1
+            self.dict_stats["by_bucket"][bucket] += 1
+
+        delay_seconds = self.latency_seconds + self._random.uniform(
+            0, self.latency_jitter_seconds
+        )
+        if delay_seconds > 0:
+            time.sleep(delay_seconds)
+
+        try:
+            error = self.get_injected_error(bucket)
+            if error is not None:
+                raise error
+            dict_body = json.loads(body) if body else {}
+            with self._lock:
+                response = handler(method, path, dict_query, dict_body)
+            status, headers = 200, {"content-type": "application/json; charset=UTF-8"}
+            if response is None:
+                status, content = 204, b""
+            elif isinstance(response, bytes):
+                content, headers["content-type"] = response, "application/octet-stream"
+            else:
+                content = json.dumps(response).encode()
+        except FakeGoogleError as e:
+            status = e.status
+            headers = {"content-type": "application/json; charset=UTF-8", **e.headers}
+            content = json.dumps(
+                {
+                    "error": {
+                        "code": e.status,
+                        "message": e.message,
+                        "errors": [
+                            {
+                                "message": e.message,
+                                "reason": e.reason or "backendError",
+                            }
+                        ],
+                        "status": {
+                            400: "INVALID_ARGUMENT",
+                            403: "PERMISSION_DENIED",
+                            404: "NOT_FOUND",
+                            429: "RESOURCE_EXHAUSTED",
+                        }.get(e.status, "UNAVAILABLE"),
+                    }
+                }
+            ).encode()
+
+        with self._lock:
+            self.dict_stats["bytes_received"] += len(content)
+        return status, headers, content
+
+    ## Sheets ##
+
+    def handle_sheets_request(self, method, path, dict_query, dict_body):
+        if path == "" and method == "POST":
+            return self.create_spreadsheet_from_body(dict_body)
+
+        match = re.fullmatch(r"/([^/:]+)(.*)", path)
+        if match is None:
+            raise FakeGoogleError(404, "Not Found")
+        spreadsheet = self.get_spreadsheet(urllib.parse.unquote(match.group(1)))
+        rest = match.group(2)
+
+        if rest == "" and method == "GET":
+            return self.get_spreadsheet_json(spreadsheet, dict_query)
+        if rest == ":batchUpdate" and method == "POST":
+            return self.batch_update(spreadsheet, dict_body)
+        if rest == "/values:batchGet" and method == "GET":
+            return {
+                "spreadsheetId": spreadsheet.spreadsheet_id,
+                "valueRanges": [
+                    self.get_values(spreadsheet, range_name, dict_query)
+                    for range_name in dict_query.get("ranges", [])
+                ],
+            }
+        if rest == "/values:batchUpdate" and method == "POST":
+            return self.batch_update_values(spreadsheet, dict_body)
+        if rest == "/values:batchClear" and method == "POST":
+            return {
+                "spreadsheetId": spreadsheet.spreadsheet_id,
+                "clearedRanges": [
+                    self.clear_values(spreadsheet, range_name)
+                    for range_name in dict_body.get("ranges", [])
+                ],
+            }
+
+        match = re.fullmatch(r"/values/([^:]+)(:append|:clear)?", rest)
+        if match is not None:
+            range_name = urllib.parse.unquote(match.group(1))
+            action = match.group(2)
+            if action is None and method == "GET":
+                return self.get_values(spreadsheet, range_name, dict_query)
+            if action is None and method == "PUT":
+                input_option = get_query_value(dict_query, "valueInputOption", "RAW")
+                response = self.update_values(
+                    spreadsheet, range_name, dict_body, input_option
+                )
+                return {"spreadsheetId": spreadsheet.spreadsheet_id, **response}
+            if action == ":append" and method == "POST":
+                return self.append_values(
+                    spreadsheet, range_name, dict_body, dict_query
+                )
+            if action == ":clear" and method == "POST":
+                return {
+                    "spreadsheetId": spreadsheet.spreadsheet_id,
+                    "clearedRange": self.clear_values(spreadsheet, range_name),
+                }
+
+        match = re.fullmatch(r"/sheets/(\d+):copyTo", rest)
+        if match is not None and method == "POST":
+            sheet = spreadsheet.get_sheet(sheet_id=int(match.group(1)))
+            dest = self.get_spreadsheet(dict_body.get("destinationSpreadsheetId"))
+            return self.copy_sheet(sheet, dest).properties
+
+        raise FakeGoogleError(404, f"Not Found: {method} {path}")
+
+    def create_spreadsheet_from_body(self, dict_body):
+        title = dict_body.get("properties", {}).get("title", "Untitled spreadsheet")
+        id = self.create_spreadsheet(title, dict_sheet_values={})
+        spreadsheet = self.dict_spreadsheets[id]
+        for dict_sheet in dict_body.get("sheets") or [{"properties": {}}]:
+            self.add_sheet(spreadsheet, dict_sheet.get("properties", {}))
+        return spreadsheet.get_json()
+
+    def get_spreadsheet_json(self, spreadsheet, dict_query):
+        dict_json = spreadsheet.get_json()
+        if get_query_value(dict_query, "includeGridData", "false") != "true":
+            return dict_json
+
+        ls_ranges = dict_query.get("ranges")
+        if ls_ranges:
+            ls_sheet_ranges = [spreadsheet.resolve_range(name) for name in ls_ranges]
+        else:
+            ls_sheet_ranges = [(sheet, None) for sheet in spreadsheet.ls_sheets]
+
+        dict_sheet_json = {
+            dict_sheet["properties"]["sheetId"]: dict_sheet
+            for dict_sheet in dict_json["sheets"]
+        }
+        for sheet, range_string in ls_sheet_ranges:
+            first_row, first_col, last_row, last_col = sheet.get_bounds(range_string)
+            last_row = min(last_row, len(sheet.ls_rows) - 1)
+            ls_row_data = []
+            for row in range(first_row, last_row + 1):
+                ls_row_data.append(
+                    {
+                        "values": [
+                            get_cell_data(
+                                sheet.get_value(row, col),
+                                sheet.dict_notes.get((row, col)),
+                            )
+                            for col in range(first_col, last_col + 1)
+                        ]
+                    }
+                )
+            dict_sheet_json[sheet.properties["sheetId"]].setdefault("data", []).append(
+                {
+                    "startRow": first_row,
+                    "startColumn": first_col,
+                    "rowData": ls_row_data,
+                }
+            )
+        return dict_json
+
+    def get_values(self, spreadsheet, range_name, dict_query):
+        sheet, range_string = spreadsheet.resolve_range(range_name)
+        first_row, first_col, last_row, last_col = sheet.get_bounds(range_string)
+        value_render = get_query_value(
+            dict_query, "valueRenderOption", "FORMATTED_VALUE"
+        )
+        major_dimension = get_query_value(dict_query, "majorDimension", "ROWS")
+
+        ls_values = [
+            [
+                render_value(value, value_render)
+                for value in sheet.ls_rows[row][first_col : last_col + 1]
+            ]
+            for row in range(first_row, min(last_row + 1, len(sheet.ls_rows)))
+        ]
+        if major_dimension == "COLUMNS":
+            num_cols = max([len(row) for row in ls_values] + [0])
+            ls_values = [
+                [row[col] if col < len(row) else "" for row in ls_values]
+                for col in range(num_cols)
+            ]
+        for values in ls_values:
+            while values and values[-1] == "":
+                values.pop()
+        while ls_values and not ls_values[-1]:
+            ls_values.pop()
+
+        dict_response = {
+            "range": sheet.get_range_label(first_row, first_col, last_row, last_col),
+            "majorDimension": major_dimension,
+        }
+        if ls_values:
+            dict_response["values"] = ls_values
+        return dict_response
+
+    def write_values(
+        self, sheet, first_row, first_col, ls_values, major_dimension, input_option
+    ):
+        if major_dimension == "COLUMNS":
+            num_rows = max([len(col) for col in ls_values] + [0])
+            ls_values = [
+                [col[row] if row < len(col) else None for col in ls_values]
+                for row in range(num_rows)
+            ]
+        num_rows = len(ls_values)
+        num_cols = max([len(row) for row in ls_values] + [0])
+        for i, values in enumerate(ls_values):
+            for j, value in enumerate(values):
+                # nulls leave the cell as it is
+                if value is None:
+                    continue
+                if input_option == "USER_ENTERED":
+                    value = parse_user_entered_value(value)
+                sheet.set_value(first_row + i, first_col + j, value)
+        sheet.trim()
+        return num_rows, num_cols
+
+    def update_values(self, spreadsheet, range_name, dict_body, input_option):
+        sheet, range_string = spreadsheet.resolve_range(range_name)
+        first_row, first_col, last_row, last_col = sheet.get_bounds(
+            range_string, check_grid=False
+        )
+        ls_values = dict_body.get("values", [])
+        major_dimension = dict_body.get("majorDimension", "ROWS")
+
+        num_rows = len(ls_values)
+        num_cols = max([len(row) for row in ls_values] + [0])
+        if major_dimension == "COLUMNS":
+            num_rows, num_cols = num_cols, num_rows
+        if first_row + num_rows - 1 > last_row or first_col + num_cols - 1 > last_col:
+            if range_string is not None and ":" in range_string:
+                raise FakeGoogleError(
+                    400,
+                    f"Requested writing within range [{range_name}], but tried writing "
+                    f"{num_rows} rows and {num_cols} columns",
+                )
+
+        # like the api, values written past the grid add the rows and columns they need
+        dict_grid = sheet.properties["gridProperties"]
+        dict_grid["rowCount"] = max(dict_grid["rowCount"], first_row + num_rows)
+        dict_grid["columnCount"] = max(dict_grid["columnCount"], first_col + num_cols)
+        self.check_cell_limit(spreadsheet)
+
+        self.write_values(
+            sheet, first_row, first_col, ls_values, major_dimension, input_option
+        )
+        self.touch_drive_file(spreadsheet.spreadsheet_id)
+        return {
+            "updatedRange": sheet.get_range_label(
+                first_row,
+                first_col,
+                first_row + max(num_rows, 1) - 1,
+                first_col + max(num_cols, 1) - 1,
+            ),
+            "updatedRows": num_rows,
+            "updatedColumns": num_cols,
+            "updatedCells": sum(
+                len([value for value in row if value is not None]) for row in ls_values
+            ),
+        }
+
+    def batch_update_values(self, spreadsheet, dict_body):
+        input_option = dict_body.get("valueInputOption", "RAW")
+        ls_responses = [
+            {
+                "spreadsheetId": spreadsheet.spreadsheet_id,
+                **self.update_values(spreadsheet, data["range"], data, input_option),
+            }
+            for data in dict_body.get("data", [])
+        ]
+        return {
+            "spreadsheetId": spreadsheet.spreadsheet_id,
+            "totalUpdatedRows": sum(r["updatedRows"] for r in ls_responses),
+            "totalUpdatedColumns": sum(r["updatedColumns"] for r in ls_responses),
+            "totalUpdatedCells": sum(r["updatedCells"] for r in ls_responses),
+            "totalUpdatedSheets": len(
+                {r["updatedRange"].rpartition("!")[0] for r in ls_responses}
+            ),
+            "responses": ls_responses,
+        }
+
+    def append_values(self, spreadsheet, range_name, dict_body, dict_query):
+        sheet, range_string = spreadsheet.resolve_range(range_name)
+        first_row, first_col, last_row, last_col = sheet.get_bounds(range_string)
+        input_option = get_query_value(dict_query, "valueInputOption", "RAW")
+        insert_option = get_query_value(dict_query, "insertDataOption", "OVERWRITE")
+        ls_values = dict_body.get("values", [])
+        num_cols = max([len(row) for row in ls_values] + [0])
+
+        # the table is taken as every row down to the last one with a value in the range columns
+        table_end = first_row
+        for row in range(first_row, len(sheet.ls_rows)):
+            if any(
+                value != "" for value in sheet.ls_rows[row][first_col : last_col + 1]
+            ):
+                table_end = row + 1
+        start_row = table_end
+
+        if insert_option == "INSERT_ROWS":
+            sheet.ls_rows[start_row:start_row] = [[] for _ in ls_values]
+            sheet.properties["gridProperties"]["rowCount"] += len(ls_values)
+        elif start_row + len(ls_values) > sheet.row_count:
+            sheet.properties["gridProperties"]["rowCount"] = start_row + len(ls_values)
+        if first_col + num_cols > sheet.column_count:
+            sheet.properties["gridProperties"]["columnCount"] = first_col + num_cols
+        self.check_cell_limit(spreadsheet)
+
+        self.write_values(sheet, start_row, first_col, ls_values, "ROWS", input_option)
+        self.touch_drive_file(spreadsheet.spreadsheet_id)
+        updated_range = sheet.get_range_label(
+            start_row,
+            first_col,
+            start_row + max(len(ls_values), 1) - 1,
+            first_col + max(num_cols, 1) - 1,
+        )
+        dict_response = {
+            "spreadsheetId": spreadsheet.spreadsheet_id,
+            "updates": {
+                "spreadsheetId": spreadsheet.spreadsheet_id,
+                "updatedRange": updated_range,
+                "updatedRows": len(ls_values),
+                "updatedColumns": num_cols,
+                "updatedCells": sum(len(row) for row in ls_values),
+            },
+        }
+        if table_end > first_row:
+            dict_response["tableRange"] = sheet.get_range_label(
+                first_row, first_col, table_end - 1, last_col
+            )
+        return dict_response
+
+    def clear_values(self, spreadsheet, range_name):
+        sheet, range_string = spreadsheet.resolve_range(range_name)
+        first_row, first_col, last_row, last_col = sheet.get_bounds(range_string)
+        for row in range(first_row, min(last_row + 1, len(sheet.ls_rows))):
+            values = sheet.ls_rows[row]
+            for col in range(first_col, min(last_col + 1, len(values))):
+                values[col] = ""
+        sheet.trim()
+        self.touch_drive_file(spreadsheet.spreadsheet_id)
+        return sheet.get_range_label(first_row, first_col, last_row, last_col)
+
+    def copy_sheet(self, sheet, dest):
+        ls_titles = [s.properties["title"] for s in dest.ls_sheets]
+        title = f"Copy of {sheet.properties['title']}"
+        i = 2
+        while title in ls_titles:
+            title = f"Copy of {sheet.properties['title']} {i}"
+            i += 1
+        new_sheet = self.add_sheet(
+            dest,
+            {
+                "title": title,
+                "gridProperties": copy.deepcopy(sheet.properties["gridProperties"]),
+            },
+        )
+        new_sheet.ls_rows = [list(row) for row in sheet.ls_rows]
+        new_sheet.dict_notes = dict(sheet.dict_notes)
+        self.touch_drive_file(dest.spreadsheet_id)
+        return new_sheet
+
+    ## Sheets batchUpdate ##
+
+    def batch_update(self, spreadsheet, dict_body):
+        # requests are applied to a copy that only replaces the spreadsheet if every request succeeds
+        working = spreadsheet.clone()
+        ls_replies = []
+        for i, dict_request in enumerate(dict_body.get("requests", [])):
+            if len(dict_request) != 1:
+                raise FakeGoogleError(
+                    400,
+                    f"Invalid requests[{i}]: exactly one kind of request is required",
+                )
+            kind, dict_params = next(iter(dict_request.items()))
+            handler = getattr(self, f"apply_{kind}", None)
+            if handler is None:
+                raise FakeGoogleError(
+                    400,
+                    f"Invalid requests[{i}]: {kind} is not supported by the fake backend",
+                )
+            try:
+                reply = handler(working, dict_params)
+            except FakeGoogleError as e:
+                raise FakeGoogleError(
+                    e.status, f"Invalid requests[{i}].{kind}: {e.message}"
+                )
+            ls_replies.append({kind: reply} if reply else {})
+
+        self.check_cell_limit(working)
+        self.dict_spreadsheets[spreadsheet.spreadsheet_id] = working
+        self.dict_files[spreadsheet.spreadsheet_id]["name"] = working.title
+        self.touch_drive_file(spreadsheet.spreadsheet_id)
+
+        dict_response = {
+            "spreadsheetId": spreadsheet.spreadsheet_id,
+            "replies": ls_replies,
+        }
+        if dict_body.get("includeSpreadsheetInResponse"):
+            dict_response["updatedSpreadsheet"] = working.get_json()
+        return dict_response
+
+    def get_grid_bounds(self, spreadsheet, grid_range):
+        """
+        This function will resolve a GridRange to its sheet and zero based inclusive bounds, open ends run to the grid edge
+        """
+        sheet = spreadsheet.get_sheet(sheet_id=grid_range.get("sheetId", 0))
+        first_row = grid_range.get("startRowIndex", 0)
+        first_col = grid_range.get("startColumnIndex", 0)
+        last_row = grid_range.get("endRowIndex", sheet.row_count) - 1
+        last_col = grid_range.get("endColumnIndex", sheet.column_count) - 1
+        if last_row >= sheet.row_count or last_col >= sheet.column_count:
+            raise FakeGoogleError(
+                400,
+                f"Range ({sheet.properties['title']}!R{first_row + 1}C{first_col + 1}:"
+                f"R{last_row + 1}C{last_col + 1}) exceeds grid limits. "
+                f"Max rows: {sheet.row_count}, max columns: {sheet.column_count}",
+            )
+        return sheet, first_row, first_col, last_row, last_col
+
+    def apply_addSheet(self, spreadsheet, dict_params):
+        return {
+            "properties": copy.deepcopy(
+                self.add_sheet(
+                    spreadsheet, dict_params.get("properties", {})
+                ).properties
+            )
+        }
+
+    def apply_deleteSheet(self, spreadsheet, dict_params):
+        sheet = spreadsheet.get_sheet(sheet_id=dict_params["sheetId"])
+        if len(spreadsheet.ls_sheets) == 1:
+            raise FakeGoogleError(400, "You can't remove all the sheets in a document.")
+        spreadsheet.ls_sheets.remove(sheet)
+        spreadsheet.reindex()
+
+    def apply_updateSheetProperties(self, spreadsheet, dict_params):
+        dict_properties = dict_params["properties"]
+        sheet = spreadsheet.get_sheet(sheet_id=dict_properties.get("sheetId", 0))
+        fields = dict_params.get("fields", "*")
+        ls_fields = (
+            ["title", "index", "gridProperties.rowCount", "gridProperties.columnCount"]
+            if fields.strip() == "*"
+            else get_field_paths(fields)
+        )
+        for field in ls_fields:
+            value = dict_properties
+            for key in field.split("."):
+                value = value.get(key) if isinstance(value, dict) else None
+            if field == "title" and value is not None:
+                for other in spreadsheet.ls_sheets:
+                    if other is not sheet and other.properties["title"] == value:
+                        raise FakeGoogleError(
+                            400, f'A sheet with the name "{value}" already exists.'
+                        )
+                sheet.properties["title"] = value
+            elif field == "index" and value is not None:
+                spreadsheet.ls_sheets.remove(sheet)
+                spreadsheet.ls_sheets.insert(
+                    min(value, len(spreadsheet.ls_sheets)), sheet
+                )
+                spreadsheet.reindex()
+            elif (
+                field in ["gridProperties.rowCount", "gridProperties.columnCount"]
+                and value is not None
+            ):
+                key = field.split(".")[1]
+                sheet.properties["gridProperties"][key] = value
+                del sheet.ls_rows[sheet.row_count :]
+                for values in sheet.ls_rows:
+                    del values[sheet.column_count :]
+                sheet.dict_notes = {
+                    (row, col): note
+                    for (row, col), note in sheet.dict_notes.items()
+                    if row < sheet.row_count and col < sheet.column_count
+                }
+                sheet.trim()
+            elif field.startswith("gridProperties.") and value is not None:
+                sheet.properties["gridProperties"][field.split(".")[1]] = value
+
+    def apply_updateSpreadsheetProperties(self, spreadsheet, dict_params):
+        title = dict_params.get("properties", {}).get("title")
+        if title is not None and dict_params.get("fields", "*").strip() in [
+            "*",
+            "title",
+        ]:
+            spreadsheet.title = title
+
+    def apply_appendDimension(self, spreadsheet, dict_params):
+        sheet = spreadsheet.get_sheet(sheet_id=dict_params["sheetId"])
+        key = "rowCount" if dict_params["dimension"] == "ROWS" else "columnCount"
+        sheet.properties["gridProperties"][key] += dict_params["length"]
+
+    def apply_insertDimension(self, spreadsheet, dict_params):
+        dict_range = dict_params["range"]
+        sheet = spreadsheet.get_sheet(sheet_id=dict_range.get("sheetId", 0))
+        start, end = dict_range["startIndex"], dict_range["endIndex"]
+        if dict_range["dimension"] == "ROWS":
+            sheet.ls_rows[start:start] = [[] for _ in range(end - start)]
+            sheet.properties["gridProperties"]["rowCount"] += end - start
+            sheet.dict_notes = {
+                (row + (end - start if row >= start else 0), col): note
+                for (row, col), note in sheet.dict_notes.items()
+            }
+        else:
+            for values in sheet.ls_rows:
+                if len(values) > start:
+                    values[start:start] = [""] * (end - start)
+            sheet.properties["gridProperties"]["columnCount"] += end - start
+            sheet.dict_notes = {
+                (row, col + (end - start if col >= start else 0)): note
+                for (row, col), note in sheet.dict_notes.items()
+            }
+        sheet.trim()
+
+    def apply_deleteDimension(self, spreadsheet, dict_params):
+        dict_range = dict_params["range"]
+        sheet = spreadsheet.get_sheet(sheet_id=dict_range.get("sheetId", 0))
+        is_rows = dict_range["dimension"] == "ROWS"
+        size = sheet.row_count if is_rows else sheet.column_count
+        start = dict_range.get("startIndex", 0)
+        end = dict_range.get("endIndex", size)
+        if end - start >= size:
+            raise FakeGoogleError(
+                400, "You can't delete all the rows or columns on the sheet."
+            )
+        if is_rows:
+            del sheet.ls_rows[start:end]
+            sheet.properties["gridProperties"]["rowCount"] -= end - start
+        else:
+            for values in sheet.ls_rows:
+                del values[start:end]
+            sheet.properties["gridProperties"]["columnCount"] -= end - start
+
+        dict_notes = {}
+        for (row, col), note in sheet.dict_notes.items():
+            index = row if is_rows else col
+            if start <= index < end:
+                continue
+            shift = end - start if index >= end else 0
+            dict_notes[(row - shift, col) if is_rows else (row, col - shift)] = note
+        sheet.dict_notes = dict_notes
+        sheet.trim()
+
+    def set_cell_data(self, sheet, row, col, dict_cell, ls_fields):
+        if "*" in ls_fields or "userEnteredValue" in ls_fields:
+            sheet.set_value(row, col, get_cell_value(dict_cell.get("userEnteredValue")))
+        if "*" in ls_fields or "note" in ls_fields:
+            if dict_cell.get("note"):
+                sheet.dict_notes[(row, col)] = dict_cell["note"]
+            else:
+                sheet.dict_notes.pop((row, col), None)
+
+    def apply_updateCells(self, spreadsheet, dict_params):
+        ls_fields = get_field_names(dict_params.get("fields", "*"))
+        ls_rows = dict_params.get("rows", [])
+        if "range" in dict_params:
+            sheet, first_row, first_col, last_row, last_col = self.get_grid_bounds(
+                spreadsheet, dict_params["range"]
+            )
+        else:
+            start = dict_params.get("start", {})
+            sheet = spreadsheet.get_sheet(sheet_id=start.get("sheetId", 0))
+            first_row, first_col = start.get("rowIndex", 0), start.get("columnIndex", 0)
+            last_row = first_row + len(ls_rows) - 1
+            last_col = (
+                first_col + max([len(r.get("values", [])) for r in ls_rows] + [0]) - 1
+            )
+            if last_row >= sheet.row_count or last_col >= sheet.column_count:
+                raise FakeGoogleError(
+                    400,
+                    f"Range ({sheet.properties['title']}!R{first_row + 1}C{first_col + 1}:"
+                    f"R{last_row + 1}C{last_col + 1}) exceeds grid limits. "
+                    f"Max rows: {sheet.row_count}, max columns: {sheet.column_count}",
+                )
+
+        # with a range every cell of it is written, the ones without data are cleared for the fields
+        for row in range(first_row, last_row + 1):
+            i = row - first_row
+            ls_cells = ls_rows[i].get("values", []) if i < len(ls_rows) else []
+            if "range" not in dict_params:
+                last_col = first_col + len(ls_cells) - 1
+            for col in range(first_col, last_col + 1):
+                j = col - first_col
+                self.set_cell_data(
+                    sheet, row, col, ls_cells[j] if j < len(ls_cells) else {}, ls_fields
+                )
+        sheet.trim()
+
+    def apply_repeatCell(self, spreadsheet, dict_params):
+        ls_fields = get_field_names(dict_params.get("fields", "*"))
+        sheet, first_row, first_col, last_row, last_col = self.get_grid_bounds(
+            spreadsheet, dict_params["range"]
+        )
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                self.set_cell_data(
+                    sheet, row, col, dict_params.get("cell", {}), ls_fields
+                )
+        sheet.trim()
+
+    def paste_cells(
+        self, sheet, ls_cells, first_row, first_col, last_row, last_col, paste_type
+    ):
+        num_rows, num_cols = len(ls_cells), len(ls_cells[0])
+        # a destination that is a multiple of the source is tiled, any other is pasted once at its corner
+        if (last_row - first_row + 1) % num_rows or (
+            last_col - first_col + 1
+        ) % num_cols:
+            last_row, last_col = first_row + num_rows - 1, first_col + num_cols - 1
+        if last_row >= sheet.row_count or last_col >= sheet.column_count:
+            raise FakeGoogleError(400, "The paste range exceeds grid limits.")
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                value, note = ls_cells[(row - first_row) % num_rows][
+                    (col - first_col) % num_cols
+                ]
+                if paste_type in ["PASTE_NORMAL", "PASTE_VALUES", "PASTE_FORMULA"]:
+                    sheet.set_value(row, col, value)
+                if paste_type in ["PASTE_NORMAL", "PASTE_NOTE"]:
+                    if note:
+                        sheet.dict_notes[(row, col)] = note
+                    else:
+                        sheet.dict_notes.pop((row, col), None)
+        sheet.trim()
+
+    def get_cells(self, sheet, first_row, first_col, last_row, last_col):
+        return [
+            [
+                (sheet.get_value(row, col), sheet.dict_notes.get((row, col)))
+                for col in range(first_col, last_col + 1)
+            ]
+            for row in range(first_row, last_row + 1)
+        ]
+
+    def apply_copyPaste(self, spreadsheet, dict_params):
+        sheet, *source_bounds = self.get_grid_bounds(spreadsheet, dict_params["source"])
+        ls_cells = self.get_cells(sheet, *source_bounds)
+        dest_sheet, *dest_bounds = self.get_grid_bounds(
+            spreadsheet, dict_params["destination"]
+        )
+        self.paste_cells(
+            dest_sheet,
+            ls_cells,
+            *dest_bounds,
+            dict_params.get("pasteType", "PASTE_NORMAL"),
+        )
+
+    def apply_pasteData(self, spreadsheet, dict_params):
+        if dict_params.get("html"):
+            raise FakeGoogleError(
+                400, "html pasteData is not supported by the fake backend"
+            )
+        dict_coordinate = dict_params.get("coordinate", {})
+        sheet = spreadsheet.get_sheet(sheet_id=dict_coordinate.get("sheetId", 0))
+        first_row = dict_coordinate.get("rowIndex", 0)
+        first_col = dict_coordinate.get("columnIndex", 0)
+        # pasted text is parsed like values typed by a user, quoted fields may hold the delimiter or line breaks
+        ls_values = list(
+            csv.reader(
+                io.StringIO(dict_params.get("data", "")),
+                delimiter=dict_params.get("delimiter", ","),
+            )
+        )
+        num_cols = max([len(row) for row in ls_values] + [0])
+        if (
+            first_row + len(ls_values) > sheet.row_count
+            or first_col + num_cols > sheet.column_count
+        ):
+            raise FakeGoogleError(
+                400,
+                f"Pasted data of {len(ls_values)} rows and {num_cols} columns exceeds grid limits. "
+                f"Max rows: {sheet.row_count}, max columns: {sheet.column_count}",
+            )
+        self.write_values(
+            sheet, first_row, first_col, ls_values, "ROWS", "USER_ENTERED"
+        )
+
+    def apply_cutPaste(self, spreadsheet, dict_params):
+        sheet, first_row, first_col, last_row, last_col = self.get_grid_bounds(
+            spreadsheet, dict_params["source"]
+        )
+        ls_cells = self.get_cells(sheet, first_row, first_col, last_row, last_col)
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                sheet.set_value(row, col, "")
+                sheet.dict_notes.pop((row, col), None)
+        sheet.trim()
+
+        destination = dict_params["destination"]
+        dest_sheet = spreadsheet.get_sheet(sheet_id=destination.get("sheetId", 0))
+        dest_row, dest_col = destination.get("rowIndex", 0), destination.get(
+            "columnIndex", 0
+        )
+        self.paste_cells(
+            dest_sheet,
+            ls_cells,
+            dest_row,
+            dest_col,
+            dest_row + len(ls_cells) - 1,
+            dest_col + len(ls_cells[0]) - 1,
+            dict_params.get("pasteType", "PASTE_NORMAL"),
+        )
+
+    ## Drive ##
+
+    def handle_drive_request(self, method, path, dict_query, dict_body):
+        if path == "/files" and method == "GET":
+            return self.list_files(dict_query)
+        if path == "/files" and method == "POST":
+            return self.create_file(dict_body)
+        if path == "/changes/startPageToken" and method == "GET":
+            return {
+                "kind": "drive#startPageToken",
+                "startPageToken": str(len(self.ls_change_file_ids)),
+            }
+        if path == "/changes" and method == "GET":
+            return self.list_changes(dict_query)
+
+        match = re.fullmatch(r"/files/([^/]+)(/copy|/export)?", path)
+        if match is None:
+            raise FakeGoogleError(404, f"Not Found: {method} {path}")
+        id = urllib.parse.unquote(match.group(1))
+        file = self.dict_files.get(id)
+        if file is None:
+            raise FakeGoogleError(404, f"File not found: {id}.")
+
+        if match.group(2) == "/copy" and method == "POST":
+            return self.copy_file(file, dict_body)
+        if match.group(2) == "/export" and method == "GET":
+            if get_query_value(dict_query, "mimeType") != xlsx_mime_type:
+                raise FakeGoogleError(400, "Export only supports xlsx in the fake.")
+            content = self.export_xlsx(id)
+            if len(content) > max_export_bytes:
+                raise FakeGoogleError(
+                    403,
+                    "This file is too large to be exported.",
+                    reason="exportSizeLimitExceeded",
+                )
+            return content
+        if method == "GET":
+            return copy.deepcopy(file)
+        if method == "PATCH":
+            return self.update_file(file, dict_body, dict_query)
+        if method == "DELETE":
+            del self.dict_files[id]
+            self.dict_spreadsheets.pop(id, None)
+            self.ls_change_file_ids.append(id)
+            return None
+        raise FakeGoogleError(404, f"Not Found: {method} {path}")
+
+    def export_xlsx(self, id):
+        """
+        This function will write a spreadsheet as an xlsx file, formulas are written as their text
+        :return: the file as bytes
+        """
+        import openpyxl
+
+        spreadsheet = self.get_spreadsheet(id)
+        workbook = openpyxl.Workbook(write_only=True)
+        for sheet in spreadsheet.ls_sheets:
+            worksheet = workbook.create_sheet(sheet.properties["title"])
+            for row_values in sheet.ls_rows:
+                ls_cells = []
+                for value in row_values:
+                    if value == "":
+                        value = None
+                    elif isinstance(value, FakeFormattedNumber):
+                        value = float(value)
+                    elif isinstance(value, str) and value.startswith("="):
+                        value = openpyxl.cell.WriteOnlyCell(worksheet, value)
+                        value.data_type = "s"
+                    ls_cells.append(value)
+                worksheet.append(ls_cells)
+        output = io.BytesIO()
+        workbook.save(output)
+        return output.getvalue()
+
+    def handle_docs_request(self, method, path, dict_query, dict_body):
+        match = re.fullmatch(r"/([^/]+)/export", path)
+        if match is None or method != "GET":
+            raise FakeGoogleError(404, f"Not Found: {method} {path}")
+        if get_query_value(dict_query, "format") != "xlsx":
+            raise FakeGoogleError(400, "Export only supports xlsx in the fake.")
+        return self.export_xlsx(urllib.parse.unquote(match.group(1)))
+
+    def list_files(self, dict_query):
+        q = get_query_value(dict_query, "q")
+        match = parse_drive_query(q) if q else (lambda file: True)
+        ls_files = [file for file in self.dict_files.values() if match(file)]
+
+        order_by = get_query_value(dict_query, "orderBy", "")
+        for key in reversed(
+            [key.strip() for key in order_by.split(",") if key.strip()]
+        ):
+            if key == "recency":
+                key = "modifiedTime desc"
+            field, _, direction = key.partition(" ")
+            ls_files.sort(
+                key=lambda file: (
+                    str(file.get(field, "")).lower()
+                    if field == "name"
+                    else str(file.get(field, ""))
+                ),
+                reverse=direction.strip() == "desc",
+            )
+
+        page_size = int(get_query_value(dict_query, "pageSize", 100))
+        start = int(get_query_value(dict_query, "pageToken", 0))
+        dict_response = {
+            "kind": "drive#fileList",
+            "incompleteSearch": False,
+            "files": copy.deepcopy(ls_files[start : start + page_size]),
+        }
+        if start + page_size < len(ls_files):
+            dict_response["nextPageToken"] = str(start + page_size)
+        return dict_response
+
+    def create_file(self, dict_body):
+        name = dict_body.get("name", "Untitled")
+        mime_type = dict_body.get("mimeType", "application/octet-stream")
+        ls_parents = dict_body.get("parents")
+        parent_id = ls_parents[0] if ls_parents else None
+        if mime_type == spreadsheet_mime_type:
+            id = self.create_spreadsheet(name, parent_id=parent_id)
+        else:
+            id = self.add_drive_file(name, mime_type, parents=ls_parents)
+            if "shortcutDetails" in dict_body:
+                self.dict_files[id]["shortcutDetails"] = copy.deepcopy(
+                    dict_body["shortcutDetails"]
+                )
+        return copy.deepcopy(self.dict_files[id])
+
+    def copy_file(self, file, dict_body):
+        ls_parents = dict_body.get("parents") or file["parents"]
+        id = self.add_drive_file(
+            dict_body.get("name", f"Copy of {file['name']}"),
+            file["mimeType"],
+            parents=ls_parents,
+        )
+        if file["id"] in self.dict_spreadsheets:
+            spreadsheet = self.dict_spreadsheets[file["id"]].clone()
+            spreadsheet.spreadsheet_id = id
+            spreadsheet.title = self.dict_files[id]["name"]
+            self.dict_spreadsheets[id] = spreadsheet
+        return copy.deepcopy(self.dict_files[id])
+
+    def update_file(self, file, dict_body, dict_query):
+        for key in ["name", "trashed", "starred", "description"]:
+            if key in dict_body:
+                file[key] = dict_body[key]
+        if "name" in dict_body and file["id"] in self.dict_spreadsheets:
+            self.dict_spreadsheets[file["id"]].title = dict_body["name"]
+        ls_remove = get_query_value(dict_query, "removeParents", "").split(",")
+        file["parents"] = [id for id in file["parents"] if id not in ls_remove]
+        for id in get_query_value(dict_query, "addParents", "").split(","):
+            if id and id not in file["parents"]:
+                file["parents"].append(id)
+        self.touch_drive_file(file["id"])
+        return copy.deepcopy(file)
+
+    def list_changes(self, dict_query):
+        start = int(get_query_value(dict_query, "pageToken", 0))
+        page_size = int(get_query_value(dict_query, "pageSize", 100))
+        ls_ids = self.ls_change_file_ids[start : start + page_size]
+        end = start + len(ls_ids)
+
+        # like the api only the latest state of a file changed more than once is listed
+        ls_changes = []
+        for id in dict.fromkeys(ls_ids):
+            change = {
+                "kind": "drive#change",
+                "changeType": "file",
+                "fileId": id,
+                "removed": id not in self.dict_files,
+                "time": get_timestamp(),
+            }
+            if id in self.dict_files:
+                change["file"] = copy.deepcopy(self.dict_files[id])
+            ls_changes.append(change)
+
+        dict_response = {"kind": "drive#changeList", "changes": ls_changes}
+        if end < len(self.ls_change_file_ids):
+            dict_response["nextPageToken"] = str(end)
+        else:
+            dict_response["newStartPageToken"] = str(end)
+        return dict_response
+
+    def create_shortcut(self, name, target_id, parent_id=None):
+        """
+        This function will add a shortcut to a file or folder to the fake drive
+        :return: the id of the shortcut
+        """
+        id = self.add_drive_file(
+            name, shortcut_mime_type, parents=[parent_id] if parent_id else None
+        )
+        self.dict_files[id]["shortcutDetails"] = {
+            "targetId": target_id,
+            "targetMimeType": self.dict_files[target_id]["mimeType"],
+        }
+        return id
+
+
+def parse_drive_query(q):
+    """
+    This function will compile a drive files.list query into a function of a file,
+    supporting name, mimeType, trashed, starred, modifiedTime, createdTime, parents and fullText terms
+    joined with and, or, not and parentheses
+    :param q: the query like "'folder_id' in parents and trashed = false"
+    :return: function of a drive file dictionary to bool
+    """
+    ls_tokens = re.findall(
+        r"'(?:[^'\\]|\\.)*'|!=|<=|>=|[=<>()]|[A-Za-z_][A-Za-z0-9_]*|\S", q
+    )
+    position = [0]
+
+    def peek():
+        return ls_tokens[position[0]] if position[0] < len(ls_tokens) else None
+
+    def take():
+        token = peek()
+        if token is None:
+            raise FakeGoogleError(400, f"Invalid Value: {q}")
+        position[0] += 1
+        return token
+
+    def parse_literal(token):
+        if token.startswith("'"):
+            return re.sub(r"\\(.)", r"\1", token[1:-1])
+        if token in ["true", "false"]:
+            return token == "true"
+        raise FakeGoogleError(400, f"Invalid Value: {q}")
+
+    def parse_or():
+        ls_terms = [parse_and()]
+        while peek() == "or":
+            take()
+            ls_terms.append(parse_and())
+        return lambda file: any(term(file) for term in ls_terms)
+
+    def parse_and():
+        ls_terms = [parse_not()]
+        while peek() == "and":
+            take()
+            ls_terms.append(parse_not())
+        return lambda file: all(term(file) for term in ls_terms)
+
+    def parse_not():
+        if peek() == "not":
+            take()
+            term = parse_not()
+            return lambda file: not term(file)
+        if peek() == "(":
+            take()
+            term = parse_or()
+            if take() != ")":
+                raise FakeGoogleError(400, f"Invalid Value: {q}")
+            return term
+        return parse_comparison()
+
+    def parse_comparison():
+        token = take()
+        if token.startswith("'"):
+            value = parse_literal(token)
+            if take() != "in":
+                raise FakeGoogleError(400, f"Invalid Value: {q}")
+            field = take()
+            return lambda file: value in file.get(field, [])
+
+        field, operator, value = token, take(), parse_literal(take())
+        if field == "fullText":
+            field = "name"
+        if operator == "contains":
+            return lambda file: str(value).lower() in str(file.get(field, "")).lower()
+        dict_operators = {
+            "=": lambda a, b: a == b,
+            "!=": lambda a, b: a != b,
+            "<": lambda a, b: a < b,
+            "<=": lambda a, b: a <= b,
+            ">": lambda a, b: a > b,
+            ">=": lambda a, b: a >= b,
+        }
+        if operator not in dict_operators:
+            raise FakeGoogleError(400, f"Invalid Value: {q}")
+        compare = dict_operators[operator]
+        if field in ["modifiedTime", "createdTime"]:
+            # times compare as instants, the api takes RFC 3339 with or without fractions and zone
+            value = normalize_timestamp(value)
+            return lambda file: compare(normalize_timestamp(file.get(field, "")), value)
+        default = False if field in ["trashed", "starred"] else ""
+        return lambda file: compare(file.get(field, default), value)
+
+    match = parse_or()
+    if peek() is not None:
+        raise FakeGoogleError(400, f"Invalid Value: {q}")
+    return match
+
+
+def normalize_timestamp(value):
+    if not value:
+        return ""
+    timestamp = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp.astimezone(datetime.timezone.utc).isoformat()
+
+
+class FakeHttp:
+    """
+    An httplib2.Http stand in that serves requests from a FakeGoogleBackend
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.timeout = None
+        self.connections = {}
+        self.follow_redirects = True
+        self.redirect_codes = httplib2.REDIRECT_CODES
+
+    def request(
+        self,
+        uri,
+        method="GET",
+        body=None,
+        headers=None,
+        redirections=5,
+        connection_type=None,
+        **kwargs,
+    ):
+        status, dict_headers, content = self.backend.handle_request(uri, method, body)
+        response = httplib2.Response({"status": status, **dict_headers})
+        response.reason = "OK" if status < 300 else "Error"
+        return response, content
+
+    def close(self):
+        pass
+
+    def add_certificate(self, *args, **kwargs):
+        pass
+
+
+def get_fake_client(backend):
+    """
+    This function will return a pygsheets client whose sheets and drive requests are served by the backend
+    :param backend: the FakeGoogleBackend
+    :return: pygsheets client
+    """
+    client = pygsheets.client.Client(
+        AnonymousCredentials(), http=FakeHttp(backend), check=False, retries=0
+    )
+    # threads ask the client for their own http, see google_tools.get_thread_http
+    client.new_thread_http = lambda: FakeHttp(backend)
+    client.fake_backend = backend
+    return client
@@ -5,19 +5,41 @@ if __name__ != "__main__":
     print(f"Importing {__name__}")
 
 import pygsheets
+from pygsheets.utils import format_addr
 import os
 from os.path import expanduser
 from pydrive.auth import GoogleAuth
 from pydrive.drive import GoogleDrive
 import pandas as pd
+import numpy as np
 import datetime
+import io
 import sys
 import time
+import threading
+import sqlite3
+import contextlib
+import random
+import socket
+import ssl
+import email.utils
+import httplib2
+import hashlib
+import concurrent.futures
+import multiprocessing
+import collections
+import re
+import csv
 from google.auth.exceptions import TransportError
 from googleapiclient.errors import HttpError
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+import googleapiclient.http
+import google_auth_httplib2
+from google_auth_httplib2 import AuthorizedHttp
 import json
+import shutil
+import atexit
+import copy
+import openpyxl
 
 # append grandparent
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -61,321 +83,4359 @@ file_dir = os.path.dirname(os.path.realpath(__file__))
 
 
 # %%
-## Google ##
+## Rate Limiting ##
+
+# token buckets shared by every process on this host through a sqlite file, so cron jobs using the
+# same service account at the same time split the per minute quotas instead of hitting 429s
+loc_rate_limit_db = os.path.join(data_dir, "google_api_rate_limit.sqlite")
+
+# requests per minute for each bucket, sheets reads and writes are separate quotas
+dict_api_quotas_per_minute = {
+    "sheets_read": 60,
+    "sheets_write": 60,
+    "drive": 1000,
+}
+
+# share of each bucket a lane has to leave free, so bulk exports cant starve interactive reads
+dict_api_lane_reserves = {
+    "interactive": 0.0,
+    "bulk": 0.25,
+}
+
+# notebooks are interactive, everything else like cron scripts is bulk
+default_api_lane = "interactive" if "ipykernel" in sys.modules else "bulk"
+
+max_api_token_wait_seconds = 600
+
+thread_local_api_lane = threading.local()
+rate_limit_db_lock = threading.Lock()
+rate_limit_db_ready = False
+
+
+def get_api_lane():
+    """
+    This function will return the priority lane of the current thread
+    :return: "interactive" or "bulk"
+    """
+    return getattr(thread_local_api_lane, "lane", default_api_lane)
+
+
+@contextlib.contextmanager
+def google_api_lane(lane):
+    """
+    This context manager will run the Google API calls made inside it in a priority lane
+    :param lane: "interactive" or "bulk"
+    """
+    if lane not in dict_api_lane_reserves.keys():
+        raise Exception(
+            f"Unknown Google API lane {lane}, options are {list(dict_api_lane_reserves.keys())}"
+        )
+
+    previous_lane = get_api_lane()
+    thread_local_api_lane.lane = lane
+    try:
+        yield
+    finally:
+        thread_local_api_lane.lane = previous_lane
+
+
+def get_rate_limit_db_connection():
+    global rate_limit_db_ready
+
+    os.makedirs(os.path.dirname(loc_rate_limit_db), exist_ok=True)
+    con = sqlite3.connect(loc_rate_limit_db, timeout=60, isolation_level=None)
+
+    with rate_limit_db_lock:
+        if not rate_limit_db_ready:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+            )
+            rate_limit_db_ready = True
+
+    return con
+
+
+def update_api_bucket(bucket, lane=None, drain=False):
+    """
+    This function will refill a token bucket for the time passed and take a token from it if the lane may
+    :param bucket: the name of the bucket in dict_api_quotas_per_minute
+    :param lane: the priority lane, defaults to the lane of the current thread
+    :param drain: whether to empty the bucket instead, used when google rate limits us anyway
+    :return: seconds to wait before trying again, 0 when a token was taken
+    """
+    lane = lane or get_api_lane()
+    capacity = dict_api_quotas_per_minute[bucket]
+    tokens_per_second = capacity / 60
+    tokens_required = 1 + dict_api_lane_reserves[lane] * capacity
+
+    con = get_rate_limit_db_connection()
+    try:
+        # immediate transactions lock the file for writing, so other processes wait for their turn
+        con.execute("BEGIN IMMEDIATE")
+        row = con.execute(
+            "SELECT tokens, updated FROM buckets WHERE name = ?", (bucket,)
+        ).fetchone()
+        now = time.time()
+        if row is None:
+            tokens = capacity
+        else:
+            tokens = min(capacity, row[0] + max(now - row[1], 0) * tokens_per_second)
+
+        if drain:
+            tokens, wait_seconds = 0, 0
+        elif tokens >= tokens_required:
+            tokens, wait_seconds = tokens - 1, 0
+        else:
+            wait_seconds = (tokens_required - tokens) / tokens_per_second
+
+        con.execute(
+            "INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+            (bucket, tokens, now),
+        )
+        con.execute("COMMIT")
+    finally:
+        con.close()
+
+    return wait_seconds
+
+
+def acquire_api_token(bucket, lane=None):
+    """
+    This function will block until a request may be sent under the shared per minute quota
+    :param bucket: the name of the bucket in dict_api_quotas_per_minute
+    :param lane: the priority lane, defaults to the lane of the current thread
+    :return: None
+    """
+    start_time = time.time()
+    wait_seconds = update_api_bucket(bucket, lane=lane)
+    while wait_seconds > 0:
+        if time.time() - start_time + wait_seconds > max_api_token_wait_seconds:
+            raise Exception(
+                f"Waited more than {max_api_token_wait_seconds} seconds for a {bucket} token in the {lane or get_api_lane()} lane"
+            )
+        # wake up at least every few seconds as other processes may have left tokens
+        time.sleep(min(wait_seconds, 5))
+        wait_seconds = update_api_bucket(bucket, lane=lane)
+
+
+def get_sheets_request_bucket(request):
+    return "sheets_read" if request.method == "GET" else "sheets_write"
+
+
+def meter_client_requests(client):
+    """
+    This function will make every Sheets and Drive request of a pygsheets client wait for a token first,
+    a 429 or a rate limit 403 from google drains the bucket so every process backs off together
+    :param client: the pygsheets client to meter
+    :return: the client
+    """
+    execute_sheets_request = client.sheet._execute_requests
+    execute_drive_request = client.drive._execute_request
+
+    def execute_metered_request(execute_request, bucket, request):
+        start_time = time.perf_counter()
+        acquire_api_token(bucket)
+        api_metrics.observe(
+            "google_api_token_wait_seconds",
+            {"script": api_metrics_script, "bucket": bucket},
+            time.perf_counter() - start_time,
+            ls_api_latency_buckets,
+        )
+        try:
+            return execute_request(request)
+        except HttpError as e:
+            if classify_google_error(e) == "rate_limited":
+                update_api_bucket(bucket, drain=True)
+            raise
+
+    client.sheet._execute_requests = lambda request: execute_metered_request(
+        execute_sheets_request, get_sheets_request_bucket(request), request
+    )
+    client.drive._execute_request = lambda request: execute_metered_request(
+        execute_drive_request, "drive", request
+    )
+
+    return client
 
 
-gc = pygsheets.authorize(
-    service_file=os.path.join(
-        expanduser("~"),
-        "credentials",
-        "team",
-        "gsheets_auth_service",
-        "service_account_credentials.json",
-    ),
-    credentials_directory=os.path.join(file_dir, "gsheets_auth_service"),
+# %%
+## Metrics ##
+
+# every sheets and drive request of the clients is recorded here, counters and histograms for prometheus and
+# one event per request for json lines, labelled with the script so the quota used by each job can be told apart
+loc_api_metrics = os.path.join(data_dir, "google_api_metrics")
+
+api_metrics_script = (
+    "interactive"
+    if "ipykernel" in sys.modules
+    else os.path.splitext(os.path.basename(sys.argv[0] or "interactive"))[0]
 )
 
-try:
-    gc_oauth = pygsheets.authorize(
-        client_secret=os.path.join(
-            expanduser("~"),
-            "credentials",
-            "personal",
-            "gsheets_auth_oauth",
-            "oauth.json",
-        ),
-        credentials_directory=os.path.join(
-            expanduser("~"), "credentials", "personal", "gsheets_auth_oauth"
+ls_api_latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+ls_api_bytes_buckets = [1024, 10 * 1024, 100 * 1024, 1024**2, 10 * 1024**2]
+
+# events waiting for export_api_metrics_jsonl, the oldest are dropped past this
+api_metrics_max_events = 100_000
+
+thread_local_api_call = threading.local()
+
+
+class ApiMetricsRegistry:
+    """
+    In memory counters, histograms and per request events of the Google API calls of this process
+    """
+
+    def __init__(self, max_events=api_metrics_max_events):
+        """
+        :param max_events: the number of events kept for export, the oldest are dropped past it
+        """
+        self._lock = threading.Lock()
+        self._dict_counters = {}
+        self._dict_histograms = {}
+        self._deque_events = collections.deque(maxlen=max_events)
+        self.dropped_events = 0
+
+    def inc(self, name, dict_labels, value=1):
+        key = (name, tuple(sorted(dict_labels.items())))
+        with self._lock:
+            self._dict_counters[key] = self._dict_counters.get(key, 0) + value
+
+    def observe(self, name, dict_labels, value, ls_buckets):
+        key = (name, tuple(sorted(dict_labels.items())))
+        with self._lock:
+            histogram = self._dict_histograms.get(key)
+            if histogram is None:
+                histogram = {
+                    "buckets": list(ls_buckets),
+                    "counts": [0] * len(ls_buckets),
+                    "sum": 0,
+                    "count": 0,
+                }
+                self._dict_histograms[key] = histogram
+            for i, bound in enumerate(histogram["buckets"]):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def add_event(self, dict_event):
+        with self._lock:
+            if len(self._deque_events) == self._deque_events.maxlen:
+                self.dropped_events += 1
+            self._deque_events.append(dict_event)
+
+    def record_request(
+        self,
+        operation,
+        spreadsheet_id,
+        status,
+        bytes_sent,
+        bytes_received,
+        latency_seconds,
+    ):
+        """
+        This function will record one http request to a Google API
+        :param operation: the api method like "sheets.spreadsheets.values.get"
+        :param spreadsheet_id: the id of the spreadsheet or drive file, "" for listings
+        :param status: the http status, or the exception name when no response came back
+        :return: None
+        """
+        call, attempt = getattr(thread_local_api_call, "call", (None, 1))
+        thread_local_api_call.last_operation = operation
+        dict_labels = {"script": api_metrics_script, "operation": operation}
+
+        self.inc(
+            "google_api_requests_total",
+            {
+                **dict_labels,
+                "spreadsheet_id": spreadsheet_id,
+                "status": str(status),
+                "lane": get_api_lane(),
+            },
+        )
+        self.inc(
+            "google_api_bytes_total",
+            {**dict_labels, "spreadsheet_id": spreadsheet_id, "direction": "sent"},
+            bytes_sent,
+        )
+        self.inc(
+            "google_api_bytes_total",
+            {**dict_labels, "spreadsheet_id": spreadsheet_id, "direction": "received"},
+            bytes_received,
+        )
+        self.observe(
+            "google_api_request_latency_seconds",
+            dict_labels,
+            latency_seconds,
+            ls_api_latency_buckets,
+        )
+        self.observe(
+            "google_api_request_bytes",
+            {**dict_labels, "direction": "sent"},
+            bytes_sent,
+            ls_api_bytes_buckets,
+        )
+        self.observe(
+            "google_api_request_bytes",
+            {**dict_labels, "direction": "received"},
+            bytes_received,
+            ls_api_bytes_buckets,
+        )
+        self.add_event(
+            {
+                "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "script": api_metrics_script,
+                "pid": os.getpid(),
+                "operation": operation,
+                "spreadsheet_id": spreadsheet_id,
+                "status": status,
+                "call": call,
+                "attempt": attempt,
+                "bytes_sent": bytes_sent,
+                "bytes_received": bytes_received,
+                "latency_seconds": round(latency_seconds, 4),
+                "lane": get_api_lane(),
+            }
+        )
+
+    def record_retry(self, error_class, key):
+        """
+        This function will record a retry of call_with_retry, under the api method that failed last on this thread
+        """
+        self.inc(
+            "google_api_retries_total",
+            {
+                "script": api_metrics_script,
+                "operation": getattr(
+                    thread_local_api_call, "last_operation", "unknown"
+                ),
+                "error_class": error_class,
+                "key": key or "",
+            },
+        )
+
+    def get_metrics(self):
+        """
+        This function will return a copy of the counters and histograms
+        :return: dict with "counters" and "histograms", lists of dictionaries with "name", "labels" and the values
+        """
+        with self._lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self._dict_counters.items()
+                ],
+                "histograms": [
+                    {"name": name, "labels": dict(labels), **copy.deepcopy(histogram)}
+                    for (name, labels), histogram in self._dict_histograms.items()
+                ],
+                "dropped_events": self.dropped_events,
+            }
+
+    def pop_events(self):
+        with self._lock:
+            ls_events = list(self._deque_events)
+            self._deque_events.clear()
+        return ls_events
+
+    def get_prometheus_text(self):
+        """
+        This function will render the counters and histograms in the prometheus text format
+        :return: string
+        """
+
+        def get_label_text(dict_labels):
+            # backslashes, quotes and newlines are escaped in label values
+            ls_labels = [
+                name
+                + '="'
+                + str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n")
+                + '"'
+                for name, value in dict_labels.items()
+            ]
+            return "{" + ",".join(ls_labels) + "}" if ls_labels else ""
+
+        dict_metrics = self.get_metrics()
+        ls_lines = []
+        for name in sorted({counter["name"] for counter in dict_metrics["counters"]}):
+            ls_lines.append(f"# TYPE {name} counter")
+            for counter in dict_metrics["counters"]:
+                if counter["name"] == name:
+                    ls_lines.append(
+                        f"{name}{get_label_text(counter['labels'])} {counter['value']}"
+                    )
+        for name in sorted(
+            {histogram["name"] for histogram in dict_metrics["histograms"]}
+        ):
+            ls_lines.append(f"# TYPE {name} histogram")
+            for histogram in dict_metrics["histograms"]:
+                if histogram["name"] != name:
+                    continue
+                for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                    dict_labels = {**histogram["labels"], "le": bound}
+                    ls_lines.append(
+                        f"{name}_bucket{get_label_text(dict_labels)} {count}"
+                    )
+                dict_labels = {**histogram["labels"], "le": "+Inf"}
+                ls_lines.append(
+                    f"{name}_bucket{get_label_text(dict_labels)} {histogram['count']}"
+                )
+                ls_lines.append(
+                    f"{name}_sum{get_label_text(histogram['labels'])} {histogram['sum']}"
+                )
+                ls_lines.append(
+                    f"{name}_count{get_label_text(histogram['labels'])} {histogram['count']}"
+                )
+        return "\n".join(ls_lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._dict_counters.clear()
+            self._dict_histograms.clear()
+            self._deque_events.clear()
+            self.dropped_events = 0
+
+
+api_metrics = ApiMetricsRegistry()
+
+
+@contextlib.contextmanager
+def api_call_context(call, attempt):
+    """
+    This context manager will tag the requests made inside it with the call_with_retry operation and attempt
+    """
+    previous_call = getattr(thread_local_api_call, "call", None)
+    thread_local_api_call.call = (call, attempt)
+    try:
+        yield
+    finally:
+        if previous_call is None:
+            del thread_local_api_call.call
+        else:
+            thread_local_api_call.call = previous_call
+
+
+def get_request_spreadsheet_id(uri):
+    match = re.search(r"/(?:spreadsheets|files)/([A-Za-z0-9_-]{10,})", uri)
+    return "" if match is None else match.group(1)
+
+
+def instrument_client_requests(client):
+    """
+    This function will record every Sheets and Drive request of a pygsheets client in api_metrics
+    with its operation, spreadsheet id, status, payload bytes and latency
+    :param client: the pygsheets client to instrument
+    :return: the client
+    """
+    execute_sheets_request = client.sheet._execute_requests
+    execute_drive_request = client.drive._execute_request
+
+    def execute_instrumented_request(execute_request, request):
+        body = request.body or b""
+        bytes_sent = len(body.encode() if isinstance(body, str) else body)
+        dict_response = {"status": None, "bytes_received": 0}
+
+        # the raw response is only seen by postproc, before googleapiclient parses it
+        postproc = request.postproc
+
+        def measured_postproc(resp, content):
+            dict_response["status"] = resp.status
+            dict_response["bytes_received"] = len(content or b"")
+            return postproc(resp, content)
+
+        request.postproc = measured_postproc
+        start_time = time.perf_counter()
+        try:
+            return execute_request(request)
+        except HttpError as e:
+            dict_response["status"] = e.resp.status
+            dict_response["bytes_received"] = len(e.content or b"")
+            raise
+        except Exception as e:
+            dict_response["status"] = dict_response["status"] or type(e).__name__
+            raise
+        finally:
+            request.postproc = postproc
+            api_metrics.record_request(
+                getattr(request, "methodId", None) or request.method,
+                get_request_spreadsheet_id(request.uri),
+                dict_response["status"],
+                bytes_sent,
+                dict_response["bytes_received"],
+                time.perf_counter() - start_time,
+            )
+
+    client.sheet._execute_requests = lambda request: execute_instrumented_request(
+        execute_sheets_request, request
+    )
+    client.drive._execute_request = lambda request: execute_instrumented_request(
+        execute_drive_request, request
+    )
+
+    return client
+
+
+def get_api_metrics():
+    """
+    This function will return the counters and histograms recorded so far
+    :return: dict with "counters", "histograms" and "dropped_events"
+    """
+    return api_metrics.get_metrics()
+
+
+def export_api_metrics_prometheus(path=None):
+    """
+    This function will write the metrics of this process as a prometheus textfile, atomically so a collector
+    never reads half a file
+    :param path: the file to write, defaults to data_dir/google_api_metrics/{script}.prom
+    :return: the path written
+    """
+    path = path or os.path.join(loc_api_metrics, f"{api_metrics_script}.prom")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(api_metrics.get_prometheus_text())
+    os.replace(tmp_path, path)
+    return path
+
+
+def export_api_metrics_jsonl(path=None):
+    """
+    This function will append the request events recorded since the last export as json lines
+    :param path: the file to append to, defaults to data_dir/google_api_metrics/google_api_calls.jsonl
+    :return: the number of events written
+    """
+    path = path or os.path.join(loc_api_metrics, "google_api_calls.jsonl")
+    ls_events = api_metrics.pop_events()
+    if not ls_events:
+        return 0
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        f.write("".join(json.dumps(event, default=str) + "\n" for event in ls_events))
+    return len(ls_events)
+
+
+def export_api_metrics_at_exit():
+    ls_formats = os.environ.get("GOOGLE_TOOLS_METRICS_EXPORT", "").split(",")
+    try:
+        if "prometheus" in ls_formats:
+            export_api_metrics_prometheus()
+        if "jsonl" in ls_formats:
+            export_api_metrics_jsonl()
+    except Exception as e:
+        print_logger(f"Error exporting google api metrics because {e}")
+
+
+# GOOGLE_TOOLS_METRICS_EXPORT=prometheus,jsonl exports the metrics of every script when it exits
+if os.environ.get("GOOGLE_TOOLS_METRICS_EXPORT"):
+    atexit.register(export_api_metrics_at_exit)
+
+
+# %%
+## Retries ##
+
+dict_retry_policy = {
+    # attempts per operation, including the first one
+    "max_attempts": 5,
+    # backoff before attempt n is a random delay up to base * 2 ** (n - 1), capped at max
+    "base_delay_seconds": 2,
+    "max_delay_seconds": 60,
+    # total time an operation may spend including waits, no retry starts past it
+    "deadline_seconds": 600,
+    # a 404 right after a book or sheet is created can be eventual consistency, so try once more
+    "not_found_attempts": 2,
+    # consecutive failures of one spreadsheet that open its breaker, and how long it stays open
+    "breaker_failure_threshold": 5,
+    "breaker_cooldown_seconds": 120,
+}
+
+dict_circuit_breakers = {}
+circuit_breaker_lock = threading.Lock()
+
+# drive and sometimes sheets report running out of quota as a 403 with one of these reasons instead of a 429
+ls_rate_limit_reasons = ["rateLimitExceeded", "userRateLimitExceeded"]
+
+
+def get_google_error_reasons(e):
+    """
+    This function will read the reasons google gives in the body of an error response
+    :param e: the HttpError
+    :return: list of reasons like "userRateLimitExceeded", empty when the body has none
+    """
+    try:
+        dict_error = json.loads(e.content).get("error", {})
+    except (ValueError, TypeError, AttributeError):
+        return []
+    if not isinstance(dict_error, dict):
+        return []
+    ls_reasons = [
+        dict_detail.get("reason")
+        for dict_detail in dict_error.get("errors", []) + dict_error.get("details", [])
+        if isinstance(dict_detail, dict)
+    ]
+    return [reason for reason in ls_reasons if reason]
+
+
+# a cached sheet handle whose tab was deleted, recreated or renamed since makes requests fail with these 400s
+ls_stale_sheet_messages = ["No grid with id", "Unable to parse range"]
+
+
+def is_stale_sheet_error(e):
+    if not isinstance(e, HttpError) or e.resp.status != 400:
+        return False
+    content = e.content.decode(errors="replace") if e.content else ""
+    return any(message in content for message in ls_stale_sheet_messages)
+
+
+def classify_google_error(e):
+    """
+    This function will classify an error raised by a Google API call for the retry engine
+    :param e: the exception
+    :return: "rate_limited", "transient", "not_found" or "fatal"
+    """
+    # pydrive wraps the HttpError of a failed request
+    if not isinstance(e, HttpError) and e.args and isinstance(e.args[0], HttpError):
+        e = e.args[0]
+
+    if isinstance(e, HttpError):
+        status = e.resp.status
+        if status == 429:
+            return "rate_limited"
+        if status == 403 and any(
+            reason in ls_rate_limit_reasons for reason in get_google_error_reasons(e)
+        ):
+            return "rate_limited"
+        if status >= 500 or status == 408:
+            return "transient"
+        # a stale handle is a tab that is not where the handle says, retried once with fresh handles
+        if status == 404 or is_stale_sheet_error(e):
+            return "not_found"
+        return "fatal"
+    if isinstance(e, ssl.SSLCertVerificationError):
+        return "fatal"
+    # ssl errors other than a bad certificate are dropped connections and handshake timeouts,
+    # gaierror is a dns lookup that failed
+    if isinstance(
+        e,
+        (
+            TransportError,
+            ConnectionError,
+            TimeoutError,
+            socket.timeout,
+            socket.gaierror,
+            ssl.SSLError,
         ),
+    ):
+        return "transient"
+    if isinstance(e, httplib2.HttpLib2Error):
+        return "transient"
+    return "fatal"
+
+
+def get_root_error(e):
+    """
+    This function will find the error at the root of a chain, call_with_retry wraps the error of the last attempt
+    :param e: the exception
+    :return: the first exception of the chain
+    """
+    while e.__cause__ is not None:
+        e = e.__cause__
+    return e
+
+
+def get_retry_after_seconds(e):
+    """
+    This function will read the Retry-After header of an HttpError
+    :param e: the exception
+    :return: seconds to wait or None if the header is missing
+    """
+    if not isinstance(e, HttpError):
+        return None
+
+    retry_after = e.resp.get("retry-after")
+    if retry_after is None:
+        return None
+
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+        return max(
+            (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+def check_circuit_breaker(key, policy):
+    """
+    This function will raise if the circuit breaker of a spreadsheet is open
+    :param key: the spreadsheet id or name
+    :param policy: the retry policy
+    :return: None
+    """
+    if key is None:
+        return
+
+    with circuit_breaker_lock:
+        breaker = dict_circuit_breakers.get(key)
+        if breaker is None or breaker["opened_at"] is None:
+            return
+        open_seconds = time.time() - breaker["opened_at"]
+        if open_seconds >= policy["breaker_cooldown_seconds"]:
+            # half open, let this call through and reopen on its first failure
+            breaker["opened_at"] = None
+            breaker["failures"] = policy["breaker_failure_threshold"] - 1
+            return
+
+    raise Exception(
+        f"Circuit breaker for {key} is open after repeated failures, retry in {policy['breaker_cooldown_seconds'] - open_seconds:.0f} seconds"
     )
-except Exception as e:
-    print_logger(f"Error connecting to Google Sheets with OAuth because {e}")
-    pass
+
+
+def record_circuit_breaker_result(key, policy, success):
+    if key is None:
+        return
+
+    with circuit_breaker_lock:
+        breaker = dict_circuit_breakers.setdefault(
+            key, {"failures": 0, "opened_at": None}
+        )
+        if success:
+            breaker["failures"] = 0
+            breaker["opened_at"] = None
+            return
+        breaker["failures"] += 1
+        if (
+            breaker["failures"] >= policy["breaker_failure_threshold"]
+            and breaker["opened_at"] is None
+        ):
+            breaker["opened_at"] = time.time()
+            print_logger(
+                f"Opening circuit breaker for {key} after {breaker['failures']} consecutive failures"
+            )
+
+
+def call_with_retry(
+    operation,
+    func,
+    *args,
+    key=None,
+    policy=None,
+    on_retry=None,
+    on_error=None,
+    **kwargs,
+):
+    """
+    This function will call a Google API operation, retrying transient errors with exponential backoff and jitter
+    :param operation: description of the operation for logs and errors
+    :param func: the function to call
+    :param args: positional arguments of the function
+    :param key: the spreadsheet id or name the operation targets, used for the circuit breaker
+    :param policy: dictionary overriding values of dict_retry_policy
+    :param on_retry: function called with the exception before each retry, to drop stale handles
+    :param on_error: function called with the exception of every failed attempt, retried or not
+    :param kwargs: keyword arguments of the function
+    :return: the return value of the function
+    """
+    policy = {**dict_retry_policy, **(policy or {})}
+    check_circuit_breaker(key, policy)
+
+    start_time = time.time()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            with api_call_context(operation, attempt):
+                result = func(*args, **kwargs)
+            record_circuit_breaker_result(key, policy, success=True)
+            return result
+        except Exception as e:
+            if on_error is not None:
+                on_error(e)
+            # a nested call_with_retry that ran out of attempts raises its error wrapped, like the chunk uploads
+            # of a chunked write, so the outer call retries on what went wrong instead of on the wrapper
+            error_class = classify_google_error(get_root_error(e))
+            if error_class == "fatal":
+                raise
+
+            if error_class == "not_found":
+                max_attempts = min(policy["not_found_attempts"], policy["max_attempts"])
+            else:
+                record_circuit_breaker_result(key, policy, success=False)
+                max_attempts = policy["max_attempts"]
+
+            if attempt >= max_attempts:
+                print_logger(
+                    f"Failed to {operation} after {attempt} attempts, error: {e}"
+                )
+                raise Exception(
+                    f"Failed to {operation} after {attempt} attempts because of {error_class} error {e}"
+                ) from e
+
+            delay_seconds = get_retry_after_seconds(get_root_error(e))
+            if delay_seconds is None:
+                delay_seconds = random.uniform(
+                    0,
+                    min(
+                        policy["max_delay_seconds"],
+                        policy["base_delay_seconds"] * 2 ** (attempt - 1),
+                    ),
+                )
+
+            if time.time() - start_time + delay_seconds > policy["deadline_seconds"]:
+                print_logger(
+                    f"Failed to {operation}, deadline of {policy['deadline_seconds']} seconds reached, error: {e}"
+                )
+                raise Exception(
+                    f"Failed to {operation} within {policy['deadline_seconds']} seconds because of {error_class} error {e}"
+                ) from e
+
+            print_logger(
+                f"Failed to {operation} with {error_class} error: {e}, retrying {attempt} of {max_attempts - 1} times after {delay_seconds:.1f} seconds"
+            )
+            api_metrics.record_retry(error_class, key)
+            if on_retry is not None:
+                on_retry(e)
+            time.sleep(delay_seconds)
+            check_circuit_breaker(key, policy)
 
 
 # %%
-## Frequently Used Functions ##
+## Google ##
+
+
+class LazyGoogleClient:
+    """
+    Authorizes a client on first use instead of at import, so scripts that never touch google pay no auth round trips,
+    every thread shares the one client and so its credentials and refreshed tokens unless it authorized its own with
+    use_thread_client, attribute access is forwarded to the client so it can be used in place of a pygsheets client
+    """
+
+    def __init__(self, name, authorize_client):
+        """
+        :param name: the name of the client used in logs
+        :param authorize_client: function with no arguments returning the authorized client
+        """
+        self._name = name
+        self._authorize_client = authorize_client
+        self._client = None
+        self._lock = threading.Lock()
+        self._thread_local = threading.local()
+
+    def get(self):
+        """
+        This function will return the client, authorizing it if this is the first use
+        :return: the authorized client, the own client of the thread if it has one
+        """
+        thread_client = getattr(self._thread_local, "client", None)
+        if thread_client is not None:
+            return thread_client
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    start_time = time.time()
+                    self._client = self._authorize_client()
+                    print_logger(
+                        f"Authorized {self._name} google client in {time.time() - start_time:.2f} seconds"
+                    )
+        return self._client
+
+    def is_authorized(self):
+        return self._client is not None
+
+    def use_thread_client(self, authorize_client=None):
+        """
+        This function will authorize a client used only by the current thread from then on, for a background thread
+        that would otherwise share the connections of the pygsheets client with the thread that started it
+        :param authorize_client: function with no arguments returning the client of the thread, None for the one
+            given at init
+        :return: the authorized client
+        """
+        start_time = time.time()
+        self._thread_local.client = (authorize_client or self._authorize_client)()
+        print_logger(
+            f"Authorized {self._name} google client for thread {threading.current_thread().name} in {time.time() - start_time:.2f} seconds"
+        )
+        return self._thread_local.client
+
+    def reset(self, authorize_client=None):
+        """
+        This function will drop the client so the next use authorizes again
+        :param authorize_client: function replacing the one given at init, None to keep it
+        :return: None
+        """
+        with self._lock:
+            if authorize_client is not None:
+                self._authorize_client = authorize_client
+            self._client = None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __repr__(self):
+        if self._client is None:
+            return f"<LazyGoogleClient {self._name} not authorized>"
+        return f"<LazyGoogleClient {self._name} {self._client!r}>"
+
+
+def authorize_service_account_client():
+    # check=False leaves 429s to the rate limiter instead of pygsheets sleeping for 100 seconds,
+    # retries=0 leaves retrying to call_with_retry
+    return meter_client_requests(
+        instrument_client_requests(
+            pygsheets.authorize(
+                service_file=os.path.join(
+                    expanduser("~"),
+                    "credentials",
+                    "team",
+                    "gsheets_auth_service",
+                    "service_account_credentials.json",
+                ),
+                credentials_directory=os.path.join(file_dir, "gsheets_auth_service"),
+                check=False,
+                retries=0,
+            )
+        )
+    )
+
+
+def authorize_oauth_client():
+    try:
+        return meter_client_requests(
+            instrument_client_requests(
+                pygsheets.authorize(
+                    client_secret=os.path.join(
+                        expanduser("~"),
+                        "credentials",
+                        "personal",
+                        "gsheets_auth_oauth",
+                        "oauth.json",
+                    ),
+                    credentials_directory=os.path.join(
+                        expanduser("~"), "credentials", "personal", "gsheets_auth_oauth"
+                    ),
+                    check=False,
+                    retries=0,
+                )
+            )
+        )
+    except Exception as e:
+        print_logger(f"Error connecting to Google Sheets with OAuth because {e}")
+        raise
+
+
+gc = LazyGoogleClient("service account", authorize_service_account_client)
+gc_oauth = LazyGoogleClient("oauth", authorize_oauth_client)
+
+
+def preheat_google_clients(include_oauth=False, background=True):
+    """
+    This function will authorize the google clients ahead of their first use,
+    in the background so the auth round trips overlap with the rest of the startup of a job
+    :param include_oauth: whether to also authorize the oauth client
+    :param background: whether to authorize in a daemon thread and return immediately
+    :return: the thread authorizing the clients, or None when not in the background
+    """
+    ls_clients = [gc, gc_oauth] if include_oauth else [gc]
+
+    def preheat():
+        for client in ls_clients:
+            try:
+                client.get()
+                refresh_client_credentials(client.get())
+            except Exception as e:
+                print_logger(f"Error preheating {client!r} because {e}")
+
+    if not background:
+        preheat()
+        return None
+
+    thread = threading.Thread(
+        target=preheat, name="preheat_google_clients", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+thread_local_http = threading.local()
+credentials_refresh_lock = threading.Lock()
+
+
+def refresh_client_credentials(client):
+    """
+    This function will refresh the token of a client once when it is missing or expired,
+    so threads starting together dont each refresh the shared credentials
+    :param client: the pygsheets client
+    :return: None
+    """
+    credentials = client.oauth
+    if credentials.valid:
+        return
+
+    with credentials_refresh_lock:
+        if not credentials.valid:
+            credentials.refresh(google_auth_httplib2.Request(httplib2.Http()))
+
+
+def get_thread_http(client):
+    """
+    This function will return an authorized http object for the current thread, as httplib2 objects
+    cant be shared between threads, the credentials and so their tokens are shared with the client
+    :param client: the pygsheets client, one with a new_thread_http function builds its own
+    :return: an AuthorizedHttp object
+    """
+    if not hasattr(thread_local_http, "dict_http"):
+        thread_local_http.dict_http = {}
+
+    # the client is kept with its http so a new client reusing the id of a dropped one is not given its http
+    client_http = thread_local_http.dict_http.get(id(client))
+    if client_http is None or client_http[0] is not client:
+        if hasattr(client, "new_thread_http"):
+            http = client.new_thread_http()
+        else:
+            http = AuthorizedHttp(client.oauth, http=httplib2.Http())
+        client_http = (client, http)
+        thread_local_http.dict_http[id(client)] = client_http
+    return client_http[1]
+
+
+def execute_sheets_request(client, request):
+    """
+    This function will execute a request built from client.sheet.service on the http of the current thread
+    :param client: the pygsheets client the request was built from
+    :param request: the request to execute
+    :return: the response of the request
+    """
+    if isinstance(client, LazyGoogleClient):
+        client = client.get()
+    refresh_client_credentials(client)
+    request.http = get_thread_http(client)
+    return client.sheet._execute_requests(request)
+
+
+def execute_drive_request(client, request):
+    """
+    This function will execute a request built from client.drive.service on the http of the current thread
+    :param client: the pygsheets client the request was built from
+    :param request: the request to execute
+    :return: the response of the request
+    """
+    if isinstance(client, LazyGoogleClient):
+        client = client.get()
+    refresh_client_credentials(client)
+    request.http = get_thread_http(client)
+    return client.drive._execute_request(request)
+
+
+def get_drive_service(client=gc):
+    """
+    This function will return the drive v3 service of a client, built once with the client
+    instead of once per call
+    :param client: the pygsheets client
+    :return: the googleapiclient drive v3 resource
+    """
+    return client.drive.service
+
+
+# %%
+## Read Cache ##
+
+# sheet reads kept on disk and revalidated against the drive modifiedTime of the spreadsheet, note that
+# formulas like NOW() or IMPORTRANGE can change values without changing modifiedTime
+loc_sheets_read_cache = os.path.join(data_dir, "sheets_read_cache")
+
+read_cache_ttl_seconds = 24 * 60 * 60
+read_cache_max_bytes = 2 * 1024**3
+
+
+def write_frame_file(df, path):
+    """
+    This function will atomically write a dataframe as parquet, or as a pickle when parquet cant hold it
+    like columns mixing numbers and text
+    :param df: the dataframe to write
+    :param path: the path to write to without the extension
+    :return: the path written to including the extension
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    for extension, write_df in [
+        (".parquet", lambda tmp_path: df.to_parquet(tmp_path)),
+        (".pkl", lambda tmp_path: df.to_pickle(tmp_path)),
+    ]:
+        tmp_path = f"{path}{extension}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            write_df(tmp_path)
+        except (ImportError, ValueError, TypeError) as e:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            print_logger(f"Could not write {path} as {extension}, error: {e}")
+            continue
+        os.replace(tmp_path, path + extension)
+        return path + extension
+
+    raise Exception(f"Could not write dataframe to {path}")
+
+
+def read_frame_file(path, columns=None):
+    """
+    This function will read a dataframe written by write_frame_file, parquet is memory mapped
+    :param path: the path including the extension
+    :param columns: list of columns to read, None for every column
+    :return: the dataframe
+    """
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns, memory_map=True)
+    df = pd.read_pickle(path)
+    return df if columns is None else df[columns]
+
+
+def get_drive_file_metadata(file_id, fields="id, name, modifiedTime"):
+    """
+    This function will get the metadata of a drive file in one request
+    :param file_id: the id of the file
+    :param fields: the fields to return
+    :return: dictionary of the metadata
+    """
+    request = (
+        get_drive_service()
+        .files()
+        .get(fileId=file_id, fields=fields, supportsAllDrives=True)
+    )
+    return call_with_retry(
+        f"get metadata of {file_id}", execute_drive_request, gc, request, key=file_id
+    )
+
+
+def get_read_cache_db_connection():
+    os.makedirs(loc_sheets_read_cache, exist_ok=True)
+    con = sqlite3.connect(
+        os.path.join(loc_sheets_read_cache, "index.sqlite"),
+        timeout=60,
+        isolation_level=None,
+    )
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, spreadsheet_id TEXT, spreadsheet_name TEXT, "
+        "sheet_name TEXT, path TEXT, modified_time TEXT, fetched_at REAL, last_access REAL, size_bytes INTEGER)"
+    )
+    return con
+
+
+def evict_read_cache(con, max_bytes=None, ttl_seconds=None):
+    """
+    This function will remove expired entries and the least recently used entries past the size limit
+    :param con: connection to the read cache index
+    :param max_bytes: the size limit of the cache, defaults to read_cache_max_bytes
+    :param ttl_seconds: the age limit of entries, defaults to read_cache_ttl_seconds
+    :return: None
+    """
+    max_bytes = read_cache_max_bytes if max_bytes is None else max_bytes
+    ttl_seconds = read_cache_ttl_seconds if ttl_seconds is None else ttl_seconds
+
+    total_bytes = 0
+    for key, path, size_bytes, fetched_at in con.execute(
+        "SELECT key, path, size_bytes, fetched_at FROM entries ORDER BY last_access DESC"
+    ).fetchall():
+        total_bytes += size_bytes
+        if total_bytes > max_bytes or time.time() - fetched_at > ttl_seconds:
+            con.execute("DELETE FROM entries WHERE key = ?", (key,))
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+def read_sheet_df_cached(
+    spreadsheet_id, sheet_name, read_df, ttl_seconds=None, **read_kwargs
+):
+    """
+    This function will return a sheet read from the read cache if the spreadsheet was not modified since,
+    otherwise it will read it with read_df and cache it
+    :param spreadsheet_id: the id of the google spreadsheet
+    :param sheet_name: the name of the sheet within the google spreadsheet
+    :param read_df: function without arguments that downloads the dataframe
+    :param ttl_seconds: the age after which an entry is downloaded again, defaults to read_cache_ttl_seconds
+    :param read_kwargs: the range and render options of the read, part of the cache key
+    :return: tuple of the dataframe and the name of the spreadsheet
+    """
+    ttl_seconds = read_cache_ttl_seconds if ttl_seconds is None else ttl_seconds
+    key = hashlib.sha1(
+        json.dumps(
+            [spreadsheet_id, sheet_name, read_kwargs], sort_keys=True, default=str
+        ).encode()
+    ).hexdigest()
+
+    # fetched before any download, so a change during the download is caught on the next read
+    dict_metadata = get_drive_file_metadata(spreadsheet_id)
+
+    con = get_read_cache_db_connection()
+    try:
+        row = con.execute(
+            "SELECT path, modified_time, fetched_at FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if (
+            row is not None
+            and row[1] == dict_metadata["modifiedTime"]
+            and time.time() - row[2] < ttl_seconds
+            and os.path.isfile(row[0])
+        ):
+            df = read_frame_file(row[0])
+            con.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            print_logger(
+                f"Using cached read of {spreadsheet_id} : {sheet_name}, unchanged since {dict_metadata['modifiedTime']}"
+            )
+            return df, dict_metadata["name"]
+
+        df = read_df()
+
+        path = write_frame_file(df, os.path.join(loc_sheets_read_cache, key))
+        if row is not None and row[0] != path and os.path.isfile(row[0]):
+            os.remove(row[0])
+        con.execute(
+            "INSERT OR REPLACE INTO entries (key, spreadsheet_id, spreadsheet_name, sheet_name, path, modified_time, fetched_at, last_access, size_bytes) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                spreadsheet_id,
+                dict_metadata["name"],
+                sheet_name,
+                path,
+                dict_metadata["modifiedTime"],
+                time.time(),
+                time.time(),
+                os.path.getsize(path),
+            ),
+        )
+        evict_read_cache(con, ttl_seconds=ttl_seconds)
+        return df, dict_metadata["name"]
+    finally:
+        con.close()
+
+
+# %%
+## Frequently Used Functions ##
+
+loc_sheets_output_cache = os.path.join(data_dir, "sheets_output_cache")
+
+# cache files are written by one background thread in submission order, so the upload starts right away
+# and a later write or removal of the same sheet never lands before an earlier one
+sheets_cache_writer = None
+sheets_cache_writer_lock = threading.Lock()
+dict_pending_cache_writes = {}
+
+
+def get_sheets_cache_path(bookName, sheetName):
+    """
+    This function will return the path of the local copy of the last frame written to a sheet
+    :param bookName: the name of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :return: the path to the cache file without the extension added by write_frame_file
+    """
+    # remove characters that windows cant have from filename
+    sheetName = (
+        sheetName.replace("/", " ")
+        .replace(":", "")
+        .replace("?", "")
+        .replace("&", "and")
+    )
+    return os.path.join(loc_sheets_output_cache, bookName, sheetName + ".done")
+
+
+def get_sheets_cache_file(bookName, sheetName):
+    """
+    This function will find the file of the cached copy of a sheet
+    :param bookName: the name of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :return: the path including the extension, or None if there is no cached copy
+    """
+    cache_path = get_sheets_cache_path(bookName, sheetName)
+    for extension in [".parquet", ".pkl"]:
+        if os.path.isfile(cache_path + extension):
+            return cache_path + extension
+    return None
+
+
+def submit_sheets_cache_job(bookName, sheetName, job):
+    """
+    This function will queue a write or removal of a cached copy on the background writer thread
+    :param bookName: the name of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :param job: function with no arguments doing the write or removal
+    :return: the future of the job
+    """
+    global sheets_cache_writer
+
+    def run_job():
+        try:
+            job()
+        except Exception as e:
+            print_logger(
+                f"Failed to update sheets output cache of {bookName} - {sheetName}, error: {e}"
+            )
+            RemoveSheetsCacheFiles(bookName, sheetName)
+
+    with sheets_cache_writer_lock:
+        if sheets_cache_writer is None:
+            sheets_cache_writer = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="sheets_cache_writer"
+            )
+        future = sheets_cache_writer.submit(run_job)
+        dict_pending_cache_writes[(bookName, sheetName)] = future
+
+    return future
+
+
+def FlushSheetsCache(bookName=None, sheetName=None):
+    """
+    This function will wait for queued cache writes to finish
+    :param bookName: the name of the google spreadsheet, None to wait for every sheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :return: None
+    """
+    with sheets_cache_writer_lock:
+        if bookName is None:
+            ls_futures = list(dict_pending_cache_writes.values())
+        else:
+            ls_futures = [dict_pending_cache_writes.get((bookName, sheetName))]
+
+    for future in ls_futures:
+        if future is not None:
+            future.result()
+
+
+def RemoveSheetsCacheFiles(bookName, sheetName):
+    cache_path = get_sheets_cache_path(bookName, sheetName)
+    # .csv is the format the cache used before parquet
+    for extension in [".parquet", ".pkl", ".csv"]:
+        if os.path.isfile(cache_path + extension):
+            os.remove(cache_path + extension)
+
+
+def WriteToSheetsCache(bookName, sheetName, df, indexes, background=True):
+    """
+    This function will save the frame written to a sheet as parquet with its dtypes, atomically
+    :param bookName: the name of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :param df: the dataframe written to the sheet
+    :param indexes: whether the index column is written to the sheet
+    :param background: whether to write on the background writer thread and return immediately
+    :return: None
+    """
+    cache_path = get_sheets_cache_path(bookName, sheetName)
+    # the caller may change the frame while it is queued
+    df = df.copy()
+    if not indexes:
+        df = df.reset_index(drop=True)
+
+    def write_cache():
+        path = write_frame_file(df, cache_path)
+        for extension in [".parquet", ".pkl", ".csv"]:
+            stale_path = cache_path + extension
+            if stale_path != path and os.path.isfile(stale_path):
+                os.remove(stale_path)
+
+    if background:
+        submit_sheets_cache_job(bookName, sheetName, write_cache)
+    else:
+        FlushSheetsCache(bookName, sheetName)
+        write_cache()
+
+
+def LoadFromSheetsCache(bookName, sheetName, columns=None):
+    """
+    This function will load the last frame written to a sheet with its dtypes, memory mapped where parquet allows,
+    for comparisons and audits of what was sent
+    :param bookName: the name of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :param columns: list of columns to load, None for every column
+    :return: the dataframe, or None if there is no cached copy
+    """
+    FlushSheetsCache(bookName, sheetName)
+
+    cache_file = get_sheets_cache_file(bookName, sheetName)
+    if cache_file is None:
+        return None
+
+    return read_frame_file(cache_file, columns=columns)
+
+
+def ReadFromSheetsCache(bookName, sheetName, indexes=False):
+    """
+    This function will read the last frame written to a sheet back from the local cache as strings
+    :param bookName: the name of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :param indexes: whether the index column was written to the sheet
+    :return: a dataframe of strings, or None if there is no cached copy
+    """
+    df = LoadFromSheetsCache(bookName, sheetName)
+    if df is None:
+        return None
+
+    return get_df_as_sheet_strings(df, indexes)
+
+
+def RemoveFromSheetsCache(bookName, sheetName):
+    """
+    This function will remove the cached copy of a sheet, so the next delta write is a full write
+    :param bookName: the name of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :return: None
+    """
+    submit_sheets_cache_job(
+        bookName, sheetName, lambda: RemoveSheetsCacheFiles(bookName, sheetName)
+    )
+
+
+handle_cache_max_books = 256
+handle_cache_max_sheets = 2048
+handle_cache_ttl_seconds = 3600
+
+
+class HandleCache:
+    """
+    A bounded cache of pygsheets Spreadsheet and Worksheet objects, least recently used entries are dropped past
+    max_entries and entries older than ttl_seconds are fetched again, safe to share between threads,
+    a thread with its own client keeps its own entries with use_thread_entries since handles hold their client
+    """
+
+    def __init__(self, name, max_entries, ttl_seconds=handle_cache_ttl_seconds):
+        """
+        :param name: the name of the cache used in logs and stats
+        :param max_entries: the number of entries kept
+        :param ttl_seconds: the age after which an entry is dropped, None to keep entries until evicted
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._dict_shared_entries = collections.OrderedDict()
+        self._thread_local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def _dict_entries(self):
+        return getattr(self._thread_local, "dict_entries", self._dict_shared_entries)
+
+    def use_thread_entries(self):
+        """
+        This function will give the current thread entries of its own from then on, empty at first
+        :return: None
+        """
+        self._thread_local.dict_entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        This function will return a cached entry and count the lookup as a hit or a miss
+        :param key: the key of the entry
+        :param default: the value returned on a miss
+        :return: the entry or default
+        """
+        with self._lock:
+            entry = self._dict_entries.get(key)
+            if entry is not None and (
+                self.ttl_seconds is None or time.time() - entry[1] <= self.ttl_seconds
+            ):
+                self._dict_entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if entry is not None:
+                del self._dict_entries[key]
+            self.misses += 1
+            return default
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._dict_entries[key] = (value, time.time())
+            self._dict_entries.move_to_end(key)
+            while len(self._dict_entries) > self.max_entries:
+                self._dict_entries.popitem(last=False)
+                self.evictions += 1
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._dict_entries.get(key)
+            return entry is not None and (
+                self.ttl_seconds is None or time.time() - entry[1] <= self.ttl_seconds
+            )
+
+    def __len__(self):
+        with self._lock:
+            return len(self._dict_entries)
+
+    def keys(self):
+        with self._lock:
+            return list(self._dict_entries.keys())
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._dict_entries.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def pop_where(self, match):
+        """
+        This function will drop every entry whose key matches
+        :param match: function called with a key returning whether to drop the entry
+        :return: the number of entries dropped
+        """
+        with self._lock:
+            ls_keys = [key for key in self._dict_entries.keys() if match(key)]
+            for key in ls_keys:
+                del self._dict_entries[key]
+            return len(ls_keys)
+
+    def clear(self):
+        with self._lock:
+            self._dict_entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "entries": len(self._dict_entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+# books are keyed by spreadsheet id, sheets by "{spreadsheet id} : {sheet name}",
+# lookups by book name resolve the id first so both share one entry
+dict_connected_books = HandleCache("books", handle_cache_max_books)
+dict_connected_sheets = HandleCache("sheets", handle_cache_max_sheets)
+dict_book_name_ids = HandleCache("book names", handle_cache_max_books, ttl_seconds=None)
+
+
+def get_sheet_handle_key(id, sheetName):
+    return f"{id} : {sheetName}"
+
+
+def get_handle_cache_stats():
+    """
+    This function will return the hit and miss counters of the handle caches
+    :return: dictionary of cache name to its stats
+    """
+    return {
+        cache.name: cache.get_stats()
+        for cache in [dict_connected_books, dict_connected_sheets, dict_book_name_ids]
+    }
+
+
+def invalidate_spreadsheet_handles(id):
+    """
+    This function will drop the cached book and every cached sheet of a spreadsheet
+    :param id: the id of the google spreadsheet
+    :return: None
+    """
+    dict_connected_books.pop(id)
+    dict_connected_sheets.pop_where(lambda key: key.startswith(f"{id} : "))
+
+
+def invalidate_stale_handles(e, id, sheetName=None):
+    """
+    This function will drop cached handles an error shows to be stale, a missing tab drops the sheet,
+    a 404 or a 400 about a tab id or range that no longer exists drops the book and its sheets
+    :param e: the exception raised by a call using the handles
+    :param id: the id of the google spreadsheet
+    :param sheetName: the name of the sheet the call used
+    :return: None
+    """
+    if id is None:
+        return
+    e = get_root_error(e)
+    if isinstance(e, pygsheets.WorksheetNotFound) and sheetName is not None:
+        dict_connected_sheets.pop(get_sheet_handle_key(id, sheetName))
+    elif classify_google_error(e) == "not_found":
+        invalidate_spreadsheet_handles(id)
+
+
+def get_book_from_id(id, retry=True):
+    Workbook = dict_connected_books.get(id)
+    if Workbook is not None:
+        return Workbook
+
+    book_from_id = call_with_retry(
+        f"open connection to {id}",
+        gc.open_by_key,
+        id,
+        key=id,
+        policy=None if retry else {"max_attempts": 1},
+        on_error=lambda e: invalidate_stale_handles(e, id),
+    )
+    dict_connected_books[id] = book_from_id
+    print_logger(f"Opening new connection to {id}")
+    return book_from_id
+
+
+dict_hardcoded_book_ids = {}
+hardcoded_book_ids_loaded = False
+hardcoded_book_ids_lock = threading.Lock()
+
+
+def get_hardcoded_book_ids():
+    """
+    This function will load google_sheet_ids.json on first use instead of at import
+    :return: dictionary of book name to spreadsheet id
+    """
+    global hardcoded_book_ids_loaded
+
+    if not hardcoded_book_ids_loaded:
+        with hardcoded_book_ids_lock:
+            if not hardcoded_book_ids_loaded:
+                with open(os.path.join(file_dir, "google_sheet_ids.json")) as f:
+                    dict_hardcoded_book_ids.update(json.load(f))
+                hardcoded_book_ids_loaded = True
+    return dict_hardcoded_book_ids
+
+
+loc_spreadsheet_name_index = os.path.join(data_dir, "spreadsheet_name_index.json")
+# a name missing from the index triggers an incremental refresh at most this often
+spreadsheet_name_index_min_refresh_seconds = 60
+drive_spreadsheet_mime_type = "application/vnd.google-apps.spreadsheet"
+
+dict_spreadsheet_name_index = {}
+spreadsheet_name_index_lock = threading.RLock()
+
+
+def read_spreadsheet_name_index_file():
+    """
+    This function will read the spreadsheet name index saved on disk
+    :return: the index, None if there is no readable file
+    """
+    if not os.path.isfile(loc_spreadsheet_name_index):
+        return None
+    try:
+        with open(loc_spreadsheet_name_index) as f:
+            return json.load(f)
+    except ValueError as e:
+        print_logger(f"Ignoring unreadable spreadsheet name index: {e}")
+        return None
+
+
+def load_spreadsheet_name_index():
+    """
+    This function will load the spreadsheet name index from disk on first use
+    :return: the index, a dictionary with "files" of id to {"name", "modifiedTime"},
+        "last_modified_time" of the newest file seen and "refreshed_at"
+    """
+    with spreadsheet_name_index_lock:
+        if not dict_spreadsheet_name_index:
+            dict_spreadsheet_name_index.update(
+                {"files": {}, "last_modified_time": None, "refreshed_at": 0}
+            )
+            dict_spreadsheet_name_index.update(read_spreadsheet_name_index_file() or {})
+        return dict_spreadsheet_name_index
+
+
+def save_spreadsheet_name_index(dict_file_changes, replace=False):
+    """
+    This function will apply changes to the spreadsheet name index and save it, the changes are merged into the index
+    on disk so the entries other processes saved since it was loaded are kept instead of the last writer winning
+    :param dict_file_changes: dictionary of id to its {"name", "modifiedTime"} entry, None to drop the id
+    :param replace: whether the changes replace every entry of the index, for a full refresh
+    :return: None
+    """
+    with spreadsheet_name_index_lock:
+        dict_index = load_spreadsheet_name_index()
+        dict_saved = read_spreadsheet_name_index_file()
+        if dict_saved is not None:
+            if not replace:
+                dict_index["files"] = dict_saved.get("files", {})
+            ls_modified_times = [
+                modified_time
+                for modified_time in [
+                    dict_index["last_modified_time"],
+                    dict_saved.get("last_modified_time"),
+                ]
+                if modified_time is not None
+            ]
+            dict_index["last_modified_time"] = (
+                max(ls_modified_times) if ls_modified_times else None
+            )
+            dict_index["refreshed_at"] = max(
+                dict_index["refreshed_at"], dict_saved.get("refreshed_at", 0)
+            )
+        if replace:
+            dict_index["files"] = {}
+        for id, dict_file in dict_file_changes.items():
+            if dict_file is None:
+                dict_index["files"].pop(id, None)
+            else:
+                dict_index["files"][id] = dict_file
+
+        os.makedirs(os.path.dirname(loc_spreadsheet_name_index), exist_ok=True)
+        tmp_path = f"{loc_spreadsheet_name_index}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dict_index, f)
+        os.replace(tmp_path, loc_spreadsheet_name_index)
+
+
+def refresh_spreadsheet_name_index(full=False):
+    """
+    This function will update the spreadsheet name index from drive, a full refresh lists every spreadsheet the
+    service account can see, otherwise only spreadsheets modified since the last refresh are listed
+    :param full: whether to rebuild the index from scratch
+    :return: the number of spreadsheets listed
+    """
+    with spreadsheet_name_index_lock:
+        dict_index = load_spreadsheet_name_index()
+        refreshed_at = time.time()
+
+        q = f"mimeType='{drive_spreadsheet_mime_type}'"
+        is_full = full or dict_index["last_modified_time"] is None
+        if is_full:
+            q += " and trashed=false"
+        else:
+            # trashed files are listed too so they are dropped from the index
+            q += f" and modifiedTime > '{dict_index['last_modified_time']}'"
+
+        ls_files = list_drive_files(q, fields="id, name, modifiedTime, trashed")
+        dict_file_changes = {}
+        if is_full:
+            dict_index["last_modified_time"] = None
+        for file in ls_files:
+            if file.get("trashed"):
+                dict_file_changes[file["id"]] = None
+            else:
+                dict_file_changes[file["id"]] = {
+                    "name": file["name"],
+                    "modifiedTime": file["modifiedTime"],
+                }
+            if (
+                dict_index["last_modified_time"] is None
+                or file["modifiedTime"] > dict_index["last_modified_time"]
+            ):
+                dict_index["last_modified_time"] = file["modifiedTime"]
+
+        dict_index["refreshed_at"] = refreshed_at
+        save_spreadsheet_name_index(dict_file_changes, replace=is_full)
+
+    print_logger(f"Refreshed spreadsheet name index with {len(ls_files)} spreadsheets")
+    return len(ls_files)
+
+
+def get_spreadsheet_ids_by_name(bookName, refresh=True):
+    """
+    This function will look up the ids of the spreadsheets with a name in the spreadsheet name index,
+    refreshing the index when the name is missing
+    :param bookName: the name of the google spreadsheet
+    :param refresh: whether to refresh the index when the name is missing
+    :return: list of ids, the most recently modified first
+    """
+
+    def lookup():
+        dict_files = load_spreadsheet_name_index()["files"]
+        ls_matches = [
+            (dict_file["modifiedTime"], id)
+            for id, dict_file in dict_files.items()
+            if dict_file["name"] == bookName
+        ]
+        return [id for _, id in sorted(ls_matches, reverse=True)]
+
+    with spreadsheet_name_index_lock:
+        ls_ids = lookup()
+        dict_index = load_spreadsheet_name_index()
+        if (
+            not ls_ids
+            and refresh
+            and time.time() - dict_index["refreshed_at"]
+            > spreadsheet_name_index_min_refresh_seconds
+        ):
+            refresh_spreadsheet_name_index()
+            ls_ids = lookup()
+
+    return ls_ids
+
+
+def get_duplicate_spreadsheet_names():
+    """
+    This function will find names shared by several spreadsheets in the spreadsheet name index,
+    opening those by name is ambiguous
+    :return: dictionary of name to list of ids
+    """
+    dict_name_ids = {}
+    for id, dict_file in load_spreadsheet_name_index()["files"].items():
+        dict_name_ids.setdefault(dict_file["name"], []).append(id)
+    return {name: ls_ids for name, ls_ids in dict_name_ids.items() if len(ls_ids) > 1}
+
+
+def forget_spreadsheet_name(bookName, id):
+    """
+    This function will drop a spreadsheet found to be deleted or renamed from the name lookups
+    :param bookName: the name it was looked up by
+    :param id: the id of the google spreadsheet
+    :return: None
+    """
+    dict_book_name_ids.pop(bookName, None)
+    invalidate_spreadsheet_handles(id)
+    with spreadsheet_name_index_lock:
+        if id in load_spreadsheet_name_index()["files"]:
+            save_spreadsheet_name_index({id: None})
+
+
+def get_book(bookName, retry=True):
+    if bookName in get_hardcoded_book_ids().keys():
+        return get_book_from_id(get_hardcoded_book_ids()[bookName], retry=retry)
+
+    id = dict_book_name_ids.get(bookName)
+    if id is not None:
+        ls_ids = [id]
+    else:
+        ls_ids = get_spreadsheet_ids_by_name(bookName)
+        if len(ls_ids) > 1:
+            print_logger(
+                f"Found {len(ls_ids)} spreadsheets named {bookName}: {ls_ids}, using the most recently modified {ls_ids[0]}"
+            )
+
+    if ls_ids:
+        try:
+            Workbook = get_book_from_id(ls_ids[0], retry=retry)
+        except Exception as e:
+            if classify_google_error(get_root_error(e)) != "not_found":
+                raise
+            Workbook = None
+        if Workbook is not None and Workbook.title == bookName:
+            dict_book_name_ids[bookName] = ls_ids[0]
+            return Workbook
+
+        # the index is refreshed at most once a minute, so the book may have been deleted or renamed since
+        print_logger(
+            f"Book {ls_ids[0]} named {bookName} in the name index was deleted or renamed, looking it up in drive"
+        )
+        forget_spreadsheet_name(bookName, ls_ids[0])
+    else:
+        print_logger(
+            f"Book {bookName} not in hardcoded book ids or the name index, opening new connection by name"
+        )
+    Workbook = call_with_retry(
+        f"open connection to {bookName}",
+        gc.open,
+        bookName,
+        key=bookName,
+        policy=None if retry else {"max_attempts": 1},
+    )
+
+    # the time it was opened ranks it first among books of the same name, reading Workbook.updated would cost a drive
+    # request, and the next refresh of the index brings the modified time of drive
+    save_spreadsheet_name_index(
+        {
+            Workbook.id: {
+                "name": bookName,
+                "modifiedTime": datetime.datetime.now(datetime.timezone.utc).strftime(
+                    "%Y-%m-%dT%H:%M:%S.%fZ"
+                ),
+            }
+        }
+    )
+
+    dict_book_name_ids[bookName] = Workbook.id
+    dict_connected_books[Workbook.id] = Workbook
+    return Workbook
+
+
+def get_book_sheet(bookName, sheetName):
+    """
+    This function will return a Worksheet object from a google sheet using the ss name and the sheet name, will return a cached connection if it exists
+    :param bookName: the name of the google sheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :return: a Worksheet object
+    """
+    return get_book_sheet_from_id_name(get_book(bookName).id, sheetName)
+
+
+def get_book_sheet_df(
+    bookName,
+    sheetName,
+    start=None,
+    end=None,
+    index_column=None,
+    value_render="FORMATTED_VALUE",
+    numerize=True,
+    script_path="",
+    function_name="",
+    use_cache=False,
+    cache_ttl_seconds=None,
+    typed=False,
+    dict_schema=None,
+):
+    """
+    This function will read a sheet of a google sheet into a dataframe
+    :param bookName: the name of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :param use_cache: whether to serve the read from the read cache when the spreadsheet was not modified since,
+        costs one drive metadata request instead of downloading the sheet
+    :param cache_ttl_seconds: the age after which a cached read is downloaded again, defaults to read_cache_ttl_seconds
+    :param typed: whether to read unformatted values with serial number dates and convert columns in one vectorized step
+        instead of parsing formatted strings, replaces value_render and numerize
+    :param dict_schema: dict of column name to dtype for convert_df_to_schema when typed
+    :return: a dataframe
+    """
+    if typed:
+        value_render = "UNFORMATTED_VALUE"
+        numerize = False
+
+    def read_df():
+        worksheet = get_book_sheet(bookName, sheetName)
+        df = call_with_retry(
+            f"read {bookName} : {sheetName}",
+            worksheet.get_as_df,
+            key=worksheet.spreadsheet.id,
+            start=start,
+            end=end,
+            index_column=index_column,
+            value_render=value_render,
+            numerize=numerize,
+        )
+        if typed:
+            df = convert_df_to_schema(df, dict_schema)
+        return df
+
+    if use_cache:
+        # a hardcoded id lets a cache hit skip opening the book
+        spreadsheet_id = get_hardcoded_book_ids().get(bookName) or get_book(bookName).id
+        df, _ = read_sheet_df_cached(
+            spreadsheet_id,
+            sheetName,
+            read_df,
+            ttl_seconds=cache_ttl_seconds,
+            start=start,
+            end=end,
+            index_column=index_column,
+            value_render=value_render,
+            numerize=numerize,
+            typed=typed,
+            dict_schema=dict_schema,
+        )
+    else:
+        spreadsheet_id = get_book(bookName).id
+        df = read_df()
+
+    log_data_pipeline(
+        script_path=script_path,
+        function_name=function_name,
+        input_output="input",
+        resource_type="google_sheet",
+        spreadsheet_id=spreadsheet_id,
+        spreadsheet_name=bookName,
+        sheet_name=sheetName,
+        domo_table_name="",
+        domo_table_id="",
+        file_path="",
+    )
+
+    return df
+
+
+def get_book_sheet_from_id_name(id, sheetName):
+    """
+    This function will return a Worksheet object from a google sheet using the spreadsheet id and the sheet name, will return a cached connection if it exists
+    :param id: the id of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :return: a Worksheet object
+    """
+    Worksheet = dict_connected_sheets.get(get_sheet_handle_key(id, sheetName))
+    if Worksheet is not None:
+        return Worksheet
+
+    Workbook = get_book_from_id(id)
+    Worksheet = call_with_retry(
+        f"open connection to {id} : {sheetName}",
+        Workbook.worksheet_by_title,
+        sheetName,
+        key=id,
+        on_error=lambda e: invalidate_stale_handles(e, id, sheetName),
+    )
+    dict_connected_sheets[get_sheet_handle_key(id, sheetName)] = Worksheet
+    print_logger(f"Opening new connection to {id} : {sheetName}")
+    return Worksheet
+
+
+def get_book_sheet_df_from_id_name(
+    id,
+    sheetName,
+    start=None,
+    end=None,
+    index_column=None,
+    value_render="FORMATTED_VALUE",
+    numerize=True,
+    script_path="",
+    function_name="",
+    use_cache=False,
+    cache_ttl_seconds=None,
+    typed=False,
+    dict_schema=None,
+):
+    """
+    This function will read a sheet of a google sheet into a dataframe
+    :param id: the id of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :param use_cache: whether to serve the read from the read cache when the spreadsheet was not modified since,
+        costs one drive metadata request instead of downloading the sheet
+    :param cache_ttl_seconds: the age after which a cached read is downloaded again, defaults to read_cache_ttl_seconds
+    :param typed: whether to read unformatted values with serial number dates and convert columns in one vectorized step
+        instead of parsing formatted strings, replaces value_render and numerize
+    :param dict_schema: dict of column name to dtype for convert_df_to_schema when typed
+    :return: a dataframe
+    """
+    if typed:
+        value_render = "UNFORMATTED_VALUE"
+        numerize = False
+
+    def read_df():
+        worksheet = get_book_sheet_from_id_name(id, sheetName)
+        df = call_with_retry(
+            f"read {id} : {sheetName}",
+            worksheet.get_as_df,
+            key=id,
+            start=start,
+            end=end,
+            index_column=index_column,
+            value_render=value_render,
+            numerize=numerize,
+        )
+        if typed:
+            df = convert_df_to_schema(df, dict_schema)
+        return df
+
+    if use_cache:
+        df, spreadsheet_name = read_sheet_df_cached(
+            id,
+            sheetName,
+            read_df,
+            ttl_seconds=cache_ttl_seconds,
+            start=start,
+            end=end,
+            index_column=index_column,
+            value_render=value_render,
+            numerize=numerize,
+            typed=typed,
+            dict_schema=dict_schema,
+        )
+    else:
+        spreadsheet_name = get_book_from_id(id).title
+        df = read_df()
+
+    log_data_pipeline(
+        script_path=script_path,
+        function_name=function_name,
+        input_output="input",
+        resource_type="google_sheet",
+        spreadsheet_id=id,
+        spreadsheet_name=spreadsheet_name,
+        sheet_name=sheetName,
+        domo_table_name="",
+        domo_table_id="",
+        file_path="",
+    )
+
+    return df
+
+
+def quote_sheet_name(sheetName):
+    """
+    This function will quote a sheet name for a range in A1 notation, quotes in the name are doubled
+    :param sheetName: the name of the sheet
+    :return: the quoted name like 'Bob''s'
+    """
+    return "'" + sheetName.replace("'", "''") + "'"
+
+
+def values_batch_update(Workbook, ls_data, parse=True):
+    """
+    This function will write several ranges of a spreadsheet in a single values.batchUpdate request
+    :param Workbook: the Spreadsheet object to write to
+    :param ls_data: list of dicts with "range" in A1 notation and "values" as a list of rows
+    :param parse: whether the values are parsed as if typed by a user, otherwise stored as is
+    :return: the response of the request
+    """
+    for data in ls_data:
+        data.setdefault("majorDimension", "ROWS")
+
+    request = (
+        Workbook.client.sheet.service.spreadsheets()
+        .values()
+        .batchUpdate(
+            spreadsheetId=Workbook.id,
+            body={
+                "valueInputOption": "USER_ENTERED" if parse else "RAW",
+                "data": ls_data,
+            },
+        )
+    )
+    return execute_sheets_request(Workbook.client, request)
+
+
+def spreadsheets_batch_update(Workbook, ls_requests):
+    """
+    This function will send a spreadsheets.batchUpdate on the http of the current thread, so it can run from worker threads
+    :param Workbook: the Spreadsheet object to update
+    :param ls_requests: list of batchUpdate request dictionaries
+    :return: the response of the request
+    """
+    request = Workbook.client.sheet.service.spreadsheets().batchUpdate(
+        spreadsheetId=Workbook.id, body={"requests": ls_requests}
+    )
+    return execute_sheets_request(Workbook.client, request)
+
+
+def get_df_as_sheet_strings(df, indexes):
+    """
+    This function will render a dataframe as the strings the sheets output cache stores, so it can be compared to a cached copy
+    :param df: the dataframe to render
+    :param indexes: whether the index column is written to the sheet
+    :return: a dataframe of strings with nan as ""
+    """
+    return pd.read_csv(
+        io.StringIO(df.to_csv(index=indexes)), dtype=str, keep_default_na=False
+    )
+
+
+def get_changed_ranges(df_old, df_new):
+    """
+    This function will compare two frames of the same shape cell by cell and return the changed cells as rectangles
+    :param df_old: the frame that is currently on the sheet
+    :param df_new: the frame that should be on the sheet
+    :return: list of (first_row, last_row, first_col, last_col) tuples, zero based and inclusive, over the data rows
+    """
+    mask = df_old.to_numpy() != df_new.to_numpy()
+
+    ls_ranges = []
+    ls_changed_rows = np.flatnonzero(mask.any(axis=1))
+    if len(ls_changed_rows) == 0:
+        return ls_ranges
+
+    # split the changed rows into runs of consecutive rows, then each run into runs of changed columns
+    for row_run in np.split(
+        ls_changed_rows, np.flatnonzero(np.diff(ls_changed_rows) != 1) + 1
+    ):
+        ls_changed_cols = np.flatnonzero(mask[row_run[0] : row_run[-1] + 1].any(axis=0))
+        for col_run in np.split(
+            ls_changed_cols, np.flatnonzero(np.diff(ls_changed_cols) != 1) + 1
+        ):
+            ls_ranges.append(
+                (int(row_run[0]), int(row_run[-1]), int(col_run[0]), int(col_run[-1]))
+            )
+
+    return ls_ranges
+
+
+def get_sheets_cache_delta(bookName, sheetName, df, indexes, max_changed_ratio=0.5):
+    """
+    This function will compare a dataframe to the cached copy of the last frame written to the sheet
+    :param bookName: the name of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :param df: the dataframe to write to the sheet
+    :param indexes: whether the index column is written to the sheet
+    :param max_changed_ratio: above this share of changed cells a full write is used instead
+    :return: tuple of (df_new, ls_ranges), df_new as strings and ls_ranges None when a full write is needed
+    """
+    df_new = get_df_as_sheet_strings(df, indexes)
+    df_old = ReadFromSheetsCache(bookName, sheetName, indexes=indexes)
+
+    if df_old is None:
+        print_logger(f"No cached copy of {bookName} - {sheetName}, writing in full")
+        return df_new, None
+
+    if df_old.shape != df_new.shape or list(df_old.columns) != list(df_new.columns):
+        print_logger(
+            f"Shape or header of {bookName} - {sheetName} changed from {df_old.shape} to {df_new.shape}, writing in full"
+        )
+        return df_new, None
+
+    ls_ranges = get_changed_ranges(df_old, df_new)
+    num_changed_cells = sum(
+        (last_row - first_row + 1) * (last_col - first_col + 1)
+        for first_row, last_row, first_col, last_col in ls_ranges
+    )
+    if num_changed_cells > max_changed_ratio * df_new.size:
+        print_logger(
+            f"{num_changed_cells} of {df_new.size} cells changed in {bookName} - {sheetName}, writing in full"
+        )
+        return df_new, None
+
+    print_logger(
+        f"{num_changed_cells} of {df_new.size} cells changed in {bookName} - {sheetName} across {len(ls_ranges)} ranges"
+    )
+    return df_new, ls_ranges
+
+
+def write_delta_to_sheet_obj(Workbook, sheet_obj, df, ls_ranges, indexes=False):
+    """
+    This function will write only the changed ranges of a frame to a sheet in a single batched request,
+    with the values of get_df_upload_columns like a full write
+    :param Workbook: the Spreadsheet object the sheet belongs to
+    :param sheet_obj: the sheet object to write to
+    :param df: the dataframe being written
+    :param ls_ranges: the changed ranges from get_sheets_cache_delta
+    :param indexes: whether the index columns are written to the sheet
+    :return: None
+    """
+    sheet_title = quote_sheet_name(sheet_obj.title)
+    _, ls_columns, _, _ = get_df_upload_columns(df, indexes=indexes)
+
+    ls_data = []
+    for first_row, last_row, first_col, last_col in ls_ranges:
+        # data rows start below the header row
+        start_label = format_addr((first_row + 2, first_col + 1), output="label")
+        end_label = format_addr((last_row + 2, last_col + 1), output="label")
+        ls_data.append(
+            {
+                "range": f"{sheet_title}!{start_label}:{end_label}",
+                "values": [
+                    [ls_columns[col][row] for col in range(first_col, last_col + 1)]
+                    for row in range(first_row, last_row + 1)
+                ],
+            }
+        )
+
+    values_batch_update(Workbook, ls_data)
+
+
+# frames with at least this many cells are written in chunks by WriteToSheets
+chunked_write_min_cells = 200_000
+
+
+def get_resize_sheet_request(sheet_id, num_rows, num_cols):
+    """
+    This function will return a batchUpdate request setting the grid size of a sheet
+    :param sheet_id: the id of the sheet within the spreadsheet
+    :param num_rows: the number of rows
+    :param num_cols: the number of columns
+    :return: the request as a dictionary
+    """
+    return {
+        "updateSheetProperties": {
+            "properties": {
+                "sheetId": sheet_id,
+                "gridProperties": {
+                    "rowCount": max(num_rows, 1),
+                    "columnCount": max(num_cols, 1),
+                },
+            },
+            "fields": "gridProperties.rowCount,gridProperties.columnCount",
+        }
+    }
+
+
+def get_row_chunks(ls_row_json, max_chunk_bytes):
+    """
+    This function will split rows into consecutive blocks of at most max_chunk_bytes of json payload
+    :param ls_row_json: list of rows encoded by get_df_values_json_rows
+    :param max_chunk_bytes: the payload size limit of a block, a single larger row is its own block
+    :return: list of (first_row, last_row) tuples, zero based and exclusive at the end
+    """
+    ls_chunks = []
+    first_row = 0
+    chunk_bytes = 0
+    for row_num, row_json in enumerate(ls_row_json):
+        # plus the comma joining it to the next row
+        row_bytes = len(row_json) + 1
+        if chunk_bytes + row_bytes > max_chunk_bytes and row_num > first_row:
+            ls_chunks.append((first_row, row_num))
+            first_row = row_num
+            chunk_bytes = 0
+        chunk_bytes += row_bytes
+    if first_row < len(ls_row_json):
+        ls_chunks.append((first_row, len(ls_row_json)))
+    return ls_chunks
+
+
+def write_df_to_sheet_obj_in_chunks(
+    Workbook,
+    sheet_obj,
+    ls_row_json,
+    num_cols,
+    ls_chunks,
+    set_committed_chunks,
+    max_workers=1,
+    progress_callback=None,
+    dict_date_formats=None,
+):
+    """
+    This function will resize a sheet to fit the values and upload them in row blocks, skipping blocks already
+    committed by an earlier attempt so a retry resumes where it failed
+    :param Workbook: the Spreadsheet object the sheet belongs to
+    :param sheet_obj: the sheet object to write to
+    :param ls_row_json: the rows to write starting at A1 encoded by get_df_values_json_rows, header included
+    :param num_cols: the number of columns of the rows
+    :param ls_chunks: the row blocks from get_row_chunks
+    :param set_committed_chunks: set of the indexes of uploaded blocks, updated as blocks are committed
+    :param max_workers: the number of blocks uploaded at the same time
+    :param progress_callback: function called with the number of committed blocks and the number of blocks
+    :param dict_date_formats: the date formats from get_df_values_json_rows, set with the resize
+    :return: None
+    """
+    call_with_retry(
+        f"resize {Workbook.title} : {sheet_obj.title}",
+        Workbook.client.sheet.batch_update,
+        Workbook.id,
+        [get_resize_sheet_request(sheet_obj.id, len(ls_row_json), num_cols)]
+        + get_date_format_requests(
+            sheet_obj.id, dict_date_formats or {}, 1, len(ls_row_json)
+        ),
+        key=Workbook.id,
+    )
+
+    sheet_title = quote_sheet_name(sheet_obj.title)
+    progress_lock = threading.Lock()
+
+    def upload_chunk(chunk_num):
+        first_row, last_row = ls_chunks[chunk_num]
+
+        def upload_attempt():
+            request = (
+                Workbook.client.sheet.service.spreadsheets()
+                .values()
+                .update(
+                    spreadsheetId=Workbook.id,
+                    range=f"{sheet_title}!A{first_row + 1}",
+                    valueInputOption="USER_ENTERED",
+                    body={},
+                )
+            )
+            set_request_body(request, get_values_body(ls_row_json[first_row:last_row]))
+            return execute_sheets_request(Workbook.client, request)
+
+        call_with_retry(
+            f"upload rows {first_row + 1} to {last_row} of {Workbook.title} : {sheet_obj.title}",
+            upload_attempt,
+            key=Workbook.id,
+        )
+
+        with progress_lock:
+            set_committed_chunks.add(chunk_num)
+            print_logger(
+                f"Uploaded rows {first_row + 1} to {last_row} of {len(ls_row_json)}, {len(set_committed_chunks)} of {len(ls_chunks)} blocks committed"
+            )
+            if progress_callback is not None:
+                progress_callback(len(set_committed_chunks), len(ls_chunks))
+
+    ls_pending_chunks = [
+        chunk_num
+        for chunk_num in range(len(ls_chunks))
+        if chunk_num not in set_committed_chunks
+    ]
+    if len(ls_pending_chunks) < len(ls_chunks):
+        print_logger(
+            f"Resuming upload with {len(ls_pending_chunks)} of {len(ls_chunks)} blocks left"
+        )
+
+    if max_workers <= 1:
+        for chunk_num in ls_pending_chunks:
+            upload_chunk(chunk_num)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # list() raises the first failed upload, the committed blocks stay in set_committed_chunks
+            list(executor.map(upload_chunk, ls_pending_chunks))
+
+
+def get_note_request(sheet_id, note):
+    """
+    This function will return a batchUpdate request setting the note of the top left cell of a sheet
+    :param sheet_id: the id of the sheet within the spreadsheet
+    :param note: the note text
+    :return: the request as a dictionary
+    """
+    return {
+        "updateCells": {
+            "range": {
+                "sheetId": sheet_id,
+                "startRowIndex": 0,
+                "endRowIndex": 1,
+                "startColumnIndex": 0,
+                "endColumnIndex": 1,
+            },
+            "rows": [{"values": [{"note": note}]}],
+            "fields": "note",
+        }
+    }
+
+
+# built once, json.dumps builds an encoder on every call when given options
+sheets_json_encoder = json.JSONEncoder(separators=(",", ":"), allow_nan=False)
+dumps_sheets_json = sheets_json_encoder.encode
+
+
+def set_request_body(request, body):
+    """
+    This function will replace the body of a built request with json encoded ahead of time, so a large payload is
+    not built as nested python objects and encoded again by googleapiclient
+    :param request: the HttpRequest built with a placeholder body
+    :param body: the encoded json body
+    :return: the request
+    """
+    request.body = body
+    # the content-length header is taken from body_size when the request is sent
+    request.body_size = len(body)
+    return request
+
+
+def get_df_upload_columns(df, indexes=False, nan=""):
+    """
+    This function will convert a dataframe column by column into the values of a sheets upload, missing values become
+    nan, numbers and booleans keep their type, date columns become the serial numbers sheets stores dates as and
+    everything else is text, like set_dataframe without its loops over the cells
+    :param df: the dataframe to convert
+    :param indexes: whether to include the index columns
+    :param nan: the value of missing cells
+    :return: tuple of the header as a list, the columns as lists of values, the kind of each column as "number", "bool",
+        "date" or "text" and dictionary of the position of each date column to its numberFormat
+    """
+    df_values = df.reset_index() if indexes else df
+
+    ls_head = [str(col) for col in df_values.columns]
+    if indexes:
+        ls_head[: df.index.nlevels] = [
+            "" if name is None else str(name) for name in df.index.names
+        ]
+
+    ls_columns = []
+    ls_kinds = []
+    dict_date_formats = {}
+    for col_num in range(df_values.shape[1]):
+        ser = df_values.iloc[:, col_num]
+        if ser.dtype == object:
+            # object columns holding only numbers, booleans or dates are sent as such
+            inferred_type = pd.api.types.infer_dtype(ser, skipna=True)
+            if inferred_type in ["integer", "floating", "mixed-integer-float"]:
+                ser = pd.to_numeric(ser)
+            elif inferred_type == "boolean":
+                ser = ser.astype("boolean")
+            elif inferred_type in ["datetime", "datetime64", "date"]:
+                ser = pd.to_datetime(ser)
+
+        is_missing = ser.isna().to_numpy()
+        if pd.api.types.is_bool_dtype(ser):
+            kind = "bool"
+            arr_values = ser.to_numpy(dtype=object)
+        elif pd.api.types.is_datetime64_any_dtype(ser):
+            kind = "date"
+            if getattr(ser.dt, "tz", None) is not None:
+                ser = ser.dt.tz_localize(None)
+            is_date = (ser.dropna() == ser.dropna().dt.normalize()).all()
+            dict_date_formats[col_num] = (
+                {"type": "DATE", "pattern": "yyyy-mm-dd"}
+                if is_date
+                else {"type": "DATE_TIME", "pattern": "yyyy-mm-dd hh:mm:ss"}
+            )
+            arr_values = (
+                ((ser - sheets_serial_epoch) / pd.Timedelta(days=1))
+                .to_numpy(dtype=float, na_value=np.nan)
+                .astype(object)
+            )
+        elif pd.api.types.is_float_dtype(ser):
+            kind = "number"
+            arr_floats = ser.to_numpy(dtype=float, na_value=np.nan)
+            # infinity has no json or sheets value either
+            is_missing = ~np.isfinite(arr_floats)
+            arr_values = arr_floats.astype(object)
+        elif pd.api.types.is_numeric_dtype(ser):
+            kind = "number"
+            arr_values = ser.to_numpy(dtype=object)
+        else:
+            kind = "text"
+            arr_values = ser.astype(str).to_numpy(dtype=object)
+
+        if is_missing.any():
+            arr_values = arr_values.copy()
+            arr_values[is_missing] = nan
+        ls_columns.append(arr_values.tolist())
+        ls_kinds.append(kind)
+
+    return ls_head, ls_columns, ls_kinds, dict_date_formats
+
+
+def get_df_values_json_rows(df, indexes=False, nan="", include_head=True):
+    """
+    This function will encode a dataframe as the json rows of a values upload, ready to be joined into a request body
+    :param df: the dataframe to encode
+    :param indexes: whether to include the index columns
+    :param nan: the value of missing cells
+    :param include_head: whether the first row is the header
+    :return: tuple of the list of encoded rows, the number of columns and the date formats of get_df_upload_columns
+    """
+    ls_head, ls_columns, _, dict_date_formats = get_df_upload_columns(
+        df, indexes=indexes, nan=nan
+    )
+    ls_rows = [dumps_sheets_json(list(row)) for row in zip(*ls_columns)]
+    if include_head:
+        ls_rows.insert(0, dumps_sheets_json(ls_head))
+    return ls_rows, len(ls_head), dict_date_formats
+
+
+def get_values_body(ls_row_json):
+    return '{"majorDimension":"ROWS","values":[' + ",".join(ls_row_json) + "]}"
+
+
+def get_cell_data_column_json(ls_values, kind):
+    """
+    This function will encode a column from get_df_upload_columns as the json CellData of updateCells, numbers, booleans and
+    dates keep their type, text starting with = is a formula and missing values are empty cells
+    :param ls_values: the values of the column
+    :param kind: the kind of the column
+    :return: numpy object array of the encoded cells
+    """
+    arr_values = np.array(ls_values, dtype=object)
+    is_value = arr_values != ""
+    arr_cells = np.full(len(arr_values), "{}", dtype=object)
+    if not is_value.any():
+        return arr_cells
+
+    arr_present = arr_values[is_value]
+    if kind == "bool":
+        arr_cells[is_value] = np.where(
+            arr_present.astype(bool),
+            '{"userEnteredValue":{"boolValue":true}}',
+            '{"userEnteredValue":{"boolValue":false}}',
+        )
+    elif kind in ["number", "date"]:
+        # numbers hold no commas, so the column is encoded in one call and split
+        arr_numbers = np.array(
+            dumps_sheets_json(arr_present.tolist())[1:-1].split(","), dtype=object
+        )
+        arr_cells[is_value] = '{"userEnteredValue":{"numberValue":' + arr_numbers + "}}"
+    else:
+        arr_text = np.array(list(map(dumps_sheets_json, arr_present)), dtype=object)
+        is_formula = (
+            pd.Series(arr_present, dtype=object)
+            .str.startswith("=")
+            .to_numpy(dtype=bool)
+        )
+        arr_cells[is_value] = np.where(
+            is_formula,
+            '{"userEnteredValue":{"formulaValue":' + arr_text + "}}",
+            '{"userEnteredValue":{"stringValue":' + arr_text + "}}",
+        )
+    return arr_cells
+
+
+def get_paste_data_request_json(sheet_id, ls_head, ls_columns):
+    """
+    This function will encode a header and columns from get_df_upload_columns as the json of a pasteData request at the
+    top left cell of a sheet, the pasted text is parsed like values sent with valueInputOption USER_ENTERED
+    :param sheet_id: the id of the sheet
+    :param ls_head: the header row
+    :param ls_columns: the columns of values
+    :return: the json string of the request
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(ls_head)
+    writer.writerows(zip(*ls_columns))
+    dict_request = {
+        "pasteData": {
+            "coordinate": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+            # the last line terminator would paste an empty row below the grid, fields holding one are quoted
+            "data": buffer.getvalue()[:-1],
+            "type": "PASTE_NORMAL",
+            "delimiter": ",",
+        }
+    }
+    return dumps_sheets_json(dict_request)
+
+
+def get_date_format_requests(
+    sheet_id, dict_date_formats, first_row, last_row, first_col=0
+):
+    """
+    This function will return the repeatCell requests showing date serial numbers as dates
+    :param sheet_id: the id of the sheet within the spreadsheet
+    :param dict_date_formats: dictionary of the position of each date column to its numberFormat
+    :param first_row: the first data row, zero based
+    :param last_row: the row after the last data row, zero based
+    :param first_col: the column of position 0, zero based
+    :return: list of requests as dictionaries
+    """
+    if last_row <= first_row:
+        return []
+    return [
+        {
+            "repeatCell": {
+                "range": {
+                    "sheetId": sheet_id,
+                    "startRowIndex": first_row,
+                    "endRowIndex": last_row,
+                    "startColumnIndex": first_col + col_num,
+                    "endColumnIndex": first_col + col_num + 1,
+                },
+                "cell": {"userEnteredFormat": {"numberFormat": number_format}},
+                "fields": "userEnteredFormat.numberFormat",
+            }
+        }
+        for col_num, number_format in dict_date_formats.items()
+    ]
+
+
+def replace_sheet_values(
+    Workbook, sheetName, df, indexes=False, note=None, typed_cells=False
+):
+    """
+    This function will replace the content of a sheet with a dataframe in one spreadsheets.batchUpdate that adds or
+    resizes the sheet to fit, pastes every cell of it parsed as if typed by a user like set_dataframe, formats the date
+    columns and sets the note, the batchUpdate is applied all or nothing so the sheet is never left half written
+    :param Workbook: the Spreadsheet object the sheet belongs to
+    :param sheetName: the name of the sheet, added if it doesnt exist
+    :param df: the dataframe to write
+    :param indexes: whether to write the index columns
+    :param note: the note to set on the top left cell, None for no note
+    :param typed_cells: whether to send the cells typed instead of pasted, text is then never parsed as a number or date
+    :return: the Worksheet object
+    """
+    ls_head, ls_columns, ls_kinds, dict_date_formats = get_df_upload_columns(
+        df, indexes=indexes
+    )
+    num_rows = len(df) + 1
+    num_cols = max(len(ls_head), 1)
+
+    try:
+        Worksheet = get_book_sheet_from_id_name(Workbook.id, sheetName)
+        sheet_id = Worksheet.id
+        ls_requests = [get_resize_sheet_request(sheet_id, num_rows, num_cols)]
+    except pygsheets.WorksheetNotFound:
+        Worksheet = None
+        # pick the id of the new sheet ourselves so the rest of the requests can refer to it
+        set_sheet_ids = {ws.id for ws in Workbook._sheet_list}
+        sheet_id = int(np.random.randint(1, 2**31 - 1))
+        while sheet_id in set_sheet_ids:
+            sheet_id = int(np.random.randint(1, 2**31 - 1))
+        ls_requests = [
+            {
+                "addSheet": {
+                    "properties": {
+                        "sheetId": sheet_id,
+                        "title": sheetName,
+                        "gridProperties": {
+                            "rowCount": num_rows,
+                            "columnCount": num_cols,
+                        },
+                    }
+                }
+            }
+        ]
+    ls_request_json = [dumps_sheets_json(request) for request in ls_requests]
+
+    if typed_cells:
+        ls_cell_columns = [
+            get_cell_data_column_json(ls_values, kind)
+            for ls_values, kind in zip(ls_columns, ls_kinds)
+        ]
+        # the range covers the whole resized grid, so cells the frame leaves empty are cleared
+        ls_cell_row_json = [
+            '{"values":[' + ",".join(get_cell_data_column_json(ls_head, "text")) + "]}"
+        ]
+        ls_cell_row_json.extend(
+            '{"values":[' + ",".join(row) + "]}" for row in zip(*ls_cell_columns)
+        )
+        dict_range = {
+            "sheetId": sheet_id,
+            "startRowIndex": 0,
+            "endRowIndex": num_rows,
+            "startColumnIndex": 0,
+            "endColumnIndex": num_cols,
+        }
+        ls_request_json.append(
+            '{"updateCells":{"range":'
+            + dumps_sheets_json(dict_range)
+            + ',"rows":['
+            + ",".join(ls_cell_row_json)
+            + '],"fields":"userEnteredValue"}}'
+        )
+    else:
+        # every row holds a value for each column of the resized grid, so cells the frame leaves empty are cleared
+        ls_request_json.append(
+            get_paste_data_request_json(sheet_id, ls_head, ls_columns)
+        )
+
+    ls_after_requests = get_date_format_requests(
+        sheet_id, dict_date_formats, 1, num_rows
+    )
+    if note is not None:
+        ls_after_requests.append(get_note_request(sheet_id, note))
+    ls_request_json.extend(dumps_sheets_json(request) for request in ls_after_requests)
+
+    request = Workbook.client.sheet.service.spreadsheets().batchUpdate(
+        spreadsheetId=Workbook.id, body={}
+    )
+    body = '{"requests":[' + ",".join(ls_request_json) + "]}"
+    response = execute_sheets_request(Workbook.client, set_request_body(request, body))
+
+    if Worksheet is None:
+        # add the sheet to the cached book the way Spreadsheet.add_worksheet does
+        Worksheet = Workbook.worksheet_cls(
+            Workbook, {"properties": response["replies"][0]["addSheet"]["properties"]}
+        )
+        Workbook._sheet_list.append(Worksheet)
+        dict_connected_sheets[get_sheet_handle_key(Workbook.id, sheetName)] = Worksheet
+    else:
+        dict_grid_properties = Worksheet.jsonSheet["properties"]["gridProperties"]
+        dict_grid_properties["rowCount"] = num_rows
+        dict_grid_properties["columnCount"] = num_cols
+    return Worksheet
+
+
+def WriteToSheets(
+    bookName,
+    sheetName,
+    df,
+    indexes=False,
+    set_note=None,
+    retries=3,
+    script_path="",
+    function_name="",
+    delta=False,
+    delta_max_changed_ratio=0.5,
+    chunked=None,
+    chunk_max_bytes=2 * 1024**2,
+    chunk_workers=1,
+    progress_callback=None,
+    write_behind=False,
+    typed_cells=False,
+):
+    """
+    This function will write a dataframe to a google sheet, will create the sheet if it doesnt exist
+    :param bookName: the name of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :param df: the dataframe to write to the sheet
+    :param indexes: whether to write the index column to the sheet
+    :param set_note: the note to set on the sheet, None for no note, "DT" for date time, string for custom note
+    :param retries: the number of times to retry if the connection fails
+    :param delta: whether to only write the cells that changed since the last write, using the sheets output cache as the baseline,
+        assumes the sheet has not been edited by hand since, nothing is sent when nothing changed
+    :param delta_max_changed_ratio: above this share of changed cells a delta write falls back to a full write
+    :param chunked: whether to upload the frame in row blocks that a retry resumes from, None for frames of at least
+        chunked_write_min_cells cells
+    :param chunk_max_bytes: the payload size limit of a block
+    :param chunk_workers: the number of blocks uploaded at the same time
+    :param progress_callback: function called with the number of committed blocks and the number of blocks
+    :param write_behind: whether to save the write to the write journal and return immediately, a drainer thread
+        sends it with backoff and a newer write to the same sheet replaces it while it waits, progress_callback is not called
+    :param typed_cells: whether a full write that is not chunked sends typed cells instead of values parsed as if
+        typed by a user, see replace_sheet_values
+    :return: None
+
+    A full write that is not chunked replaces the sheet with replace_sheet_values, the sheet is rewritten in full so
+    there is no need to clear it first, every write mode sends the values of get_df_upload_columns
+    """
+
+    # global dict_connected_books
+    # global dict_connected_sheets
+
+    start_time = datetime.datetime.now()
+    print_logger(
+        f"Writing to Google Sheet: {bookName} - {sheetName} with size {df.shape}"
+    )
+    if isinstance(df, pd.Series):
+        print_logger(
+            "# Found a series when writing to sheets, converting to dataframe #"
+        )
+        df = df.reset_index()
+
+    if write_behind:
+        enqueue_sheets_write(
+            bookName,
+            sheetName,
+            df,
+            {
+                "indexes": indexes,
+                # the note is rendered now so a date time note tells when the data was computed
+                "set_note": get_sheet_note(set_note),
+                "script_path": script_path,
+                "function_name": function_name,
+                "delta": delta,
+                "delta_max_changed_ratio": delta_max_changed_ratio,
+                "chunked": chunked,
+                "chunk_max_bytes": chunk_max_bytes,
+                "chunk_workers": chunk_workers,
+                "typed_cells": typed_cells,
+            },
+        )
+        start_sheets_write_drainer()
+        return
+
+    ls_delta_ranges = None
+    if delta:
+        # the baseline is the frame of the last write that reached the sheet
+        _, ls_delta_ranges = get_sheets_cache_delta(
+            bookName, sheetName, df, indexes, max_changed_ratio=delta_max_changed_ratio
+        )
+
+    if ls_delta_ranges == []:
+        print_logger(
+            f"No changes to write to Google Sheet: {bookName} - {sheetName}, skipping"
+        )
+        WriteToSheetsCache(bookName, sheetName, df, indexes)
+        log_data_pipeline(
+            script_path=script_path,
+            function_name=function_name,
+            input_output="output",
+            resource_type="google_sheet",
+            spreadsheet_id=get_hardcoded_book_ids().get(bookName, ""),
+            spreadsheet_name=bookName,
+            sheet_name=sheetName,
+            domo_table_name="",
+            domo_table_id="",
+            file_path="",
+        )
+        return
+
+    if chunked is None:
+        chunked = df.size >= chunked_write_min_cells
+    if chunked:
+        ls_chunk_rows, num_chunk_cols, dict_chunk_date_formats = (
+            get_df_values_json_rows(df, indexes=indexes)
+        )
+        ls_chunks = get_row_chunks(ls_chunk_rows, chunk_max_bytes)
+        # blocks committed by a failed attempt are skipped when the write is retried
+        set_committed_chunks = set()
+
+    note = get_sheet_note(set_note)
+    is_note_set = False
+
+    def write_attempt():
+        nonlocal ls_delta_ranges, is_note_set
+
+        Workbook = get_book(bookName)
+
+        if ls_delta_ranges is None and not chunked:
+            Worksheet = replace_sheet_values(
+                Workbook,
+                sheetName,
+                df,
+                indexes=indexes,
+                note=note,
+                typed_cells=typed_cells,
+            )
+            is_note_set = True
+            return Workbook, Worksheet
+
+        try:
+            Worksheet = get_book_sheet(bookName, sheetName)
+        except pygsheets.WorksheetNotFound:
+            Workbook.add_worksheet(sheetName)
+            Worksheet = get_book_sheet(bookName, sheetName)
+            # a new sheet has none of the baseline on it
+            ls_delta_ranges = None
+
+        if ls_delta_ranges is not None:
+            write_delta_to_sheet_obj(
+                Workbook, Worksheet, df, ls_delta_ranges, indexes=indexes
+            )
+        else:
+            write_df_to_sheet_obj_in_chunks(
+                Workbook,
+                Worksheet,
+                ls_chunk_rows,
+                num_chunk_cols,
+                ls_chunks,
+                set_committed_chunks,
+                max_workers=chunk_workers,
+                progress_callback=progress_callback,
+                dict_date_formats=dict_chunk_date_formats,
+            )
+
+        return Workbook, Worksheet
+
+    def drop_sheet_connection(e):
+        # the tab may have been deleted, recreated or renamed since it was cached
+        id = get_hardcoded_book_ids().get(bookName) or dict_book_name_ids.get(bookName)
+        if id is not None:
+            dict_connected_sheets.pop(get_sheet_handle_key(id, sheetName))
+            invalidate_stale_handles(e, id, sheetName)
+
+    try:
+        Workbook, Worksheet = call_with_retry(
+            f"write to sheets with name {bookName} and sheet name {sheetName} and df of size {df.shape}",
+            write_attempt,
+            key=get_hardcoded_book_ids().get(bookName, bookName),
+            policy={"max_attempts": retries},
+            on_retry=drop_sheet_connection,
+        )
+    except Exception as e:
+        print_logger(f"Failed to write to sheet after {retries} retries")
+        # a failed write of any mode may have changed part of the sheet, so it no longer matches the cached copy
+        # and the next delta write has to be a full write
+        RemoveFromSheetsCache(bookName, sheetName)
+        raise Exception(
+            f"Failed to write to sheets with name {bookName} and sheet name {sheetName} and df of size {df.shape}"
+        ) from e
+
+    # the cached copy is the baseline of delta writes, so it is only written once the sheet holds the frame
+    WriteToSheetsCache(bookName, sheetName, df, indexes)
+
+    if note is not None and not is_note_set:
+        try:
+            call_with_retry(
+                f"set note on {bookName} : {sheetName}",
+                spreadsheets_batch_update,
+                Workbook,
+                [get_note_request(Worksheet.id, note)],
+                key=Workbook.id,
+            )
+        except Exception as e:
+            print_logger(f"Failed to set note when writing, error: {e}")
+
+    print_logger(
+        f"Finished writing to Google Sheet: {bookName} - {sheetName} with size {df.shape}, after {datetime.datetime.now() - start_time}"
+    )
+
+    log_data_pipeline(
+        script_path=script_path,
+        function_name=function_name,
+        input_output="output",
+        resource_type="google_sheet",
+        spreadsheet_id=Workbook.id,
+        spreadsheet_name=bookName,
+        sheet_name=sheetName,
+        domo_table_name="",
+        domo_table_id="",
+        file_path="",
+    )
+
+
+def get_sheet_note(set_note):
+    """
+    This function will return the text of a note as WriteToSheets sets it
+    :param set_note: None for no note, "DT" for date time, string for custom note
+    :return: the note text or None
+    """
+    if set_note == "DT":
+        return "Data updated at: " + str(
+            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        )
+    return set_note
+
+
+def WriteManyToSheets(
+    bookName,
+    dict_sheet_dfs,
+    indexes=False,
+    set_note=None,
+    raise_errors=True,
+    script_path="",
+    function_name="",
+):
+    """
+    This function will write several dataframes to tabs of one google sheet in two round trips, one spreadsheets.batchUpdate
+    to create, resize and note the tabs and one values.batchUpdate for all values, will create tabs that dont exist
+    :param bookName: the name of the google spreadsheet
+    :param dict_sheet_dfs: dictionary of sheet name to the dataframe to write to it
+    :param indexes: whether to write the index column to the sheets
+    :param set_note: the note to set on the sheets, None for no note, "DT" for date time, string for custom note
+    :param raise_errors: whether to raise after all tabs were attempted if any of them failed
+    :return: dictionary of sheet name to {"status": "ok" or "failed", "error": error or "", "shape": shape}
+    """
+    start_time = datetime.datetime.now()
+    print_logger(
+        f"Writing {len(dict_sheet_dfs)} tabs to Google Sheet: {bookName} - {list(dict_sheet_dfs.keys())}"
+    )
+
+    dict_sheet_dfs = {
+        sheetName: df.reset_index() if isinstance(df, pd.Series) else df
+        for sheetName, df in dict_sheet_dfs.items()
+    }
+    # tuples of the encoded rows, the number of columns and the date formats
+    dict_sheet_rows = {
+        sheetName: get_df_values_json_rows(df, indexes=indexes)
+        for sheetName, df in dict_sheet_dfs.items()
+    }
+
+    dict_results = {
+        sheetName: {
+            "status": "ok",
+            "error": "",
+            "shape": dict_sheet_dfs[sheetName].shape,
+        }
+        for sheetName in dict_sheet_dfs.keys()
+    }
+
+    Workbook = get_book(bookName)
+    note = get_sheet_note(set_note)
+
+    def get_tab_requests(sheetName, dict_sheet_ids):
+        ls_row_json, num_cols, dict_date_formats = dict_sheet_rows[sheetName]
+        grid_properties = {
+            "rowCount": max(len(ls_row_json), 1),
+            "columnCount": max(num_cols, 1),
+        }
+        ls_requests = []
+        if sheetName in dict_sheet_ids.keys():
+            ls_requests.append(
+                get_resize_sheet_request(
+                    dict_sheet_ids[sheetName],
+                    grid_properties["rowCount"],
+                    grid_properties["columnCount"],
+                )
+            )
+        else:
+            # pick the id of the new tab ourselves so the note can be set in the same request
+            new_sheet_id = int(np.random.randint(1, 2**31 - 1))
+            while new_sheet_id in dict_sheet_ids.values():
+                new_sheet_id = int(np.random.randint(1, 2**31 - 1))
+            dict_sheet_ids[sheetName] = new_sheet_id
+            ls_requests.append(
+                {
+                    "addSheet": {
+                        "properties": {
+                            "sheetId": new_sheet_id,
+                            "title": sheetName,
+                            "gridProperties": grid_properties,
+                        }
+                    }
+                }
+            )
+        ls_requests.extend(
+            get_date_format_requests(
+                dict_sheet_ids[sheetName], dict_date_formats, 1, len(ls_row_json)
+            )
+        )
+        if note is not None:
+            ls_requests.append(get_note_request(dict_sheet_ids[sheetName], note))
+        return ls_requests
+
+    def write_tab_values(ls_tab_names):
+        # the rows are already encoded, so the body is joined instead of built as python objects
+        ls_data_json = []
+        for sheetName in ls_tab_names:
+            values_body = get_values_body(dict_sheet_rows[sheetName][0])
+            ls_data_json.append(
+                '{"range":'
+                + dumps_sheets_json(f"{quote_sheet_name(sheetName)}!A1")
+                + ","
+                + values_body[1:]
+            )
+        body = (
+            '{"valueInputOption":"USER_ENTERED","data":['
+            + ",".join(ls_data_json)
+            + "]}"
+        )
+        request = (
+            Workbook.client.sheet.service.spreadsheets()
+            .values()
+            .batchUpdate(spreadsheetId=Workbook.id, body={})
+        )
+        return execute_sheets_request(Workbook.client, set_request_body(request, body))
+
+    ls_sheet_names = list(dict_sheet_dfs.keys())
+    try:
+        dict_sheet_ids = {ws.title: ws.id for ws in Workbook.worksheets()}
+        ls_requests = []
+        for sheetName in ls_sheet_names:
+            ls_requests.extend(get_tab_requests(sheetName, dict_sheet_ids))
+        call_with_retry(
+            f"update tabs of {bookName}",
+            Workbook.client.sheet.batch_update,
+            Workbook.id,
+            ls_requests,
+            key=Workbook.id,
+        )
+        call_with_retry(
+            f"write values of {bookName}",
+            write_tab_values,
+            ls_sheet_names,
+            key=Workbook.id,
+        )
+    except Exception as e:
+        # the batched requests are all or nothing, so write tab by tab to find which ones fail
+        print_logger(
+            f"Failed to write tabs of {bookName} in one batch, error: {e}, writing tab by tab"
+        )
+        try:
+            call_with_retry(
+                f"refresh tabs of {bookName}",
+                Workbook.fetch_properties,
+                key=Workbook.id,
+            )
+        except Exception:
+            # the tabs may have been resized by the first batch, so none of them matches its cached copy
+            for sheetName in ls_sheet_names:
+                RemoveFromSheetsCache(bookName, sheetName)
+            raise
+        dict_sheet_ids = {ws.title: ws.id for ws in Workbook.worksheets()}
+        for sheetName in ls_sheet_names:
+            try:
+                call_with_retry(
+                    f"update tab {bookName} : {sheetName}",
+                    Workbook.client.sheet.batch_update,
+                    Workbook.id,
+                    get_tab_requests(sheetName, dict_sheet_ids),
+                    key=Workbook.id,
+                )
+                call_with_retry(
+                    f"write values of {bookName} : {sheetName}",
+                    write_tab_values,
+                    [sheetName],
+                    key=Workbook.id,
+                )
+            except Exception as e:
+                print_logger(
+                    f"Failed to write to sheets with name {bookName} and sheet name {sheetName}, error: {e}"
+                )
+                dict_results[sheetName]["status"] = "failed"
+                dict_results[sheetName]["error"] = str(e)
+
+    # tabs may have been added, so the cached connections no longer match the book
+    invalidate_spreadsheet_handles(Workbook.id)
+
+    # like WriteToSheets the cached copy is the delta baseline, kept only for the tabs that hold their frame
+    for sheetName in ls_sheet_names:
+        if dict_results[sheetName]["status"] == "ok":
+            WriteToSheetsCache(bookName, sheetName, dict_sheet_dfs[sheetName], indexes)
+        else:
+            RemoveFromSheetsCache(bookName, sheetName)
+
+    for sheetName in ls_sheet_names:
+        if dict_results[sheetName]["status"] == "ok":
+            log_data_pipeline(
+                script_path=script_path,
+                function_name=function_name,
+                input_output="output",
+                resource_type="google_sheet",
+                spreadsheet_id=Workbook.id,
+                spreadsheet_name=bookName,
+                sheet_name=sheetName,
+                domo_table_name="",
+                domo_table_id="",
+                file_path="",
+            )
+
+    ls_failed_sheets = [
+        sheetName
+        for sheetName in ls_sheet_names
+        if dict_results[sheetName]["status"] == "failed"
+    ]
+    print_logger(
+        f"Finished writing {len(ls_sheet_names) - len(ls_failed_sheets)} of {len(ls_sheet_names)} tabs to Google Sheet: {bookName}, after {datetime.datetime.now() - start_time}"
+    )
+
+    if ls_failed_sheets and raise_errors:
+        raise Exception(
+            f"Failed to write to sheets with name {bookName} and sheet names {ls_failed_sheets}"
+        )
+
+    return dict_results
+
+
+def ClearSheet(book_name, sheet_name, start_range, end_range):
+    """
+    This function will clear a range of cells on a sheet
+    :param book_name: the name of the google spreadsheet
+    :param sheet_name: the name of the sheet within the google spreadsheet
+    :param start_range: the start range of the cells to clear in the format "A1"
+    :param end_range: the end range of the cells to clear in the format "A1"
+    :return: None
+    """
+
+    Worksheet = get_book_sheet(book_name, sheet_name)
+    call_with_retry(
+        f"clear range of {book_name} : {sheet_name}",
+        Worksheet.clear,
+        start_range,
+        end_range,
+        key=Worksheet.spreadsheet.id,
+    )
+
+
+def clear_range_of_sheet_obj(sheet_obj, start, end, retries=3):
+    """
+    This function will clear a range of cells on a sheet
+    :param sheet_obj: the sheet object to write to
+    :param start: the start range of the cells to clear in the format "A1"
+    :param end: the end range of the cells to clear in the format "A1"
+    :return: None
+    """
+
+    call_with_retry(
+        "clear range",
+        sheet_obj.clear,
+        start,
+        end,
+        key=sheet_obj.spreadsheet.id,
+        policy={"max_attempts": retries},
+    )
+
+
+def write_df_to_range_of_sheet_obj(
+    sheet_obj,
+    df,
+    start,
+    fit,
+    nan="",
+    copy_head=False,
+    retries=3,
+):
+    """
+    This function will write a dataframe to a range on a sheet
+    :param sheet_obj: the sheet object to write to
+    :param df: the dataframe to write to the sheet
+    :param start: the start range of the cells to clear in the format "A1"
+    :param fit: whether to fit the dataframe to the range
+    :param nan: the value to use for nan
+    :param copy_head: whether to copy the header
+    :return: None
+    """
+    start_row, start_col = format_addr(start, output="tuple")
+    ls_row_json, num_cols, dict_date_formats = get_df_values_json_rows(
+        df, nan=nan, include_head=copy_head
+    )
+    if not ls_row_json or num_cols == 0:
+        return
+    end_row = start_row + len(ls_row_json) - 1
+    end_col = start_col + num_cols - 1
+
+    # the resize and the date formats go in one batchUpdate, none is sent when neither is needed
+    ls_requests = get_date_format_requests(
+        sheet_obj.id,
+        dict_date_formats,
+        start_row - 1 + int(copy_head),
+        end_row,
+        first_col=start_col - 1,
+    )
+    if fit:
+        ls_requests.insert(0, get_resize_sheet_request(sheet_obj.id, end_row, end_col))
+    if ls_requests:
+        call_with_retry(
+            "format range",
+            spreadsheets_batch_update,
+            sheet_obj.spreadsheet,
+            ls_requests,
+            key=sheet_obj.spreadsheet.id,
+            policy={"max_attempts": retries},
+        )
+        if fit:
+            dict_grid_properties = sheet_obj.jsonSheet["properties"]["gridProperties"]
+            dict_grid_properties["rowCount"] = end_row
+            dict_grid_properties["columnCount"] = end_col
+
+    sheet_title = quote_sheet_name(sheet_obj.title)
+    start_label = format_addr((start_row, start_col), output="label")
+    end_label = format_addr((end_row, end_col), output="label")
+    body = get_values_body(ls_row_json)
+
+    def write_attempt():
+        request = (
+            sheet_obj.client.sheet.service.spreadsheets()
+            .values()
+            .update(
+                spreadsheetId=sheet_obj.spreadsheet.id,
+                range=f"{sheet_title}!{start_label}:{end_label}",
+                valueInputOption="USER_ENTERED",
+                body={},
+            )
+        )
+        return execute_sheets_request(sheet_obj.client, set_request_body(request, body))
+
+    call_with_retry(
+        "write to range",
+        write_attempt,
+        key=sheet_obj.spreadsheet.id,
+        policy={"max_attempts": retries},
+    )
+
+
+# %%
+## Append Only Writes ##
+
+# the keys of the rows appended by AppendToSheets, so duplicates are dropped without reading the sheet back
+loc_sheets_append_index = os.path.join(data_dir, "sheets_append_index")
+
+# a spreadsheet holds at most this many cells across its sheets, appends move to a new part spreadsheet
+# named like "Book (2)" once the next append would use more than append_rotate_cells_ratio of it
+max_cells_per_spreadsheet = 10_000_000
+append_rotate_cells_ratio = 0.9
+
+# appends to one sheet take turns through a lock row, held while the rows are sent, see acquire_append_lock
+append_lock_poll_seconds = 1
+append_lock_max_wait_seconds = 600
+# a lock taken longer ago than this by a run that died is taken over
+append_lock_timeout_seconds = 3600
+
+
+def get_sheets_append_index_connection():
+    os.makedirs(loc_sheets_append_index, exist_ok=True)
+    con = sqlite3.connect(
+        os.path.join(loc_sheets_append_index, "index.sqlite"),
+        timeout=60,
+        isolation_level=None,
+    )
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS targets (book TEXT, sheet TEXT, part INTEGER, key_columns TEXT, "
+        "PRIMARY KEY (book, sheet))"
+    )
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS keys (book TEXT, sheet TEXT, key TEXT, PRIMARY KEY (book, sheet, key)) "
+        "WITHOUT ROWID"
+    )
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS locks (book TEXT, sheet TEXT, locked_by TEXT, locked_at REAL, "
+        "PRIMARY KEY (book, sheet))"
+    )
+    return con
+
+
+def acquire_append_lock(con, bookName, sheetName):
+    """
+    This function will wait for the append lock of a sheet, so two runs can not append the same keys while appends
+    to other sheets go ahead, sqlite itself is only locked for the short transactions
+    :param con: the connection to the append index
+    :param bookName: the name of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :return: the owner of the lock to release it with
+    """
+    owner = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    start_time = time.time()
+    while True:
+        now = time.time()
+        con.execute("BEGIN IMMEDIATE")
+        con.execute(
+            "DELETE FROM locks WHERE book = ? AND sheet = ? AND locked_at < ?",
+            (bookName, sheetName, now - append_lock_timeout_seconds),
+        )
+        cursor = con.execute(
+            "INSERT OR IGNORE INTO locks (book, sheet, locked_by, locked_at) VALUES (?, ?, ?, ?)",
+            (bookName, sheetName, owner, now),
+        )
+        con.execute("COMMIT")
+        if cursor.rowcount == 1:
+            return owner
+        if now - start_time > append_lock_max_wait_seconds:
+            raise Exception(
+                f"Timed out after {append_lock_max_wait_seconds} seconds waiting for the append lock of {bookName} - {sheetName}"
+            )
+        time.sleep(append_lock_poll_seconds)
+
+
+def release_append_lock(con, bookName, sheetName, owner):
+    con.execute(
+        "DELETE FROM locks WHERE book = ? AND sheet = ? AND locked_by = ?",
+        (bookName, sheetName, owner),
+    )
+
+
+def get_append_part_name(bookName, part):
+    return bookName if part == 1 else f"{bookName} ({part})"
+
+
+def get_append_key_value(value):
+    """
+    This function will turn a cell value into its part of an append key, values from get_df_upload_columns and the
+    unformatted values read back from a sheet give the same key, numbers and dates by 15 significant digits like sheets
+    :param value: the value
+    :return: the key text
+    """
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return "" if value != value else format(float(value), ".15g")
+    return "" if value is None else str(value)
+
+
+def get_row_keys(ls_rows, ls_key_positions):
+    return [
+        json.dumps(
+            [
+                get_append_key_value(row[i]) if i < len(row) else ""
+                for i in ls_key_positions
+            ]
+        )
+        for row in ls_rows
+    ]
+
+
+def render_serial_dates(ls_rows, dict_date_formats):
+    """
+    This function will render the serial number dates of rows from get_df_upload_columns as text like 2024-01-05,
+    which sheets parses back into the same serial numbers shown as dates
+    :param ls_rows: list of rows
+    :param dict_date_formats: dictionary of the position of each date column to its numberFormat
+    :return: list of rows
+    """
+    if not dict_date_formats:
+        return ls_rows
+    dict_strftime = {
+        col_num: "%Y-%m-%d" if number_format["type"] == "DATE" else "%Y-%m-%d %H:%M:%S"
+        for col_num, number_format in dict_date_formats.items()
+    }
+    ls_rendered = []
+    for row in ls_rows:
+        row = list(row)
+        for col_num, strftime in dict_strftime.items():
+            if row[col_num] != "":
+                date = sheets_serial_epoch + pd.Timedelta(days=row[col_num])
+                row[col_num] = date.round("s").strftime(strftime)
+        ls_rendered.append(row)
+    return ls_rendered
+
+
+def load_append_target(con, bookName, sheetName, ls_key_columns):
+    """
+    This function will return the part spreadsheet appends to a sheet go to, the first time a sheet is appended to
+    from this machine, or with other key columns, the parts are found on drive and the keys already on them indexed
+    from their unformatted values
+    :param con: the connection to the append index, the caller holds the append lock of the sheet
+    :param bookName: the name of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :param ls_key_columns: the key columns, empty for none
+    :return: the part number
+    """
+    row = con.execute(
+        "SELECT part, key_columns FROM targets WHERE book = ? AND sheet = ?",
+        (bookName, sheetName),
+    ).fetchone()
+    if row is not None and json.loads(row[1]) == ls_key_columns:
+        return row[0]
+
+    part = 1
+    while get_spreadsheet_ids_by_name(get_append_part_name(bookName, part + 1)):
+        part += 1
+
+    # the sheets are read before the transaction, so sqlite is not locked while waiting on google
+    set_keys = set()
+    if ls_key_columns:
+        print_logger(
+            f"Indexing the {ls_key_columns} keys of {part} parts of {bookName} - {sheetName}"
+        )
+        for part_num in range(1, part + 1):
+            try:
+                id = get_book(get_append_part_name(bookName, part_num)).id
+                for df_chunk in iter_sheet_chunks(
+                    id, sheetName, value_render="UNFORMATTED_VALUE", numerize=False
+                ):
+                    if not set(ls_key_columns).issubset(df_chunk.columns):
+                        break
+                    set_keys.update(
+                        get_row_keys(
+                            df_chunk[ls_key_columns].fillna("").values.tolist(),
+                            range(len(ls_key_columns)),
+                        )
+                    )
+            except pygsheets.WorksheetNotFound:
+                continue
+
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        con.execute(
+            "DELETE FROM keys WHERE book = ? AND sheet = ?", (bookName, sheetName)
+        )
+        con.executemany(
+            "INSERT INTO keys (book, sheet, key) VALUES (?, ?, ?)",
+            [(bookName, sheetName, key) for key in set_keys],
+        )
+        con.execute(
+            "INSERT OR REPLACE INTO targets (book, sheet, part, key_columns) VALUES (?, ?, ?, ?)",
+            (bookName, sheetName, part, json.dumps(ls_key_columns)),
+        )
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    return part
+
+
+def get_append_sheet_state(Workbook, sheetName):
+    """
+    This function will get the header of a sheet and the size of its spreadsheet in two requests
+    :param Workbook: the Spreadsheet object the sheet is in
+    :param sheetName: the name of the sheet
+    :return: tuple of the header as a list, None if the sheet doesnt exist, the number of columns of the sheet,
+        the number of rows of the sheet and the number of cells of the spreadsheet
+    """
+    request = Workbook.client.sheet.service.spreadsheets().get(
+        spreadsheetId=Workbook.id,
+        fields="sheets.properties(title,gridProperties(rowCount,columnCount))",
+    )
+    response = call_with_retry(
+        f"get size of {Workbook.title}",
+        execute_sheets_request,
+        Workbook.client,
+        request,
+        key=Workbook.id,
+    )
+
+    num_cells = 0
+    num_cols = None
+    num_rows = 0
+    for sheet in response.get("sheets", []):
+        grid = sheet["properties"].get("gridProperties", {})
+        num_cells += grid.get("rowCount", 0) * grid.get("columnCount", 0)
+        if sheet["properties"]["title"] == sheetName:
+            num_cols = grid.get("columnCount", 0)
+            num_rows = grid.get("rowCount", 0)
+    if num_cols is None:
+        return None, 0, 0, num_cells
+
+    ls_header_rows = get_sheet_values_window(
+        Workbook, f"{quote_sheet_name(sheetName)}!1:1"
+    )
+    return (
+        (ls_header_rows[0] if ls_header_rows else []),
+        num_cols,
+        num_rows,
+        num_cells,
+    )
+
+
+def get_sheet_row_count(Workbook, sheetName):
+    """
+    This function will get the number of rows of the grid of a sheet
+    :param Workbook: the Spreadsheet object the sheet is in
+    :param sheetName: the name of the sheet
+    :return: the number of rows, 0 if the sheet doesnt exist
+    """
+    request = Workbook.client.sheet.service.spreadsheets().get(
+        spreadsheetId=Workbook.id,
+        fields="sheets.properties(title,gridProperties(rowCount))",
+    )
+    response = call_with_retry(
+        f"get row count of {Workbook.title} : {sheetName}",
+        execute_sheets_request,
+        Workbook.client,
+        request,
+        key=Workbook.id,
+    )
+    for sheet in response.get("sheets", []):
+        if sheet["properties"]["title"] == sheetName:
+            return sheet["properties"].get("gridProperties", {}).get("rowCount", 0)
+    return 0
+
+
+def create_append_part_book(Workbook, part_name, sheetName):
+    """
+    This function will create the next part spreadsheet of an append only sheet in the folder of the previous part
+    :param Workbook: the Spreadsheet object of the previous part
+    :param part_name: the name of the new spreadsheet
+    :param sheetName: the name of the sheet, given to the first sheet of the new spreadsheet
+    :return: the Spreadsheet object
+    """
+    Workbook_part = call_with_retry(
+        f"create {part_name}",
+        gc.create,
+        part_name,
+        key=part_name,
+        policy={"max_attempts": 1},
+    )
+
+    # moved here instead of with the folder argument of create, which fails reading the parents in pygsheets 2.0.6
+    ls_parents = get_drive_file_metadata(Workbook.id, fields="id, parents").get(
+        "parents", []
+    )
+    if ls_parents:
+        ls_part_parents = get_drive_file_metadata(
+            Workbook_part.id, fields="id, parents"
+        ).get("parents", [])
+        request = (
+            get_drive_service()
+            .files()
+            .update(
+                fileId=Workbook_part.id,
+                addParents=ls_parents[0],
+                removeParents=",".join(ls_part_parents),
+                fields="id, parents",
+                supportsAllDrives=True,
+            )
+        )
+        call_with_retry(
+            f"move {part_name} to {ls_parents[0]}",
+            execute_drive_request,
+            gc,
+            request,
+            key=Workbook_part.id,
+        )
+
+    spreadsheets_batch_update(
+        Workbook_part,
+        [
+            {
+                "updateSheetProperties": {
+                    "properties": {
+                        "sheetId": Workbook_part.sheet1.id,
+                        "title": sheetName,
+                    },
+                    "fields": "title",
+                }
+            }
+        ],
+    )
+    invalidate_spreadsheet_handles(Workbook_part.id)
+
+    save_spreadsheet_name_index(
+        {
+            Workbook_part.id: {
+                "name": part_name,
+                "modifiedTime": datetime.datetime.now(datetime.timezone.utc).strftime(
+                    "%Y-%m-%dT%H:%M:%S.%fZ"
+                ),
+            }
+        }
+    )
+    dict_book_name_ids[part_name] = Workbook_part.id
+    return get_book_from_id(Workbook_part.id)
+
+
+def AppendToSheets(
+    bookName,
+    sheetName,
+    df,
+    key_columns=None,
+    indexes=False,
+    retries=3,
+    script_path="",
+    function_name="",
+):
+    """
+    This function will append the rows of a dataframe below the rows of a google sheet with values.append,
+    so a run costs the same however long the sheet is, will create the sheet if it doesnt exist
+    :param bookName: the name of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :param df: the new rows, its columns have to be in the header of the sheet, the columns it lacks are left empty
+    :param key_columns: list of the columns identifying a row, rows with a key appended before are dropped using the
+        local append index, None to append every row
+    :param indexes: whether to write the index columns to the sheet
+    :param retries: the number of times to retry the append, before a retry the row count of the sheet is read and
+        an append whose response was lost but whose rows were inserted is not sent again
+    :return: dict with "book" the spreadsheet appended to, "appended" and "duplicates" row counts
+    """
+    start_time = datetime.datetime.now()
+    print_logger(
+        f"Appending to Google Sheet: {bookName} - {sheetName} with size {df.shape}"
+    )
+    if isinstance(df, pd.Series):
+        df = df.reset_index()
+
+    ls_head, ls_columns, _, dict_date_formats = get_df_upload_columns(
+        df, indexes=indexes
+    )
+    ls_rows = [list(row) for row in zip(*ls_columns)]
+    ls_key_columns = list(key_columns or [])
+    ls_missing_keys = [col for col in ls_key_columns if col not in ls_head]
+    if ls_missing_keys:
+        raise Exception(f"Key columns {ls_missing_keys} are not columns of the frame")
+
+    con = get_sheets_append_index_connection()
+    lock_owner = acquire_append_lock(con, bookName, sheetName)
+    try:
+        part = load_append_target(con, bookName, sheetName, ls_key_columns)
+
+        ls_keys = []
+        num_rows = len(ls_rows)
+        if ls_key_columns:
+            ls_row_keys = get_row_keys(
+                ls_rows, [ls_head.index(col) for col in ls_key_columns]
+            )
+            set_seen_keys = set()
+            for i in range(0, len(ls_row_keys), 500):
+                ls_batch = ls_row_keys[i : i + 500]
+                set_seen_keys.update(
+                    key
+                    for (key,) in con.execute(
+                        f"SELECT key FROM keys WHERE book = ? AND sheet = ? AND key IN ({', '.join('?' * len(ls_batch))})",
+                        [bookName, sheetName, *ls_batch],
+                    )
+                )
+            ls_new_rows = []
+            for key, row in zip(ls_row_keys, ls_rows):
+                if key not in set_seen_keys:
+                    set_seen_keys.add(key)
+                    ls_keys.append(key)
+                    ls_new_rows.append(row)
+            ls_rows = ls_new_rows
+
+        dict_result = {
+            "book": get_append_part_name(bookName, part),
+            "appended": len(ls_rows),
+            "duplicates": num_rows - len(ls_rows),
+        }
+        if not ls_rows:
+            print_logger(
+                f"No new rows to append to Google Sheet: {bookName} - {sheetName}, skipping"
+            )
+            return dict_result
+
+        Workbook = get_book(dict_result["book"])
+        ls_sheet_head, num_sheet_cols, num_sheet_rows, num_cells = (
+            get_append_sheet_state(Workbook, sheetName)
+        )
+        num_new_cells = (len(ls_rows) + 1) * max(num_sheet_cols, len(ls_head))
+        if (
+            num_cells + num_new_cells
+            > append_rotate_cells_ratio * max_cells_per_spreadsheet
+        ):
+            part += 1
+            dict_result["book"] = get_append_part_name(bookName, part)
+            print_logger(
+                f"{Workbook.title} has {num_cells} cells, appending to new part {dict_result['book']}"
+            )
+            Workbook = create_append_part_book(Workbook, dict_result["book"], sheetName)
+            ls_sheet_head = []
+            num_sheet_rows = get_sheet_row_count(Workbook, sheetName)
+            con.execute(
+                "UPDATE targets SET part = ? WHERE book = ? AND sheet = ?",
+                (part, bookName, sheetName),
+            )
+        elif ls_sheet_head is None:
+            spreadsheets_batch_update(
+                Workbook,
+                [
+                    {
+                        "addSheet": {
+                            "properties": {
+                                "title": sheetName,
+                                "gridProperties": {
+                                    "rowCount": 1,
+                                    "columnCount": len(ls_head),
+                                },
+                            }
+                        }
+                    }
+                ],
+            )
+            invalidate_spreadsheet_handles(Workbook.id)
+            ls_sheet_head = []
+            num_sheet_rows = 1
+
+        # dates are sent as text for sheets to parse, so they show as dates without a format request
+        ls_rows = render_serial_dates(ls_rows, dict_date_formats)
+        if ls_sheet_head:
+            ls_extra_columns = [col for col in ls_head if col not in ls_sheet_head]
+            if ls_extra_columns:
+                raise Exception(
+                    f"Columns {ls_extra_columns} are not in the header of {dict_result['book']} - {sheetName}: {ls_sheet_head}"
+                )
+            # put the values in the column order of the sheet
+            ls_positions = [
+                ls_head.index(col) if col in ls_head else None for col in ls_sheet_head
+            ]
+            ls_append = [
+                ["" if i is None else row[i] for i in ls_positions] for row in ls_rows
+            ]
+        else:
+            ls_append = [ls_head] + ls_rows
+
+        sheet_title = quote_sheet_name(sheetName)
+        is_sent = False
+
+        def append_attempt():
+            nonlocal is_sent
+            # INSERT_ROWS adds a row to the grid per appended row, so a failed attempt whose rows landed anyway shows
+            # in the row count, the append lock keeps other appends to the sheet from adding rows meanwhile
+            if is_sent and get_sheet_row_count(
+                Workbook, sheetName
+            ) >= num_sheet_rows + len(ls_append):
+                print_logger(
+                    f"The rows of the failed append to {dict_result['book']} : {sheetName} were inserted, not sending them again"
+                )
+                return None
+            is_sent = True
+            request = (
+                Workbook.client.sheet.service.spreadsheets()
+                .values()
+                .append(
+                    spreadsheetId=Workbook.id,
+                    range=f"{sheet_title}!A1",
+                    valueInputOption="USER_ENTERED",
+                    insertDataOption="INSERT_ROWS",
+                    body={"majorDimension": "ROWS", "values": ls_append},
+                )
+            )
+            return execute_sheets_request(Workbook.client, request)
+
+        call_with_retry(
+            f"append {len(ls_rows)} rows to {dict_result['book']} : {sheetName}",
+            append_attempt,
+            key=Workbook.id,
+            policy={"max_attempts": retries},
+        )
+
+        con.execute("BEGIN IMMEDIATE")
+        con.executemany(
+            "INSERT OR IGNORE INTO keys (book, sheet, key) VALUES (?, ?, ?)",
+            [(bookName, sheetName, key) for key in ls_keys],
+        )
+        con.execute("COMMIT")
+    finally:
+        release_append_lock(con, bookName, sheetName, lock_owner)
+        con.close()
+
+    # the output cache holds a full copy of the sheet for delta writes, which no longer matches
+    RemoveFromSheetsCache(bookName, sheetName)
+
+    print_logger(
+        f"Finished appending {dict_result['appended']} rows to Google Sheet: {dict_result['book']} - {sheetName}, "
+        f"skipped {dict_result['duplicates']} duplicates, after {datetime.datetime.now() - start_time}"
+    )
+    log_data_pipeline(
+        script_path=script_path,
+        function_name=function_name,
+        input_output="output",
+        resource_type="google_sheet",
+        spreadsheet_id=Workbook.id,
+        spreadsheet_name=dict_result["book"],
+        sheet_name=sheetName,
+        domo_table_name="",
+        domo_table_id="",
+        file_path="",
+    )
+    return dict_result
+
+
+# %%
+## Write Behind Journal ##
+
+# writes made with write_behind are saved here with their frame and sent by a drainer, so a script finishes
+# while google is down and the data reaches the sheet once it is back, see enqueue_sheets_write
+loc_sheets_write_journal = os.path.join(data_dir, "sheets_write_journal")
+
+# backoff between attempts of a journaled write, doubling from base up to max
+write_behind_base_delay_seconds = 30
+write_behind_max_delay_seconds = 900
+# a write still failing after this many attempts is marked failed, about 4 hours at the max delay
+write_behind_max_attempts = 20
+# a write claimed longer ago than this by a drainer that died is handed out again
+write_behind_claim_timeout_seconds = 3600
+# how long a script waits at exit for its drainer to send the writes that are due
+write_behind_exit_drain_seconds = 120
+write_behind_poll_seconds = 5
+
+sheets_write_drainer = None
+sheets_write_drainer_stop = threading.Event()
+sheets_write_drainer_lock = threading.Lock()
+
+
+def get_sheets_write_journal_connection():
+    os.makedirs(loc_sheets_write_journal, exist_ok=True)
+    con = sqlite3.connect(
+        os.path.join(loc_sheets_write_journal, "journal.sqlite"),
+        timeout=60,
+        isolation_level=None,
+    )
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS writes (id INTEGER PRIMARY KEY AUTOINCREMENT, book TEXT, sheet TEXT, "
+        "frame_path TEXT, kwargs TEXT, created REAL, status TEXT, attempts INTEGER, next_attempt REAL, "
+        "claimed_by TEXT, claimed_at REAL, last_error TEXT)"
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS writes_target ON writes (book, sheet, status)"
+    )
+    return con
+
+
+def remove_journal_frames(ls_frame_paths):
+    for frame_path in ls_frame_paths:
+        if os.path.isfile(frame_path):
+            os.remove(frame_path)
+
+
+def enqueue_sheets_write(bookName, sheetName, df, dict_kwargs):
+    """
+    This function will save a write to the journal, replacing the writes to the same sheet still waiting
+    :param bookName: the name of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet
+    :param df: the dataframe to write
+    :param dict_kwargs: the keyword arguments of WriteToSheets to send it with
+    :return: the id of the journal entry
+    """
+    frame_path = write_frame_file(
+        df,
+        os.path.join(
+            loc_sheets_write_journal,
+            "frames",
+            f"{time.time_ns()}_{os.getpid()}_{threading.get_ident()}",
+        ),
+    )
+
+    con = get_sheets_write_journal_connection()
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        # a write being sent right now is left alone, it is replaced once it lands
+        ls_replaced = con.execute(
+            "SELECT id, frame_path FROM writes WHERE book = ? AND sheet = ? AND status = 'pending'",
+            (bookName, sheetName),
+        ).fetchall()
+        con.executemany(
+            "DELETE FROM writes WHERE id = ?", [(id,) for id, _ in ls_replaced]
+        )
+        cursor = con.execute(
+            "INSERT INTO writes (book, sheet, frame_path, kwargs, created, status, attempts, next_attempt) "
+            "VALUES (?, ?, ?, ?, ?, 'pending', 0, 0)",
+            (bookName, sheetName, frame_path, json.dumps(dict_kwargs), time.time()),
+        )
+        con.execute("COMMIT")
+    finally:
+        con.close()
+
+    remove_journal_frames([path for _, path in ls_replaced])
+    print_logger(
+        f"Journaled write to Google Sheet: {bookName} - {sheetName} with size {df.shape}"
+        + (f", replacing {len(ls_replaced)} waiting writes" if ls_replaced else "")
+    )
+    return cursor.lastrowid
+
+
+def claim_sheets_write(con):
+    """
+    This function will claim the oldest write that is due and whose sheet no other drainer is writing
+    :param con: the connection to the journal
+    :return: tuple of the entry row or None
+    """
+    now = time.time()
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        con.execute(
+            "UPDATE writes SET status = 'pending' WHERE status = 'running' AND claimed_at < ?",
+            (now - write_behind_claim_timeout_seconds,),
+        )
+        row = con.execute(
+            "SELECT id, book, sheet, frame_path, kwargs, attempts FROM writes AS w "
+            "WHERE status = 'pending' AND next_attempt <= ? AND NOT EXISTS ("
+            "SELECT 1 FROM writes WHERE book = w.book AND sheet = w.sheet AND status = 'running') "
+            "ORDER BY id LIMIT 1",
+            (now,),
+        ).fetchone()
+        if row is not None:
+            con.execute(
+                "UPDATE writes SET status = 'running', claimed_by = ?, claimed_at = ? WHERE id = ?",
+                (f"{socket.gethostname()}:{os.getpid()}", now, row[0]),
+            )
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    return row
+
+
+def send_sheets_write(con, row):
+    """
+    This function will send a claimed write with WriteToSheets, on failure it waits in the journal with backoff
+    unless a newer write to the sheet replaced it meanwhile, a fatal error like a bad request, a frame or kwargs
+    that cant be read or used, or write_behind_max_attempts failed attempts mark it failed and delete its frame,
+    the entry is kept with its last error
+    :param con: the connection to the journal
+    :param row: the entry row from claim_sheets_write
+    :return: whether the write was sent
+    """
+    id, bookName, sheetName, frame_path, kwargs, attempts = row
+    is_loaded = False
+    try:
+        df = read_frame_file(frame_path)
+        dict_kwargs = json.loads(kwargs)
+        is_loaded = True
+        # the journal does the backing off between attempts
+        WriteToSheets(bookName, sheetName, df, retries=1, **dict_kwargs)
+    except Exception as e:
+        # the write may have partly reached the sheet, so the cached frame is no longer a delta baseline
+        RemoveFromSheetsCache(bookName, sheetName)
+        # the retry engine wraps the error of the request, classify the error at the root of the chain
+        cause = get_root_error(e)
+        error_class = classify_google_error(cause)
+        attempts += 1
+        if not is_loaded or isinstance(cause, TypeError):
+            # a missing or corrupt frame and kwargs WriteToSheets doesnt take fail the same way every attempt
+            error_class = "fatal"
+        elif error_class == "fatal" and not isinstance(cause, HttpError):
+            # like an open circuit breaker, only google rejecting the request gives the write up
+            error_class = "transient"
+        if attempts >= write_behind_max_attempts:
+            error_class = "fatal"
+        delay_seconds = min(
+            write_behind_max_delay_seconds,
+            write_behind_base_delay_seconds * 2 ** (attempts - 1),
+        ) * random.uniform(0.5, 1)
+
+        con.execute("BEGIN IMMEDIATE")
+        is_replaced = con.execute(
+            "SELECT 1 FROM writes WHERE book = ? AND sheet = ? AND status = 'pending' AND id > ?",
+            (bookName, sheetName, id),
+        ).fetchone()
+        if is_replaced:
+            con.execute("DELETE FROM writes WHERE id = ?", (id,))
+        else:
+            con.execute(
+                "UPDATE writes SET status = ?, attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?",
+                (
+                    "failed" if error_class == "fatal" else "pending",
+                    attempts,
+                    time.time() + delay_seconds,
+                    repr(cause),
+                    id,
+                ),
+            )
+        con.execute("COMMIT")
+
+        if is_replaced:
+            remove_journal_frames([frame_path])
+            outcome = "a newer write replaced it"
+        elif error_class == "fatal":
+            remove_journal_frames([frame_path])
+            outcome = "giving up"
+        else:
+            outcome = f"retrying in {delay_seconds:.0f} seconds"
+        print_logger(
+            f"Failed journaled write {id} to {bookName} - {sheetName} on attempt {attempts} with {error_class} error: {cause}, {outcome}"
+        )
+        return False
+
+    con.execute("DELETE FROM writes WHERE id = ?", (id,))
+    remove_journal_frames([frame_path])
+    return True
+
+
+def drain_sheets_write_journal(max_seconds=None):
+    """
+    This function will send the journaled writes that are due, oldest first
+    :param max_seconds: stop claiming writes after this long, None to drain every write that is due
+    :return: the number of writes attempted
+    """
+    start_time = time.time()
+    attempted = 0
+    con = get_sheets_write_journal_connection()
+    try:
+        while max_seconds is None or time.time() - start_time < max_seconds:
+            row = claim_sheets_write(con)
+            if row is None:
+                break
+            send_sheets_write(con, row)
+            attempted += 1
+    finally:
+        con.close()
+    return attempted
+
+
+def run_sheets_write_drainer(poll_seconds=write_behind_poll_seconds, stop_event=None):
+    """
+    This function will drain the journal until stopped, for the drainer thread or a long running process like
+    python -c "from utils.google_tools import run_sheets_write_drainer; run_sheets_write_drainer()"
+    :param poll_seconds: the wait between looks at the journal when nothing is due
+    :param stop_event: threading.Event stopping the loop once nothing is due, None to run forever
+    :return: None
+    """
+    stop_event = stop_event or threading.Event()
+    while True:
+        try:
+            attempted = drain_sheets_write_journal()
+        except Exception as e:
+            print_logger(f"Error draining the sheets write journal because {e}")
+            attempted = 0
+        if stop_event.is_set() and attempted == 0:
+            return
+        if attempted == 0:
+            stop_event.wait(poll_seconds)
 
-loc_sheets_output_cache = os.path.join(data_dir, "sheets_output_cache")
 
+def run_sheets_write_drainer_thread(stop_event):
+    """
+    This function will drain the journal with a client and handles of the drainer thread's own, httplib2 connections
+    cant be shared with the thread the script runs in
+    :param stop_event: threading.Event stopping the drainer once nothing is due
+    :return: None
+    """
+    try:
+        gc.use_thread_client()
+    except Exception as e:
+        print_logger(f"Error authorizing the sheets write drainer because {e}")
+        return
+    dict_connected_books.use_thread_entries()
+    dict_connected_sheets.use_thread_entries()
+    run_sheets_write_drainer(stop_event=stop_event)
 
-def WriteToSheetsCache(bookName, sheetName, df, indexes):
-    write_folder = os.path.join(loc_sheets_output_cache, bookName)
 
-    os.makedirs(write_folder, 0o755, exist_ok=True)
-    # remove characters that windows cant have from filename
-    sheetName = (
-        sheetName.replace("/", " ")
-        .replace(":", "")
-        .replace("?", "")
-        .replace("&", "and")
-    )
-    df.to_csv(os.path.join(write_folder, sheetName + ".done.csv"), index=indexes)
+def start_sheets_write_drainer():
+    """
+    This function will start the drainer thread of this process once, at exit the script waits up to
+    write_behind_exit_drain_seconds for it to send the writes that are due, the rest stay in the journal
+    for the next drainer
+    :return: the thread
+    """
+    global sheets_write_drainer
+
+    with sheets_write_drainer_lock:
+        if sheets_write_drainer is None or not sheets_write_drainer.is_alive():
+            sheets_write_drainer_stop.clear()
+            sheets_write_drainer = threading.Thread(
+                target=run_sheets_write_drainer_thread,
+                kwargs={"stop_event": sheets_write_drainer_stop},
+                name="sheets_write_drainer",
+                daemon=True,
+            )
+            sheets_write_drainer.start()
+        return sheets_write_drainer
 
 
-dict_connected_books = {}
-dict_connected_sheets = {}
+def stop_sheets_write_drainer(timeout=write_behind_exit_drain_seconds):
+    """
+    This function will let the drainer thread finish the writes that are due and wait for it
+    :param timeout: the longest wait in seconds
+    :return: whether the drainer finished in time
+    """
+    with sheets_write_drainer_lock:
+        thread = sheets_write_drainer
+    if thread is None:
+        return True
+    sheets_write_drainer_stop.set()
+    thread.join(timeout)
+    if thread.is_alive():
+        print_logger(
+            f"Sheets write drainer still busy after {timeout} seconds, leaving the rest of the journal for the next drainer"
+        )
+    return not thread.is_alive()
 
 
-def get_book_from_id(id, retry=True):
-    global dict_connected_books
+atexit.register(stop_sheets_write_drainer)
 
-    if id in dict_connected_books.keys():
-        Workbook = dict_connected_books[id]
-        print_logger(f"Using cached connection to {id}")
-        return Workbook
 
+def get_sheets_write_journal():
+    """
+    This function will list the writes waiting in the journal
+    :return: dataframe with a row per write and its status, attempts, next attempt and last error
+    """
+    con = get_sheets_write_journal_connection()
     try:
-        book_from_id = gc.open_by_key(id)
-        dict_connected_books[id] = book_from_id
-        print_logger(f"Opening new connection to {id}")
-        return book_from_id
-    except TransportError as e:
-        print_logger(
-            f"Error opening connection to {id}, Trying again in 5 seconds, error: {e}"
+        df = pd.read_sql_query(
+            "SELECT id, book, sheet, status, attempts, created, next_attempt, claimed_by, last_error "
+            "FROM writes ORDER BY id",
+            con,
         )
-        if retry:
-            time.sleep(30)
-            return get_book_from_id(id, retry=False)
-        else:
-            print_logger("Failed to connect to Google Sheets even after retrying")
-            raise Exception(
-                f"Failed to connect to Google Sheets even after retrying because of TransportError {e}"
-            )
-    except HttpError as e:
-        if e.resp.status == 429:
-            print_logger(
-                f"Error HttpError 429, rate limited, opening connection to {id}, Trying again in 20 seconds, error: {e}"
-            )
-            if retry:
-                time.sleep(20)
-                return get_book_from_id(id, retry=False)
-            else:
-                print_logger(
-                    f"Failed to connect to Google Sheets even after retrying because of HttpError 429: {e}"
-                )
-                raise Exception(
-                    f"Failed to connect to Google Sheets even after retrying because of HttpError 429: {e}"
-                )
-        elif e.resp.status == 500:
-            print_logger(
-                f"Error HttpError 500, internal server error, opening connection to {id}, Trying again in 120 seconds, error: {e}"
-            )
-            if retry:
-                time.sleep(120)
-                return get_book_from_id(id, retry=False)
-            else:
-                print_logger(
-                    f"Failed to connect to Google Sheets even after retrying because of HttpError 500: {e}"
-                )
-                raise Exception(
-                    f"Failed to connect to Google Sheets even after retrying because of HttpError 500: {e}"
-                )
-        elif e.resp.status == 503:
-            print_logger(
-                f"Error HttpError 503, internal server error, opening connection to {id}, Trying again in 120 seconds, error: {e}"
-            )
-            if retry:
-                time.sleep(120)
-                return get_book_from_id(id, retry=False)
-            else:
-                print_logger(
-                    f"Failed to connect to Google Sheets even after retrying because of HttpError 503: {e}"
-                )
-                raise Exception(
-                    f"Failed to connect to Google Sheets even after retrying because of HttpError 503: {e}"
-                )
-        elif e.resp.status == 404:
-            print_logger(
-                f"HttpError 404 opening connection to {id}, Trying again in 5 seconds, error: {e}"
-            )
-            if retry:
-                time.sleep(5)
-                return get_book_from_id(id, retry=False)
-            else:
-                print_logger(
-                    f"Failed to connect to Google Sheets even after retrying because of HttpError 404: {e}"
-                )
-                raise Exception(
-                    f"Failed to connect to Google Sheets even after retrying because of HttpError 404: {e}"
-                )
+    finally:
+        con.close()
+    for column in ["created", "next_attempt"]:
+        df[column] = pd.to_datetime(df[column], unit="s")
+    return df
 
-        else:
-            raise Exception(
-                f"Failed to connect to Google Sheets because of other HttpError {e}"
-            )
 
+# %%
+## Streaming and Batched Reads ##
 
-dict_hardcoded_book_ids = json.load(
-    open(os.path.join(file_dir, "google_sheet_ids.json"))
-)
 
+default_rows_per_chunk = 10_000
 
-def get_book(bookName, retry=True):
-    global dict_connected_books
 
-    if bookName in dict_hardcoded_book_ids.keys():
-        print_logger(
-            f"Book {bookName} in hardcoded book ids, using id: {dict_hardcoded_book_ids[bookName]}"
-        )
-        return get_book_from_id(dict_hardcoded_book_ids[bookName])
-    else:
-        print_logger(
-            f"Book {bookName} not in hardcoded book ids, trying to open by name"
-        )
+def numerize_df_columns(df, ls_columns=None):
+    """
+    This function will convert every column of a chunk whose non blank values all parse as numbers to a numeric column,
+    so each chunk comes back typed without a python level pass over every cell
+    :param df: a dataframe of strings as returned by the values api
+    :param ls_columns: the columns to convert, None for every column
+    :return: the dataframe with numeric columns converted, blanks become nan
+    """
+    for col in df.columns if ls_columns is None else ls_columns:
+        ser = df[col]
+        if not (ser.dtype == object or pd.api.types.is_string_dtype(ser.dtype)):
+            continue
+        ser_blank = ser.isna() | (ser.astype(str).str.strip() == "")
+        if ser_blank.all():
+            continue
+        ser_num = pd.to_numeric(ser.where(~ser_blank), errors="coerce")
+        if ser_num[~ser_blank].notna().all():
+            df[col] = ser_num
 
-    if bookName in dict_connected_books.keys():
-        Workbook = dict_connected_books[bookName]
-        print_logger(f"Using cached connection to {bookName}")
-        return Workbook
-    else:
-        try:
-            print_logger(f"Opening new connection to {bookName}")
-            Workbook = gc.open(bookName)
+    return df
 
-            # print out what should add
-            workbook_id_to_add_to_dict = Workbook.id
-            print_logger(
-                f'Consider adding this to dict hardcoded book ids: "{bookName}": "{workbook_id_to_add_to_dict}"'
-            )
-            # write to file what should add
-            with open(
-                os.path.join(data_dir, "dict_hardcoded_book_ids_to_add.txt"), "a"
-            ) as f:
-                f.write(f'"{bookName}": "{workbook_id_to_add_to_dict}"\n')
 
-            dict_connected_books[bookName] = Workbook
-            return Workbook
-        except TransportError as e:
-            print_logger(
-                f"Error opening connection to {bookName}, Trying again in 5 seconds, error: {e}"
-            )
-            time.sleep(5)
-            if retry:
-                return get_book(bookName, retry=False)
-            else:
-                print_logger("Failed to connect to Google Sheets even after retrying")
-                raise e
-        except HttpError as e:
-            if e.resp.status == 429:
-                print_logger(
-                    f"Error HttpError 429, rate limited, opening connection to {bookName}, Trying again in 20 seconds, error: {e}"
-                )
-                time.sleep(20)
-                if retry:
-                    return get_book(bookName, retry=False)
-                else:
-                    print_logger(
-                        "Failed to connect to Google Sheets even after retrying"
-                    )
-                    raise e
-            else:
-                raise e
+# day 0 of the serial numbers google sheets uses for dates and times
+sheets_serial_epoch = pd.Timestamp("1899-12-30")
 
 
-def get_book_sheet(bookName, sheetName):
+def convert_sheet_column(ser, dtype):
     """
-    This function will return a Worksheet object from a google sheet using the ss name and the sheet name, will return a cached connection if it exists
-    :param bookName: the name of the google sheet
-    :param sheetName: the name of the sheet within the google spreadsheet
-    :return: a Worksheet object
+    This function will convert a column read with UNFORMATTED_VALUE to a dtype in one vectorized step
+    :param ser: the column, numbers as numbers and blanks as ""
+    :param dtype: one of "float64", "int64", "datetime64", "category", "string" or "bool"
+    :return: the converted column, blanks become missing values
     """
-    global dict_connected_sheets
-
-    if f"{bookName} : {sheetName}" in dict_connected_sheets.keys():
-        Worksheet = dict_connected_sheets[f"{bookName} : {sheetName}"]
-        print_logger(f"Using cached connection to {bookName} : {sheetName}")
-        return Worksheet
-    else:
-        Workbook = get_book(bookName)
-        Worksheet = Workbook.worksheet_by_title(sheetName)
-        dict_connected_sheets[f"{bookName} : {sheetName}"] = Worksheet
-        print_logger(f"Opening new connection to {bookName} : {sheetName}")
-        return Worksheet
+    ser = ser.where(~(ser.isna() | ser.eq("")))
+
+    if dtype in ["float64", "int64"]:
+        ser_num = pd.to_numeric(ser, errors="coerce")
+        if dtype == "float64":
+            return ser_num.astype("float64")
+        # a column with blanks cant be int64, so it gets the nullable integer dtype
+        return ser_num.astype("Int64" if ser_num.isna().any() else "int64")
+    if dtype == "datetime64":
+        ser_num = pd.to_numeric(ser, errors="coerce")
+        ser_serial = sheets_serial_epoch + pd.to_timedelta(
+            (ser_num * 86400).round(), unit="s"
+        )
+        # cells holding dates as text are parsed instead
+        ser_text = pd.to_datetime(ser.where(ser_num.isna()), errors="coerce")
+        return ser_serial.fillna(ser_text)
+    if dtype == "category":
+        return ser.astype("category")
+    if dtype == "string":
+        return ser.astype("string")
+    if dtype == "bool":
+        return ser.astype("boolean")
 
+    raise ValueError(f"Unknown sheet column dtype {dtype}")
 
-def get_book_sheet_df(
-    bookName,
-    sheetName,
-    start=None,
-    end=None,
-    index_column=None,
-    value_render="FORMATTED_VALUE",
-    numerize=True,
-    script_path="",
-    function_name="",
-):
 
-    workbook = get_book(bookName)
-    worksheet = get_book_sheet(bookName, sheetName)
+def convert_df_to_schema(df, dict_schema=None):
+    """
+    This function will convert the columns of a frame read with UNFORMATTED_VALUE to typed columns
+    :param df: the dataframe read with value_render="UNFORMATTED_VALUE" and numerize=False
+    :param dict_schema: dict of column name to dtype for convert_sheet_column,
+        columns not in it become numeric when every value is a number
+    :return: the dataframe with converted columns
+    """
+    dict_schema = dict_schema or {}
 
-    df = worksheet.get_as_df(
-        start=start,
-        end=end,
-        index_column=index_column,
-        value_render=value_render,
-        numerize=numerize,
-    )
+    ls_missing_columns = [col for col in dict_schema.keys() if col not in df.columns]
+    if ls_missing_columns:
+        raise KeyError(
+            f"Columns {ls_missing_columns} of the schema are not in the sheet"
+        )
 
-    log_data_pipeline(
-        script_path=script_path,
-        function_name=function_name,
-        input_output="input",
-        resource_type="google_sheet",
-        spreadsheet_id=workbook.id,
-        spreadsheet_name=bookName,
-        sheet_name=sheetName,
-        domo_table_name="",
-        domo_table_id="",
-        file_path="",
+    df = df.copy()
+    df = numerize_df_columns(
+        df, ls_columns=[col for col in df.columns if col not in dict_schema.keys()]
     )
+    for col, dtype in dict_schema.items():
+        df[col] = convert_sheet_column(df[col], dtype)
 
     return df
 
 
-def get_book_sheet_from_id_name(id, sheetName):
+def get_df_from_sheet_values(ls_rows, ls_header, index=None):
     """
-    This function will return a Worksheet object from a google sheet using the spreadsheet id and the sheet name, will return a cached connection if it exists
-    :param id: the id of the google spreadsheet
-    :param sheetName: the name of the sheet within the google spreadsheet
-    :return: a Worksheet object
+    This function will build a dataframe from rows returned by the values api, which drops trailing blank cells
+    :param ls_rows: list of rows of values
+    :param ls_header: list of column names, rows are padded or cut to its length
+    :param index: the index of the dataframe, None for a range index
+    :return: a dataframe with blank cells as ""
     """
-    global dict_connected_sheets
+    num_header_cols = len(ls_header)
+    ls_rows = [
+        (list(row) + [""] * (num_header_cols - len(row)))[:num_header_cols]
+        for row in ls_rows
+    ]
+    return pd.DataFrame(ls_rows, columns=ls_header, index=index)
 
-    if f"{id} : {sheetName}" in dict_connected_sheets.keys():
-        Worksheet = dict_connected_sheets[f"{id} : {sheetName}"]
-        print_logger(f"Using cached connection to {id} : {sheetName}")
-        return Worksheet
-    else:
-        Workbook = get_book_from_id(id)
-        Worksheet = Workbook.worksheet_by_title(sheetName)
-        dict_connected_sheets[f"{id} : {sheetName}"] = Worksheet
-        print_logger(f"Opening new connection to {id} : {sheetName}")
-        return Worksheet
+
+def get_sheet_grid_sizes(Workbook):
+    """
+    This function will get the current number of rows and columns of every sheet from the api instead of the cached handles
+    :param Workbook: the Spreadsheet object
+    :return: dictionary of sheet name to tuple of (row_count, column_count)
+    """
+    request = Workbook.client.sheet.service.spreadsheets().get(
+        spreadsheetId=Workbook.id,
+        fields="sheets.properties(title,gridProperties(rowCount,columnCount))",
+    )
+    response = call_with_retry(
+        f"get sheet sizes of {Workbook.id}",
+        execute_sheets_request,
+        Workbook.client,
+        request,
+        key=Workbook.id,
+    )
+    dict_grid_sizes = {}
+    for sheet in response.get("sheets", []):
+        properties = sheet["properties"]
+        grid = properties.get("gridProperties", {})
+        dict_grid_sizes[properties["title"]] = (
+            grid.get("rowCount", 0),
+            grid.get("columnCount", 0),
+        )
+    return dict_grid_sizes
 
 
-def get_book_sheet_df_from_id_name(
+def get_sheet_grid_size(Workbook, sheetName):
+    """
+    This function will get the current number of rows and columns of a sheet from the api instead of the cached handle
+    :param Workbook: the Spreadsheet object the sheet is in
+    :param sheetName: the name of the sheet
+    :return: tuple of (row_count, column_count)
+    """
+    dict_grid_sizes = get_sheet_grid_sizes(Workbook)
+    if sheetName not in dict_grid_sizes:
+        raise pygsheets.WorksheetNotFound(f"{sheetName} not found in {Workbook.id}")
+    return dict_grid_sizes[sheetName]
+
+
+def get_sheet_values_window(Workbook, range_name, value_render="FORMATTED_VALUE"):
+    """
+    This function will read one range of a sheet with a single values.get request
+    :param Workbook: the Spreadsheet object to read from
+    :param range_name: the range in A1 notation including the sheet title
+    :param value_render: the valueRenderOption of the request
+    :return: list of rows, trailing blank rows and cells are not returned by the api
+    """
+    request = (
+        Workbook.client.sheet.service.spreadsheets()
+        .values()
+        .get(
+            spreadsheetId=Workbook.id,
+            range=range_name,
+            majorDimension="ROWS",
+            valueRenderOption=value_render,
+            dateTimeRenderOption="SERIAL_NUMBER",
+        )
+    )
+    response = call_with_retry(
+        f"read {range_name} of {Workbook.id}",
+        execute_sheets_request,
+        Workbook.client,
+        request,
+        key=Workbook.id,
+    )
+    return response.get("values", [])
+
+
+def iter_sheet_chunks(
     id,
     sheetName,
-    start=None,
-    end=None,
-    index_column=None,
+    rows_per_chunk=default_rows_per_chunk,
     value_render="FORMATTED_VALUE",
     numerize=True,
+    dict_dtypes=None,
+    typed=False,
+    dict_schema=None,
+    prefetch=True,
     script_path="",
     function_name="",
 ):
+    """
+    This generator will read a sheet in windows of rows and yield each window as a dataframe,
+    the next window is downloaded while the caller processes the current one so memory stays bounded to two windows
+    :param id: the id of the google spreadsheet
+    :param sheetName: the name of the sheet within the google spreadsheet, the first row is used as the header
+    :param rows_per_chunk: the number of data rows in each yielded dataframe
+    :param value_render: the valueRenderOption of the reads
+    :param numerize: whether to convert columns whose values are all numbers to numeric columns in each chunk
+    :param dict_dtypes: optional dict of column name to dtype applied to every chunk, keeps dtypes stable across chunks
+    :param typed: whether to read unformatted values with serial number dates and convert each chunk with convert_df_to_schema
+    :param dict_schema: dict of column name to dtype for convert_df_to_schema when typed
+    :param prefetch: whether to download the next window in a background thread
+    :return: generator of dataframes, the index is the sheet row number
+    """
+    if typed:
+        value_render = "UNFORMATTED_VALUE"
+
+    Workbook = get_book_from_id(id)
+    num_rows, num_cols = get_sheet_grid_size(Workbook, sheetName)
+    last_col = format_addr((1, max(num_cols, 1)), output="label").rstrip("0123456789")
 
-    workbook = get_book_from_id(id)
-    worksheet = get_book_sheet_from_id_name(id, sheetName)
+    def get_range(first_row, last_row):
+        return f"{quote_sheet_name(sheetName)}!A{first_row}:{last_col}{last_row}"
 
-    df = worksheet.get_as_df(
-        start=start,
-        end=end,
-        index_column=index_column,
-        value_render=value_render,
-        numerize=numerize,
+    ls_header_rows = get_sheet_values_window(
+        Workbook, get_range(1, 1), value_render=value_render
     )
+    ls_header = [str(col) for col in ls_header_rows[0]] if ls_header_rows else []
+    ls_header = [
+        col if col != "" else f"Unnamed: {i}" for i, col in enumerate(ls_header)
+    ]
 
     log_data_pipeline(
         script_path=script_path,
@@ -383,224 +4443,552 @@ def get_book_sheet_df_from_id_name(
         input_output="input",
         resource_type="google_sheet",
         spreadsheet_id=id,
-        spreadsheet_name=workbook.title,
+        spreadsheet_name=Workbook.title,
         sheet_name=sheetName,
         domo_table_name="",
         domo_table_id="",
         file_path="",
     )
 
-    return df
+    if not ls_header or num_rows < 2:
+        return
 
+    def fetch(first_row):
+        last_row = min(first_row + rows_per_chunk - 1, num_rows)
+        return first_row, get_sheet_values_window(
+            Workbook, get_range(first_row, last_row), value_render=value_render
+        )
 
-def WriteToSheets(
-    bookName,
-    sheetName,
-    df,
-    indexes=False,
-    set_note=None,
-    retries=3,
+    def get_chunk_df(first_row, ls_rows):
+        df = get_df_from_sheet_values(
+            ls_rows,
+            ls_header,
+            index=pd.RangeIndex(first_row, first_row + len(ls_rows)),
+        )
+        if typed:
+            df = convert_df_to_schema(df, dict_schema)
+        elif numerize:
+            df = numerize_df_columns(df)
+        if dict_dtypes:
+            df = df.astype(dict_dtypes)
+        return df
+
+    ls_first_rows = list(range(2, num_rows + 1, rows_per_chunk))
+    executor = (
+        concurrent.futures.ThreadPoolExecutor(max_workers=1) if prefetch else None
+    )
+    try:
+        future = executor.submit(fetch, ls_first_rows[0]) if executor else None
+        for i, first_row in enumerate(ls_first_rows):
+            if executor:
+                first_row, ls_rows = future.result()
+                if i + 1 < len(ls_first_rows):
+                    future = executor.submit(fetch, ls_first_rows[i + 1])
+            else:
+                first_row, ls_rows = fetch(first_row)
+
+            if ls_rows:
+                yield get_chunk_df(first_row, ls_rows)
+    finally:
+        if executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def get_many_dfs(
+    spreadsheet_id,
+    ls_ranges,
+    value_render="FORMATTED_VALUE",
+    numerize=True,
+    typed=False,
+    ls_schemas=None,
     script_path="",
     function_name="",
 ):
     """
-    This function will write a dataframe to a google sheet, will create the sheet if it doesnt exist
-    :param bookName: the name of the google spreadsheet
-    :param sheetName: the name of the sheet within the google spreadsheet
-    :param df: the dataframe to write to the sheet
-    :param indexes: whether to write the index column to the sheet
-    :param set_note: the note to set on the sheet, None for no note, "DT" for date time, string for custom note
-    :param retries: the number of times to retry if the connection fails
-    :return: None
+    This function will read several ranges of a spreadsheet, from any of its tabs, in a single values.batchGet request
+    :param spreadsheet_id: the id of the google spreadsheet
+    :param ls_ranges: list of (sheet name, start, end) tuples, start and end like "A1" and "H10" or None for the whole tab,
+        a start without an end runs to the bottom right of the tab, the first row of each range is used as the header
+    :param value_render: the valueRenderOption of the read
+    :param numerize: whether to convert columns whose values are all numbers to numeric columns
+    :param typed: whether to read unformatted values with serial number dates and convert with convert_df_to_schema
+    :param ls_schemas: list of dict_schema for convert_df_to_schema in the order of ls_ranges when typed
+    :return: list of dataframes in the order of ls_ranges
     """
-
-    # global dict_connected_books
-    # global dict_connected_sheets
-
-    start_time = datetime.datetime.now()
-    print_logger(
-        f"Writing to Google Sheet: {bookName} - {sheetName} with size {df.shape}"
+    if typed:
+        value_render = "UNFORMATTED_VALUE"
+
+    Workbook = get_book_from_id(spreadsheet_id)
+
+    # "A2:" is not a range, so open ended ranges end at the corner of the grid, read in one request for every tab
+    dict_grid_sizes = {}
+    if any(start is not None and end is None for _, start, end in ls_ranges):
+        dict_grid_sizes = get_sheet_grid_sizes(Workbook)
+
+    ls_a1_ranges = []
+    for sheetName, start, end in ls_ranges:
+        sheet_title = quote_sheet_name(sheetName)
+        if start is None and end is None:
+            ls_a1_ranges.append(sheet_title)
+            continue
+        if end is None:
+            if sheetName not in dict_grid_sizes:
+                raise pygsheets.WorksheetNotFound(
+                    f"{sheetName} not found in {spreadsheet_id}"
+                )
+            num_rows, num_cols = dict_grid_sizes[sheetName]
+            end = format_addr((max(num_rows, 1), max(num_cols, 1)), output="label")
+        ls_a1_ranges.append(f"{sheet_title}!{start or 'A1'}:{end}")
+
+    request = (
+        Workbook.client.sheet.service.spreadsheets()
+        .values()
+        .batchGet(
+            spreadsheetId=spreadsheet_id,
+            ranges=ls_a1_ranges,
+            majorDimension="ROWS",
+            valueRenderOption=value_render,
+            dateTimeRenderOption="SERIAL_NUMBER",
+        )
     )
-    if isinstance(df, pd.Series):
-        print_logger(
-            "# Found a series when writing to sheets, converting to dataframe #"
+    response = call_with_retry(
+        f"read {len(ls_a1_ranges)} ranges of {spreadsheet_id}",
+        execute_sheets_request,
+        Workbook.client,
+        request,
+        key=spreadsheet_id,
+    )
+
+    ls_dfs = []
+    for i, value_range in enumerate(response.get("valueRanges", [])):
+        ls_values = value_range.get("values", [])
+        ls_header = list(ls_values[0]) if ls_values else []
+        df = get_df_from_sheet_values(ls_values[1:], ls_header)
+        if typed:
+            df = convert_df_to_schema(df, ls_schemas[i] if ls_schemas else None)
+        elif numerize:
+            df = numerize_df_columns(df)
+        ls_dfs.append(df)
+
+        log_data_pipeline(
+            script_path=script_path,
+            function_name=function_name,
+            input_output="input",
+            resource_type="google_sheet",
+            spreadsheet_id=spreadsheet_id,
+            spreadsheet_name=Workbook.title,
+            sheet_name=ls_ranges[i][0],
+            domo_table_name="",
+            domo_table_id="",
+            file_path="",
         )
-        df = df.reset_index()
 
-    WriteToSheetsCache(bookName, sheetName, df, indexes)
+    return ls_dfs
 
-    for i in range(retries):
-        try:
-            Workbook = get_book(bookName)
 
-            try:
-                Worksheet = get_book_sheet(bookName, sheetName)
-            except pygsheets.WorksheetNotFound:
-                Workbook.add_worksheet(sheetName)
-                Worksheet = get_book_sheet(bookName, sheetName)
+# %%
+## Workbook Export ##
 
-            if indexes == False:
-                Worksheet.set_dataframe(df, (1, 1), fit=True, nan="")
-            else:
-                Worksheet.set_dataframe(df, (1, 1), fit=True, nan="", copy_index=True)
-            try:
-                if set_note != None:
-                    if set_note == "DT":
-                        Worksheet.cell((1, 1)).note = "Data updated at: " + str(
-                            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        )
-                    else:
-                        Worksheet.cell((1, 1)).note = set_note
-            except Exception as e:
-                print_logger(
-                    f"Failed to set note when writing, error: {e}, trying one more time"
-                )
-                try:
-                    if set_note != None:
-                        if set_note == "DT":
-                            Worksheet.cell((1, 1)).note = "Data updated at: " + str(
-                                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                            )
-                        else:
-                            Worksheet.cell((1, 1)).note = set_note
-                except:
-                    pass
-                pass
-            print_logger(
-                f"Finished writing to Google Sheet: {bookName} - {sheetName} with size {df.shape}, after {datetime.datetime.now() - start_time}"
-            )
+xlsx_mime_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# drive refuses to export files over 10MB through the api, the export link of the sheets web app has no limit
+workbook_export_link = "https://docs.google.com/spreadsheets/d/{}/export?format=xlsx"
 
-            log_data_pipeline(
-                script_path=script_path,
-                function_name=function_name,
-                input_output="output",
-                resource_type="google_sheet",
-                spreadsheet_id=Workbook.id,
-                spreadsheet_name=bookName,
-                sheet_name=sheetName,
-                domo_table_name="",
-                domo_table_id="",
-                file_path="",
-            )
+loc_workbook_exports = os.path.join(data_dir, "workbook_exports")
+# exports this big have their tabs parsed in a process pool instead of one after another
+workbook_export_pool_min_bytes = 5 * 1024**2
 
-            return
-        except Exception as e:
-            print_logger(
-                f"Failed to write to sheets with name {bookName} and sheet name {sheetName} and df of size {df.shape}, error: {e}"
-            )
-            print_logger(f"Retrying {i+1} of {retries} times after {i * 20} seconds")
-            time.sleep(i * 20)
-            print_logger("Retrying now")
-            pass
 
-    print_logger(f"Failed to write to sheet after {retries} retries")
-    raise Exception(
-        f"Failed to write to sheets with name {bookName} and sheet name {sheetName} and df of size {df.shape}"
-    )
+def is_export_size_error(e):
+    if not isinstance(e, HttpError) or e.resp.status != 403:
+        return False
+    content = e.content.decode(errors="replace") if e.content else ""
+    return "exportSizeLimitExceeded" in content or "too large to be exported" in content
 
 
-def ClearSheet(book_name, sheet_name, start_range, end_range):
+def download_workbook_xlsx(spreadsheet_id, client=gc):
     """
-    This function will clear a range of cells on a sheet
-    :param book_name: the name of the google spreadsheet
-    :param sheet_name: the name of the sheet within the google spreadsheet
-    :param start_range: the start range of the cells to clear in the format "A1"
-    :param end_range: the end range of the cells to clear in the format "A1"
-    :return: None
+    This function will download a whole spreadsheet as an xlsx file in one request,
+    through the drive export api or the export link when the file is over the api export limit
+    :param spreadsheet_id: the id of the google spreadsheet
+    :param client: the pygsheets client
+    :return: the xlsx file as bytes
     """
+    request = (
+        get_drive_service(client)
+        .files()
+        .export(fileId=spreadsheet_id, mimeType=xlsx_mime_type)
+    )
+    try:
+        return call_with_retry(
+            f"export {spreadsheet_id} as xlsx",
+            execute_drive_request,
+            client,
+            request,
+            key=spreadsheet_id,
+        )
+    except HttpError as e:
+        if not is_export_size_error(e):
+            raise
+        print_logger(
+            f"{spreadsheet_id} is over the drive export limit, downloading it from the export link"
+        )
 
-    Worksheet = get_book_sheet(book_name, sheet_name)
-    Worksheet.clear(start_range, end_range)
-
-
-def clear_range_of_sheet_obj(sheet_obj, start, end, retries=3):
-    """
-    This function will clear a range of cells on a sheet
-    :param sheet_obj: the sheet object to write to
-    :param start: the start range of the cells to clear in the format "A1"
-    :param end: the end range of the cells to clear in the format "A1"
-    :return: None
-    """
+    # an HttpRequest so the download goes through the rate limiter and metrics like the api requests
+    request = googleapiclient.http.HttpRequest(
+        get_thread_http(client),
+        lambda resp, content: content,
+        workbook_export_link.format(spreadsheet_id),
+        method="GET",
+    )
+    return call_with_retry(
+        f"download {spreadsheet_id} from the export link",
+        execute_drive_request,
+        client,
+        request,
+        key=spreadsheet_id,
+    )
 
-    for i in range(retries):
-        try:
-            sheet_obj.clear(start, end)
-            return
-        except Exception as e:
-            print_logger(f"Failed to clear range, error: {e}")
-            print_logger(f"Retrying {i+1} of {retries} times after {i * 20} seconds")
-            time.sleep(i * 10)
-            print_logger("Retrying now")
-            pass
 
-    print_logger(f"Failed to clear range after {retries} retries")
-    raise Exception(f"Failed to clear range after {retries} retries")
+def get_worksheet_df(worksheet, range_string=None):
+    """
+    This function will read one tab of an xlsx file opened with openpyxl as a dataframe, streaming its rows
+    :param worksheet: the openpyxl worksheet, read only workbooks stream it without holding every cell
+    :param range_string: the range like "A1:D10" or "B:E" without the sheet title, None for the whole tab,
+        the first row of the range is used as the header
+    :return: dataframe with blank cells as "" like get_many_dfs
+    """
+    dict_bounds = {}
+    if range_string is not None:
+        dict_grid_range = get_grid_range(0, range_string)
+        dict_bounds = {
+            "min_row": dict_grid_range.get("startRowIndex", 0) + 1,
+            "max_row": dict_grid_range.get("endRowIndex"),
+            "min_col": dict_grid_range.get("startColumnIndex", 0) + 1,
+            "max_col": dict_grid_range.get("endColumnIndex"),
+        }
+
+    ls_rows = []
+    for row in worksheet.iter_rows(values_only=True, **dict_bounds):
+        # like the values api, trailing blank cells and rows are left out
+        row = list(row)
+        while row and row[-1] is None:
+            row.pop()
+        ls_rows.append(row)
+    while ls_rows and not ls_rows[-1]:
+        ls_rows.pop()
+    if not ls_rows:
+        return pd.DataFrame()
+
+    ls_header = ["" if value is None else str(value) for value in ls_rows[0]]
+    ls_rows = [["" if value is None else value for value in row] for row in ls_rows[1:]]
+    return get_df_from_sheet_values(ls_rows, ls_header)
+
+
+def parse_workbook_sheet(loc_xlsx, sheetName, range_string=None):
+    """
+    This function will read one tab of an xlsx file as a dataframe, module level so a process pool can run it
+    :param loc_xlsx: the path of the xlsx file
+    :param sheetName: the name of the tab
+    :param range_string: the range of the tab to read, None for the whole tab
+    :return: dataframe
+    """
+    workbook = openpyxl.load_workbook(loc_xlsx, read_only=True, data_only=True)
+    try:
+        return get_worksheet_df(workbook[sheetName], range_string)
+    finally:
+        workbook.close()
 
 
-def write_df_to_range_of_sheet_obj(
-    sheet_obj,
-    df,
-    start,
-    fit,
-    nan="",
-    copy_head=False,
-    retries=3,
+def get_workbook_dfs(
+    spreadsheet_id,
+    ls_sheet_names=None,
+    dict_sheet_ranges=None,
+    numerize=True,
+    max_workers=None,
+    script_path="",
+    function_name="",
 ):
     """
-    This function will write a dataframe to a range on a sheet
-    :param sheet_obj: the sheet object to write to
-    :param df: the dataframe to write to the sheet
-    :param start: the start range of the cells to clear in the format "A1"
-    :param fit: whether to fit the dataframe to the range
-    :param nan: the value to use for nan
-    :param copy_head: whether to copy the header
-    :return: None
+    This function will read every tab of a spreadsheet from a single xlsx export instead of a request per tab,
+    dates come back as datetimes and formulas as their values when google last calculated them
+    :param spreadsheet_id: the id of the google spreadsheet
+    :param ls_sheet_names: list of the names of the tabs to read, None for every tab
+    :param dict_sheet_ranges: dictionary of tab name to a range like "A1:D10" to read instead of the whole tab,
+        its tabs are read even when not in ls_sheet_names
+    :param numerize: whether to convert columns whose values are all numbers to numeric columns
+    :param max_workers: the number of processes parsing the tabs of exports of at least workbook_export_pool_min_bytes,
+        1 to always parse in this process, None for one per tab up to the number of cpus
+    :return: dictionary of tab name to dataframe in the order of the tabs in the spreadsheet
     """
+    dict_sheet_ranges = dict_sheet_ranges or {}
+    content = download_workbook_xlsx(spreadsheet_id)
 
-    for i in range(retries):
-
-        try:
-            sheet_obj.set_dataframe(
-                df=df, start=start, fit=fit, nan=nan, copy_head=copy_head
-            )
-            return
-        except Exception as e:
-            print_logger(
-                f"Failed to write to range with error: {e}, retrying {i+1} of {retries} times"
+    workbook = openpyxl.load_workbook(
+        io.BytesIO(content), read_only=True, data_only=True
+    )
+    try:
+        ls_workbook_sheet_names = workbook.sheetnames
+        if ls_sheet_names is None and not dict_sheet_ranges:
+            ls_sheet_names = ls_workbook_sheet_names
+        set_sheet_names = set(ls_sheet_names or []) | set(dict_sheet_ranges)
+        ls_missing = [
+            name for name in set_sheet_names if name not in ls_workbook_sheet_names
+        ]
+        if ls_missing:
+            raise pygsheets.WorksheetNotFound(
+                f"{', '.join(ls_missing)} not found in {spreadsheet_id}"
             )
-            time.sleep(i * 10)
-            pass
+        ls_sheet_names = [
+            name for name in ls_workbook_sheet_names if name in set_sheet_names
+        ]
+
+        if max_workers is None:
+            max_workers = min(len(ls_sheet_names), os.cpu_count() or 1)
+        use_pool = max_workers > 1 and len(content) >= workbook_export_pool_min_bytes
+        if not use_pool:
+            ls_dfs = [
+                get_worksheet_df(workbook[sheetName], dict_sheet_ranges.get(sheetName))
+                for sheetName in ls_sheet_names
+            ]
+    finally:
+        workbook.close()
+
+    if use_pool:
+        # the workers read the file from disk instead of each being sent the bytes
+        os.makedirs(loc_workbook_exports, exist_ok=True)
+        loc_export = os.path.join(
+            loc_workbook_exports,
+            f"{spreadsheet_id}_{os.getpid()}_{threading.get_ident()}.xlsx",
+        )
+        with open(loc_export, "wb") as f:
+            f.write(content)
+        try:
+            # spawned workers start clean instead of forking the locks, threads and connections of this process
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                ls_futures = [
+                    executor.submit(
+                        parse_workbook_sheet,
+                        loc_export,
+                        sheetName,
+                        dict_sheet_ranges.get(sheetName),
+                    )
+                    for sheetName in ls_sheet_names
+                ]
+                ls_dfs = [future.result() for future in ls_futures]
+        finally:
+            os.remove(loc_export)
+
+    # the name for the pipeline log is one drive field, not the whole spreadsheet resource of get_book_from_id
+    Workbook = dict_connected_books.get(spreadsheet_id)
+    if Workbook is not None:
+        spreadsheet_name = Workbook.title
+    else:
+        spreadsheet_name = get_drive_file_metadata(spreadsheet_id, fields="name")[
+            "name"
+        ]
+
+    dict_dfs = {}
+    for sheetName, df in zip(ls_sheet_names, ls_dfs):
+        dict_dfs[sheetName] = numerize_df_columns(df) if numerize else df
+
+        log_data_pipeline(
+            script_path=script_path,
+            function_name=function_name,
+            input_output="input",
+            resource_type="google_sheet",
+            spreadsheet_id=spreadsheet_id,
+            spreadsheet_name=spreadsheet_name,
+            sheet_name=sheetName,
+            domo_table_name="",
+            domo_table_id="",
+            file_path="",
+        )
 
-    print_logger(f"Failed to write to range after {retries} retries")
-    raise Exception(f"Failed to write to range with error: {e}")
+    return dict_dfs
 
 
 # %%
 ## Entire Sheet Operations ##
 
 
-def copy_sheet_book_to_book(source_book, ls_source_sheets, ls_dest_books):
-    Workbook_src = gc.open(source_book)
-    src_book_id = Workbook_src.id
+def get_sheet_properties(Workbook):
+    """
+    This function will get the current properties of every tab of a spreadsheet from the api instead of the cached handle
+    :param Workbook: the Spreadsheet object
+    :return: list of the sheet properties dictionaries
+    """
+    request = Workbook.client.sheet.service.spreadsheets().get(
+        spreadsheetId=Workbook.id, fields="sheets.properties(sheetId,title,index)"
+    )
+    response = call_with_retry(
+        f"get sheet properties of {Workbook.id}",
+        execute_sheets_request,
+        Workbook.client,
+        request,
+        key=Workbook.id,
+    )
+    return [sheet["properties"] for sheet in response.get("sheets", [])]
+
 
-    for dest_book in ls_dest_books:
+def copy_sheets_to_book(Workbook_src, dict_source_sheet_ids, Workbook_dest):
+    """
+    This function will copy tabs into a spreadsheet with one copyTo per tab, then replace the tabs of the same names
+    and rename the copies in a single batchUpdate, the copies keep the position of the tabs they replace,
+    if any step fails the copies already made are deleted so no "Copy of" tabs are left behind
+    :param Workbook_src: the Spreadsheet object to copy from
+    :param dict_source_sheet_ids: dict of source sheet name to sheet id
+    :param Workbook_dest: the Spreadsheet object to copy to, opened by the caller since handles are not thread safe
+    :return: the id of the destination spreadsheet
+    """
+    dict_existing_sheets = {
+        properties["title"]: properties
+        for properties in get_sheet_properties(Workbook_dest)
+    }
+
+    ls_copy_sheet_ids = []
+    ls_requests = []
+    try:
+        for source_sheet, src_sheet_id in dict_source_sheet_ids.items():
+            request = (
+                Workbook_src.client.sheet.service.spreadsheets()
+                .sheets()
+                .copyTo(
+                    spreadsheetId=Workbook_src.id,
+                    sheetId=src_sheet_id,
+                    body={"destinationSpreadsheetId": Workbook_dest.id},
+                )
+            )
+            dict_copy = call_with_retry(
+                f"copy {Workbook_src.title} : {source_sheet} to {Workbook_dest.title}",
+                execute_sheets_request,
+                Workbook_src.client,
+                request,
+                key=Workbook_dest.id,
+            )
+            ls_copy_sheet_ids.append(dict_copy["sheetId"])
+
+            dict_properties = {"sheetId": dict_copy["sheetId"], "title": source_sheet}
+            if source_sheet in dict_existing_sheets:
+                ls_requests.append(
+                    {
+                        "deleteSheet": {
+                            "sheetId": dict_existing_sheets[source_sheet]["sheetId"]
+                        }
+                    }
+                )
+                dict_properties["index"] = dict_existing_sheets[source_sheet]["index"]
+            ls_requests.append(
+                {
+                    "updateSheetProperties": {
+                        "properties": dict_properties,
+                        "fields": ",".join(
+                            key for key in dict_properties if key != "sheetId"
+                        ),
+                    }
+                }
+            )
 
-        for source_sheet in ls_source_sheets:
+        call_with_retry(
+            f"replace {len(dict_source_sheet_ids)} sheets in {Workbook_dest.title}",
+            spreadsheets_batch_update,
+            Workbook_dest,
+            ls_requests,
+            key=Workbook_dest.id,
+        )
+    except Exception:
+        # the batchUpdate is atomic, so after any failure the copies are still named "Copy of ..."
+        if ls_copy_sheet_ids:
+            try:
+                call_with_retry(
+                    f"delete {len(ls_copy_sheet_ids)} partial copies in {Workbook_dest.title}",
+                    spreadsheets_batch_update,
+                    Workbook_dest,
+                    [
+                        {"deleteSheet": {"sheetId": sheet_id}}
+                        for sheet_id in ls_copy_sheet_ids
+                    ],
+                    key=Workbook_dest.id,
+                )
+            except Exception as e:
+                print_logger(
+                    f"Failed to delete partial copies {ls_copy_sheet_ids} in {Workbook_dest.title}, error: {e}"
+                )
+        raise
+    finally:
+        # tabs were added and deleted, so the cached connections no longer match the book
+        invalidate_spreadsheet_handles(Workbook_dest.id)
 
-            sheet_src = Workbook_src.worksheet_by_title(source_sheet)
-            src_sheet_id = sheet_src.id
-            src_tup = (src_book_id, src_sheet_id)
+    return Workbook_dest.id
 
-            Workbook_dest = gc.open(dest_book)
 
+def copy_sheet_book_to_book(
+    source_book, ls_source_sheets, ls_dest_books, max_workers=4, raise_errors=True
+):
+    """
+    This function will copy tabs of a spreadsheet to many spreadsheets, replacing tabs of the same names,
+    destinations run in parallel and every request still waits for the shared rate limiter
+    :param source_book: the name of the spreadsheet to copy from
+    :param ls_source_sheets: list of the names of the tabs to copy
+    :param ls_dest_books: list of the names of the spreadsheets to copy to
+    :param max_workers: the number of destinations copied at the same time
+    :param raise_errors: whether to raise after all destinations ran if any of them failed
+    :return: dict of destination name to dict with "status", "error" and "spreadsheet_id"
+    """
+    Workbook_src = get_book(source_book)
+    dict_source_sheet_ids = {
+        source_sheet: get_book_sheet_from_id_name(Workbook_src.id, source_sheet).id
+        for source_sheet in ls_source_sheets
+    }
+
+    dict_results = {
+        dest_book: {"status": "ok", "error": None, "spreadsheet_id": None}
+        for dest_book in ls_dest_books
+    }
+
+    # the destinations are opened here, the workers only send requests on the http of their own thread
+    dict_dest_workbooks = {}
+    for dest_book in ls_dest_books:
+        try:
+            dict_dest_workbooks[dest_book] = get_book(dest_book)
+        except Exception as e:
+            print_logger(f"Failed to open {dest_book}, error: {e}")
+            dict_results[dest_book]["status"] = "failed"
+            dict_results[dest_book]["error"] = str(e)
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(max_workers, len(dict_dest_workbooks)))
+    ) as executor:
+        dict_futures = {
+            executor.submit(
+                copy_sheets_to_book, Workbook_src, dict_source_sheet_ids, Workbook_dest
+            ): dest_book
+            for dest_book, Workbook_dest in dict_dest_workbooks.items()
+        }
+        for future in concurrent.futures.as_completed(dict_futures):
+            dest_book = dict_futures[future]
             try:
-                Workbook_dest.del_worksheet(
-                    Workbook_dest.worksheet_by_title(source_sheet)
+                dict_results[dest_book]["spreadsheet_id"] = future.result()
+                print_logger(f"Copied {ls_source_sheets} to {dest_book}")
+            except Exception as e:
+                print_logger(
+                    f"Failed to copy {ls_source_sheets} to {dest_book}, error: {e}"
                 )
-            except:
-                pass
+                dict_results[dest_book]["status"] = "failed"
+                dict_results[dest_book]["error"] = str(e)
+
+    ls_failed = [
+        dest_book
+        for dest_book, dict_result in dict_results.items()
+        if dict_result["status"] == "failed"
+    ]
+    if ls_failed and raise_errors:
+        raise Exception(
+            f"Failed to copy {ls_source_sheets} from {source_book} to {ls_failed}"
+        )
 
-            Workbook_dest.add_worksheet(source_sheet, src_tuple=src_tup)
+    return dict_results
 
 
 # %%
@@ -641,63 +5029,260 @@ def get_google_authentication():
     return gauth
 
 
+google_drive_oauth = LazyGoogleClient(
+    "pydrive oauth", lambda: GoogleDrive(get_google_authentication())
+)
+
+
 def get_google_drive_obj():
-    drive = GoogleDrive(get_google_authentication())
-    return drive
+    return google_drive_oauth.get()
+
+
+def authorize_thread_google_drive():
+    """
+    This function will build a pydrive client on the credentials of google_drive_oauth with an http connection of its
+    own, for a thread of a pool, httplib2 connections can not be shared between threads but credentials can
+    :return: the GoogleDrive object
+    """
+    gauth = GoogleAuth()
+    gauth.credentials = get_google_drive_obj().auth.credentials
+    gauth.Authorize()
+    return GoogleDrive(gauth)
 
 
 def get_file_list_from_folder_id_oauth(folder_id):
-    parent_folder_files = (
-        get_google_drive_obj()
-        .ListFile({"q": f"'{folder_id}' in parents and trashed=false"})
-        .GetList()
+    def list_attempt():
+        acquire_api_token("drive")
+        return (
+            get_google_drive_obj()
+            .ListFile({"q": f"'{folder_id}' in parents and trashed=false"})
+            .GetList()
+        )
+
+    parent_folder_files = call_with_retry(
+        f"list files in folder {folder_id}", list_attempt
     )
 
     return parent_folder_files
 
 
-def get_book_id_from_parent_folder_id_oauth(parent_folder_id, book_name):
+def get_book_id_from_parent_folder_id_oauth(
+    parent_folder_id, book_name, use_mirror=False
+):
+    """
+    This function will find a file by name in a drive folder with the pydrive oauth credentials
+    :param parent_folder_id: the id of the folder
+    :param book_name: the name of the file
+    :param use_mirror: whether to look it up in the "oauth" drive mirror instead of listing the folder, the mirror
+        lists with the gc_oauth pygsheets credentials, which may be another account than pydrive with other files
+    :return: the id of the file, or None if there is none
+    """
 
     print(
         f"Getting sheet ID for book named {book_name} inside parent folder ID {parent_folder_id}"
     )
 
-    parent_folder_files = get_file_list_from_folder_id_oauth(parent_folder_id)
+    if use_mirror:
+        file_id = get_file_id_from_drive_mirror(
+            parent_folder_id, book_name, account="oauth"
+        )
+    else:
+        file_id = next(
+            (
+                file["id"]
+                for file in get_file_list_from_folder_id_oauth(parent_folder_id)
+                if file["title"] == book_name
+            ),
+            None,
+        )
+    if file_id is not None:
+        print(
+            f"Found sheet ID {file_id} for book named {book_name} inside parent folder ID {parent_folder_id}"
+        )
+    return file_id
+
+
+drive_folder_mime_type = "application/vnd.google-apps.folder"
+drive_shortcut_mime_type = "application/vnd.google-apps.shortcut"
+drive_file_fields = "id, name, mimeType, parents, modifiedTime, shortcutDetails"
+
 
-    for file in parent_folder_files:
-        if file["title"] == book_name:
-            file_id = file["id"]
-            print(
-                f"Found sheet ID {file_id} for book named {book_name} inside parent folder ID {parent_folder_id}"
+def list_drive_files(q, fields=drive_file_fields, client=gc):
+    """
+    This function will list every file matching a drive query, following nextPageToken through all pages
+    :param q: the drive v3 query
+    :param fields: the fields of each file to return
+    :param client: the pygsheets client whose drive service and credentials are used
+    :return: list of dictionaries of the files
+    """
+    ls_files = []
+    page_token = None
+    while True:
+        request = (
+            get_drive_service(client)
+            .files()
+            .list(
+                q=q,
+                fields=f"nextPageToken, files({fields})",
+                pageSize=1000,
+                pageToken=page_token,
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True,
             )
-            return file_id
+        )
+        response = call_with_retry(
+            f"list drive files matching {q}", execute_drive_request, client, request
+        )
+        ls_files.extend(response.get("files", []))
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return ls_files
 
 
-def get_file_list_from_folder_id(folder_id):
+def link_drive_tree_folder(file, dict_children):
+    """
+    This function will give a folder, or a shortcut to one, of a tree from walk_drive_folder its children list
+    :param file: the drive file dictionary
+    :param dict_children: dictionary of folder id to its children list, shared by every folder or shortcut pointing at it
+    :return: the id of the folder to list when it was not listed yet, else None
+    """
+    if file["mimeType"] == drive_folder_mime_type:
+        list_from_id = file["id"]
+    elif (
+        file["mimeType"] == drive_shortcut_mime_type
+        and file.get("shortcutDetails", {}).get("targetMimeType")
+        == drive_folder_mime_type
+    ):
+        list_from_id = file["shortcutDetails"]["targetId"]
+    else:
+        return None
 
-    # authenticate with the Google Drive API using your Pygsheets credentials
-    credentials = service_account.Credentials.from_service_account_file(
-        os.path.join(
-            os.path.expanduser("~"),
-            "credentials",
-            "team",
-            "gsheets_auth_service",
-            "service_account_credentials.json",
+    is_new = list_from_id not in dict_children
+    if is_new:
+        dict_children[list_from_id] = []
+    file["children"] = dict_children[list_from_id]
+    return list_from_id if is_new else None
+
+
+def walk_drive_folder(
+    folder_id, client=gc, max_workers=8, max_parents_per_query=20, max_depth=None
+):
+    """
+    This function will list a drive folder and all its subfolders, a level at a time with the listings of a level
+    spread over a thread pool and several folders listed per query, shortcuts to folders are followed once
+    :param folder_id: the id of the root folder
+    :param client: the pygsheets client whose drive service and credentials are used, gc_oauth for a personal drive
+    :param max_workers: the number of listings running at the same time
+    :param max_parents_per_query: the number of folders listed by one query
+    :param max_depth: the deepest level of subfolders to list, 0 lists only the root, None for all
+    :return: the root as a dictionary with "id" and "children", every child is a drive file dictionary and folders
+        have their own "children" list
+    """
+    dict_root = {"id": folder_id, "mimeType": drive_folder_mime_type, "children": []}
+    # one children list per listed folder id, shared by every folder or shortcut pointing at it
+    dict_children = {folder_id: dict_root["children"]}
+    ls_level_ids = [folder_id]
+    depth = 0
+
+    def list_children(ls_parent_ids):
+        q = " or ".join(f"'{parent_id}' in parents" for parent_id in ls_parent_ids)
+        ls_files = list_drive_files(f"({q}) and trashed=false", client=client)
+        return ls_parent_ids, ls_files
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while ls_level_ids and (max_depth is None or depth <= max_depth):
+            ls_futures = [
+                executor.submit(
+                    list_children, ls_level_ids[i : i + max_parents_per_query]
+                )
+                for i in range(0, len(ls_level_ids), max_parents_per_query)
+            ]
+
+            ls_level_ids = []
+            for future in concurrent.futures.as_completed(ls_futures):
+                ls_group_ids, ls_files = future.result()
+                for file in ls_files:
+                    for parent_id in file.get("parents", []):
+                        if parent_id in ls_group_ids:
+                            dict_children[parent_id].append(file)
+
+                    list_from_id = link_drive_tree_folder(file, dict_children)
+                    if list_from_id is not None:
+                        ls_level_ids.append(list_from_id)
+
+            depth += 1
+
+    return dict_root
+
+
+def walk_drive_folder_oauth(folder_id, max_workers=8, max_depth=None):
+    """
+    This function will list a drive folder and all its subfolders with the pydrive credentials, a level at a time with
+    the folders of a level listed on a thread pool, into the same tree as walk_drive_folder
+    :param folder_id: the id of the root folder
+    :param max_workers: the number of folders listed at the same time, each thread lists with a pydrive client of its own
+    :param max_depth: the deepest level of subfolders to list, 0 lists only the root, None for all
+    :return: the root as a dictionary with "id" and "children" like walk_drive_folder
+    """
+    dict_root = {"id": folder_id, "mimeType": drive_folder_mime_type, "children": []}
+    dict_children = {folder_id: dict_root["children"]}
+    ls_level_ids = [folder_id]
+    depth = 0
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=lambda: google_drive_oauth.use_thread_client(
+            authorize_thread_google_drive
         ),
-        scopes=["https://www.googleapis.com/auth/drive"],
-    )
-    service = build("drive", "v3", credentials=credentials)
+    ) as executor:
+        while ls_level_ids and (max_depth is None or depth <= max_depth):
+            ls_next_level_ids = []
+            # map keeps the order of the folders, so the tree does not depend on which listing finishes first
+            for parent_id, ls_drive_files in zip(
+                ls_level_ids,
+                executor.map(get_file_list_from_folder_id_oauth, ls_level_ids),
+            ):
+                for drive_file in ls_drive_files:
+                    # pydrive lists with drive v2, which calls the name the title
+                    file = {
+                        "id": drive_file["id"],
+                        "name": drive_file["title"],
+                        "mimeType": drive_file["mimeType"],
+                        "shortcutDetails": drive_file.get("shortcutDetails", {}),
+                    }
+                    dict_children[parent_id].append(file)
+                    list_from_id = link_drive_tree_folder(file, dict_children)
+                    if list_from_id is not None:
+                        ls_next_level_ids.append(list_from_id)
+            ls_level_ids = ls_next_level_ids
+            depth += 1
+
+    return dict_root
+
+
+def iter_drive_tree(dict_folder, level=0, set_path_ids=None):
+    """
+    This generator will walk a tree from walk_drive_folder, the files of a folder before its subfolders,
+    a shortcut back to a folder above it is yielded but not walked again
+    :param dict_folder: a folder dictionary with "children"
+    :param level: the level of the folder
+    :param set_path_ids: the folders above this one, used to stop at cycles
+    :return: generator of (level, file) tuples
+    """
+    set_path_ids = (set_path_ids or set()) | {id(dict_folder["children"])}
+    ls_children = sorted(dict_folder["children"], key=lambda file: file["name"])
+    for file in ls_children:
+        if "children" not in file:
+            yield level, file
+    for file in ls_children:
+        if "children" in file:
+            yield level, file
+            if id(file["children"]) not in set_path_ids:
+                yield from iter_drive_tree(file, level + 1, set_path_ids)
 
-    # retrieve a list of files in the specified folder
-    results = (
-        service.files()
-        .list(
-            q=f"'{folder_id}' in parents and trashed=false",
-            fields="nextPageToken, files(id, name)",
-        )
-        .execute()
-    )
-    files = results.get("files", [])
+
+def get_file_list_from_folder_id(folder_id):
+    files = list_drive_files(f"'{folder_id}' in parents and trashed=false")
 
     if not files:
         print("No files found.")
@@ -711,45 +5296,31 @@ def get_book_id_from_parent_folder_id(parent_folder_id, book_name):
         f"Getting sheet ID for book named {book_name} inside parent folder ID {parent_folder_id}"
     )
 
-    parent_folder_files = get_file_list_from_folder_id(parent_folder_id)
+    return get_file_id_from_drive_mirror(parent_folder_id, book_name)
 
-    for file in parent_folder_files:
-        file_id = file["id"]
-        file_title = file["name"]
-        print(f"Processing file ID {file_id} with the name {file_title}")
-        if file_title == book_name:
-            return file_id
 
+def list_files_recursively(folder_id, level=0, client=None):
+    """
+    This function will print a drive folder and all its subfolders
+    :param folder_id: the id of the root folder
+    :param level: the indent of the root folder
+    :param client: the pygsheets client to list with, like gc or gc_oauth, None to list with the pydrive credentials
+        as before, the account and so the files seen differ between them, both list on a thread pool
+    :return: the tree from walk_drive_folder
+    """
+    if client is None:
+        dict_root = walk_drive_folder_oauth(folder_id)
+    else:
+        dict_root = walk_drive_folder(folder_id, client=client)
+    for file_level, file in iter_drive_tree(dict_root):
+        print_logger(
+            "\t" * (level + 2 * file_level)
+            + "title: %s" % file["name"]
+            + " - ID: %s" % file["id"]
+            + " - Type: %s" % file["mimeType"]
+        )
 
-def list_files_recursively(folder_id, level):
-    file_list = (
-        get_google_drive_obj()
-        .ListFile({"q": f"'{folder_id}' in parents and trashed=false"})
-        .GetList()
-    )
-    for file in file_list:
-        if not (file["mimeType"] == "application/vnd.google-apps.folder") or (
-            file["mimeType"] == "application/vnd.google-apps.shortcut"
-        ):
-            print_logger(
-                "\t" * level
-                + "title: %s" % file["title"]
-                + " - ID: %s" % file["id"]
-                + " - Type: %s" % file["mimeType"]
-            )
-
-    for file in file_list:
-        if (
-            file["mimeType"] == "application/vnd.google-apps.folder"
-            or file["mimeType"] == "application/vnd.google-apps.shortcut"
-        ):
-            print_logger(
-                "\t" * level
-                + "title: %s" % file["title"]
-                + " - ID: %s" % file["id"]
-                + " - Type: %s" % file["mimeType"]
-            )
-            list_files_recursively(file["id"], level + 2)
+    return dict_root
 
 
 def get_book_from_file_name(file_name):  # need to remove, aliased to new one for now
@@ -760,33 +5331,25 @@ def get_book_from_file_name(file_name):  # need to remove, aliased to new one fo
 def get_df_from_sheet_id(
     id, sheet_name, start_range, end_range, include_tailing_empty=False, retry=True
 ):
-    try:
-        data_from_book = get_book_sheet_from_id_name(id, sheet_name).get_as_df(
+    def read_attempt():
+        return get_book_sheet_from_id_name(id, sheet_name).get_as_df(
             start=start_range,
             end=end_range,
             include_tailing_empty=include_tailing_empty,
         )
-        return data_from_book
-    except Exception as e:
-        if retry:
-            print_logger(
-                f"Failed to get df from sheet id {id}, sheet_name: {sheet_name}, error: {e}, retrying"
-            )
-            return get_df_from_sheet_id(
-                id,
-                sheet_name,
-                start_range,
-                end_range,
-                include_tailing_empty,
-                retry=False,
-            )
-        else:
-            print_logger(
-                f"Failed to get df even after retry from sheet id {id}, sheet_name: {sheet_name}, error: {e}"
-            )
-            raise Exception(
-                f"Failed to get df even after retry from sheet id {id}, sheet_name: {sheet_name}, error: {e}"
-            )
+
+    def drop_sheet_connection(e):
+        # the tab may have been deleted or renamed since it was cached
+        dict_connected_sheets.pop(get_sheet_handle_key(id, sheet_name))
+
+    data_from_book = call_with_retry(
+        f"get df from sheet id {id}, sheet_name: {sheet_name}",
+        read_attempt,
+        key=id,
+        policy=None if retry else {"max_attempts": 1},
+        on_retry=drop_sheet_connection,
+    )
+    return data_from_book
 
 
 def get_df_from_file_name(
@@ -794,8 +5357,13 @@ def get_df_from_file_name(
 ):
     book_from_file_name = get_book_from_file_name(file_name)
     sheet_from_book = book_from_file_name.worksheet_by_title(sheet_name)
-    data_from_book = sheet_from_book.get_as_df(
-        start=start_range, end=end_range, include_tailing_empty=include_tailing_empty
+    data_from_book = call_with_retry(
+        f"get df from {file_name}, sheet_name: {sheet_name}",
+        sheet_from_book.get_as_df,
+        start=start_range,
+        end=end_range,
+        include_tailing_empty=include_tailing_empty,
+        key=book_from_file_name.id,
     )
     return data_from_book
 
@@ -806,19 +5374,31 @@ def get_df_and_id_from_file_name(
     book_from_file_name = get_book_from_file_name(file_name)
     sheet_id = book_from_file_name.id
     sheet_from_book = book_from_file_name.worksheet_by_title(sheet_name)
-    data_from_book = sheet_from_book.get_as_df(
-        start=start_range, end=end_range, include_tailing_empty=include_tailing_empty
+    data_from_book = call_with_retry(
+        f"get df from {file_name}, sheet_name: {sheet_name}",
+        sheet_from_book.get_as_df,
+        start=start_range,
+        end=end_range,
+        include_tailing_empty=include_tailing_empty,
+        key=sheet_id,
     )
     return data_from_book, sheet_id
 
 
 def get_book_from_id_oauth(id):
-    book_from_id = gc_oauth.open_by_key(id)
+    book_from_id = call_with_retry(
+        f"open connection to {id} with oauth", gc_oauth.open_by_key, id, key=id
+    )
     return book_from_id
 
 
 def get_book_from_file_name_oauth(file_name):
-    book_from_file_name = gc_oauth.open(file_name)
+    book_from_file_name = call_with_retry(
+        f"open connection to {file_name} with oauth",
+        gc_oauth.open,
+        file_name,
+        key=file_name,
+    )
     return book_from_file_name
 
 
@@ -827,8 +5407,13 @@ def get_df_from_sheet_id_oauth(
 ):
     book_from_id = get_book_from_id_oauth(id)
     sheet_from_book = book_from_id.worksheet_by_title(sheet_name)
-    data_from_book = sheet_from_book.get_as_df(
-        start=start_range, end=end_range, include_tailing_empty=include_tailing_empty
+    data_from_book = call_with_retry(
+        f"get df from sheet id {id} with oauth, sheet_name: {sheet_name}",
+        sheet_from_book.get_as_df,
+        start=start_range,
+        end=end_range,
+        include_tailing_empty=include_tailing_empty,
+        key=id,
     )
     return data_from_book
 
@@ -838,27 +5423,181 @@ def get_df_from_file_name_oauth(
 ):
     book_from_file_name = get_book_from_file_name_oauth(file_name)
     sheet_from_book = book_from_file_name.worksheet_by_title(sheet_name)
-    data_from_book = sheet_from_book.get_as_df(
-        start=start_range, end=end_range, include_tailing_empty=include_tailing_empty
+    data_from_book = call_with_retry(
+        f"get df from {file_name} with oauth, sheet_name: {sheet_name}",
+        sheet_from_book.get_as_df,
+        start=start_range,
+        end=end_range,
+        include_tailing_empty=include_tailing_empty,
+        key=book_from_file_name.id,
     )
     return data_from_book
 
 
+def get_grid_range(sheet_id, range_string):
+    """
+    This function will convert a range in A1 notation without the sheet title to a GridRange of the api,
+    open ended ranges like "A:D", "2:5" or "B2:C" leave the missing bounds out
+    :param sheet_id: the id of the sheet
+    :param range_string: the range like "A1:D10", a single cell like "A1" is a one cell range
+    :return: dictionary of the GridRange
+    """
+
+    def parse_cell(cell):
+        match = re.fullmatch(r"([A-Za-z]*)(\d*)", cell.strip())
+        if match is None or cell.strip() == "":
+            raise ValueError(f"Invalid range {range_string}")
+        letters, digits = match.groups()
+        col = 0
+        for letter in letters.upper():
+            col = col * 26 + ord(letter) - ord("A") + 1
+        return (int(digits) if digits else None), (col if letters else None)
+
+    start, _, end = range_string.partition(":")
+    start_row, start_col = parse_cell(start)
+    end_row, end_col = parse_cell(end) if end else (start_row, start_col)
+
+    dict_grid_range = {"sheetId": sheet_id}
+    if start_row is not None:
+        dict_grid_range["startRowIndex"] = start_row - 1
+    if end_row is not None:
+        dict_grid_range["endRowIndex"] = end_row
+    if start_col is not None:
+        dict_grid_range["startColumnIndex"] = start_col - 1
+    if end_col is not None:
+        dict_grid_range["endColumnIndex"] = end_col
+    return dict_grid_range
+
+
+def copy_ranges_on_server(
+    book_name, ls_range_pairs, paste_type="PASTE_FORMULA", cut=False
+):
+    """
+    This function will copy or move ranges inside a spreadsheet with a single batchUpdate, nothing is downloaded,
+    relative references of pasted formulas shift like a paste in the sheets ui
+    :param book_name: the name of the google spreadsheet
+    :param ls_range_pairs: list of ((copy sheet name, copy range), (paste sheet name, paste range)) with ranges like "A1:D10",
+        a paste range smaller than the copy range pastes the whole copy range from its top left cell
+    :param paste_type: the PasteType of the api, like "PASTE_FORMULA", "PASTE_VALUES" or "PASTE_NORMAL"
+    :param cut: whether to move the ranges with cutPaste instead of copying them
+    :return: None
+    """
+    Workbook = get_book(book_name)
+
+    ls_requests = []
+    for copy_pair, paste_pair in ls_range_pairs:
+        copy_sheet_name, copy_range = copy_pair
+        paste_sheet_name, paste_range = paste_pair
+        source = get_grid_range(
+            get_book_sheet_from_id_name(Workbook.id, copy_sheet_name).id, copy_range
+        )
+        destination = get_grid_range(
+            get_book_sheet_from_id_name(Workbook.id, paste_sheet_name).id, paste_range
+        )
+        if cut:
+            ls_requests.append(
+                {
+                    "cutPaste": {
+                        "source": source,
+                        "destination": {
+                            "sheetId": destination["sheetId"],
+                            "rowIndex": destination.get("startRowIndex", 0),
+                            "columnIndex": destination.get("startColumnIndex", 0),
+                        },
+                        "pasteType": paste_type,
+                    }
+                }
+            )
+        else:
+            ls_requests.append(
+                {
+                    "copyPaste": {
+                        "source": source,
+                        "destination": destination,
+                        "pasteType": paste_type,
+                        "pasteOrientation": "NORMAL",
+                    }
+                }
+            )
+
+    call_with_retry(
+        f"{'move' if cut else 'copy'} {len(ls_requests)} ranges in {book_name}",
+        spreadsheets_batch_update,
+        Workbook,
+        ls_requests,
+        key=Workbook.id,
+    )
+
+
 def copy_formulas_range_to_range(
-    book_name, copy_sheet_name, copy_range, paste_sheet_name, paste_range_string
+    book_name,
+    copy_sheet_name,
+    copy_range,
+    paste_sheet_name,
+    paste_range_string,
+    server_side=False,
 ):
-    copy_sheet = get_book_sheet(book_name, copy_sheet_name)
-    paste_sheet = get_book_sheet(book_name, paste_sheet_name)
-    paste_sheet.update_values(
-        paste_range_string,
-        copy_sheet.get_values(
-            start=copy_range[0],
-            end=copy_range[1],
-            returnas="matrix",
-            include_tailing_empty=True,
-            include_tailing_empty_rows=True,
-            value_render="FORMULA",
-        ),
+    """
+    This function will copy the formulas of a range to another range
+    :param book_name: the name of the google spreadsheet
+    :param copy_sheet_name: the name of the sheet to copy from
+    :param copy_range: tuple of the start and end cell to copy like ("A1", "D10")
+    :param paste_sheet_name: the name of the sheet to paste to
+    :param paste_range_string: the range to paste to like "A1:D10" or its top left cell
+    :param server_side: whether to copy with a copyPaste on the server instead of downloading and uploading the formulas,
+        relative references then shift with the paste instead of being kept as written
+    :return: None
+    """
+    if server_side:
+        copy_ranges_on_server(
+            book_name,
+            [
+                (
+                    (copy_sheet_name, f"{copy_range[0]}:{copy_range[1]}"),
+                    (paste_sheet_name, paste_range_string),
+                )
+            ],
+        )
+        return
+
+    # the ranges are sent in A1 notation with quote_sheet_name, pygsheets does not escape quotes in sheet names
+    Workbook = get_book(book_name)
+    request = (
+        Workbook.client.sheet.service.spreadsheets()
+        .values()
+        .get(
+            spreadsheetId=Workbook.id,
+            range=f"{quote_sheet_name(copy_sheet_name)}!{copy_range[0]}:{copy_range[1]}",
+            valueRenderOption="FORMULA",
+        )
+    )
+    response = call_with_retry(
+        f"read formulas of {book_name} : {copy_sheet_name}",
+        execute_sheets_request,
+        Workbook.client,
+        request,
+        key=Workbook.id,
+    )
+
+    # trailing empty cells are dropped by the api, they are written back as empty so the paste clears them
+    first_row, first_col = format_addr(copy_range[0], output="tuple")
+    last_row, last_col = format_addr(copy_range[1], output="tuple")
+    num_rows, num_cols = last_row - first_row + 1, last_col - first_col + 1
+    ls_rows = response.get("values", [])
+    ls_rows = ls_rows + [[]] * (num_rows - len(ls_rows))
+    ls_formulas = [row + [""] * (num_cols - len(row)) for row in ls_rows]
+
+    call_with_retry(
+        f"write formulas to {book_name} : {paste_sheet_name}",
+        values_batch_update,
+        Workbook,
+        [
+            {
+                "range": f"{quote_sheet_name(paste_sheet_name)}!{paste_range_string}",
+                "values": ls_formulas,
+            }
+        ],
+        key=Workbook.id,
     )
 
 
@@ -875,6 +5614,326 @@ def convert_to_sheets_link(sheet_id):
     return f'=hyperlink("{sheet_link}","Link")'
 
 
+# %%
+## Drive Mirror ##
+
+# a local copy of the listings of the drive folders we look files up in, kept current with the changes api,
+# one database per account as change tokens and visible files differ between them, "oauth" is the account of
+# gc_oauth, not of the pydrive credentials
+dict_drive_mirror_clients = {"service": gc, "oauth": gc_oauth}
+loc_drive_mirror_dir = data_dir
+# sync with the changes api at most this often per process
+drive_mirror_sync_seconds = 60
+dict_drive_mirror_synced_at = {}
+drive_mirror_lock = threading.RLock()
+
+
+def get_drive_mirror_db_connection(account="service"):
+    loc_drive_mirror_db = os.path.join(
+        loc_drive_mirror_dir, f"drive_mirror_{account}.sqlite"
+    )
+    os.makedirs(os.path.dirname(loc_drive_mirror_db), exist_ok=True)
+    con = sqlite3.connect(loc_drive_mirror_db, timeout=60, isolation_level=None)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS files (id TEXT, parent_id TEXT, name TEXT, mime_type TEXT, "
+        "modified_time TEXT, PRIMARY KEY (id, parent_id))"
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS files_parent_name ON files (parent_id, name)"
+    )
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS folders (id TEXT PRIMARY KEY, recursive INTEGER, listed_at REAL)"
+    )
+    con.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+    return con
+
+
+def get_drive_changes_start_page_token(client):
+    request = (
+        get_drive_service(client).changes().getStartPageToken(supportsAllDrives=True)
+    )
+    response = call_with_retry(
+        "get drive changes start page token", execute_drive_request, client, request
+    )
+    return response["startPageToken"]
+
+
+def insert_drive_mirror_files(con, ls_files, set_folder_ids):
+    """
+    This function will add files to the mirror under each of their parents that is mirrored
+    :param con: the connection to the mirror
+    :param ls_files: list of drive file dictionaries with id, name, mimeType, parents and modifiedTime
+    :param set_folder_ids: the ids of the mirrored folders
+    :return: None
+    """
+    con.executemany(
+        "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+        [
+            (
+                file["id"],
+                parent_id,
+                file["name"],
+                file["mimeType"],
+                file.get("modifiedTime"),
+            )
+            for file in ls_files
+            for parent_id in file.get("parents", [])
+            if parent_id in set_folder_ids
+        ],
+    )
+
+
+def add_drive_mirror_folder(folder_id, account="service", recursive=False):
+    """
+    This function will list a folder into the mirror so later lookups in it are local,
+    the folder is then kept current by sync_drive_mirror
+    :param folder_id: the id of the folder
+    :param account: "service" or "oauth", the account whose view of drive is mirrored
+    :param recursive: whether to also mirror every subfolder, including ones created later
+    :return: None
+    """
+    client = dict_drive_mirror_clients[account]
+
+    with drive_mirror_lock:
+        con = get_drive_mirror_db_connection(account)
+        # the token is taken before listing so changes made during the listing are synced later
+        row = con.execute("SELECT value FROM state WHERE key = 'page_token'").fetchone()
+        if row is None:
+            con.execute(
+                "INSERT INTO state VALUES ('page_token', ?)",
+                (get_drive_changes_start_page_token(client),),
+            )
+
+        if recursive:
+            dict_root = walk_drive_folder(folder_id, client=client)
+            ls_folder_ids = [folder_id] + [
+                file["id"]
+                for _, file in iter_drive_tree(dict_root)
+                if file["mimeType"] == drive_folder_mime_type
+            ]
+            ls_files = [file for _, file in iter_drive_tree(dict_root)]
+        else:
+            ls_folder_ids = [folder_id]
+            ls_files = list_drive_files(
+                f"'{folder_id}' in parents and trashed=false", client=client
+            )
+
+        con.execute("BEGIN IMMEDIATE")
+        con.executemany(
+            "INSERT OR REPLACE INTO folders VALUES (?, ?, ?)",
+            [(id, int(recursive), time.time()) for id in ls_folder_ids],
+        )
+        con.executemany(
+            "DELETE FROM files WHERE parent_id = ?", [(id,) for id in ls_folder_ids]
+        )
+        insert_drive_mirror_files(con, ls_files, set(ls_folder_ids))
+        con.execute("COMMIT")
+        con.close()
+
+    print_logger(
+        f"Mirrored {len(ls_files)} files of {len(ls_folder_ids)} drive folders under {folder_id}"
+    )
+
+
+def sync_drive_mirror(account="service", force=False):
+    """
+    This function will apply the drive changes since the last sync to the mirrored folders,
+    usually a single changes.list request
+    :param account: "service" or "oauth", the account whose view of drive is mirrored
+    :param force: whether to sync even if the last sync was less than drive_mirror_sync_seconds ago
+    :return: the number of changes applied
+    """
+    client = dict_drive_mirror_clients[account]
+
+    with drive_mirror_lock:
+        if (
+            not force
+            and time.time() - dict_drive_mirror_synced_at.get(account, 0)
+            < drive_mirror_sync_seconds
+        ):
+            return 0
+
+        con = get_drive_mirror_db_connection(account)
+        row = con.execute("SELECT value FROM state WHERE key = 'page_token'").fetchone()
+        if row is None:
+            con.close()
+            return 0
+
+        page_token = row[0]
+        ls_changes = []
+        while True:
+            request = (
+                get_drive_service(client)
+                .changes()
+                .list(
+                    pageToken=page_token,
+                    pageSize=1000,
+                    fields="nextPageToken, newStartPageToken, changes(fileId, removed, "
+                    "file(id, name, mimeType, parents, modifiedTime, trashed))",
+                    supportsAllDrives=True,
+                    includeItemsFromAllDrives=True,
+                )
+            )
+            response = call_with_retry(
+                "list drive changes", execute_drive_request, client, request
+            )
+            ls_changes.extend(response.get("changes", []))
+            if "newStartPageToken" in response:
+                page_token = response["newStartPageToken"]
+                break
+            page_token = response["nextPageToken"]
+
+        con.execute("BEGIN IMMEDIATE")
+        dict_folders = dict(con.execute("SELECT id, recursive FROM folders"))
+        for change in ls_changes:
+            con.execute("DELETE FROM files WHERE id = ?", (change["fileId"],))
+            file = change.get("file")
+            if change.get("removed") or file is None or file.get("trashed"):
+                continue
+
+            ls_parent_ids = [id for id in file.get("parents", []) if id in dict_folders]
+            # a folder created inside a recursively mirrored folder is mirrored too
+            if file["mimeType"] == drive_folder_mime_type and any(
+                dict_folders[id] for id in ls_parent_ids
+            ):
+                dict_folders[file["id"]] = 1
+                con.execute(
+                    "INSERT OR REPLACE INTO folders VALUES (?, 1, ?)",
+                    (file["id"], time.time()),
+                )
+            insert_drive_mirror_files(con, [file], set(ls_parent_ids))
+
+        con.execute(
+            "UPDATE state SET value = ? WHERE key = 'page_token'", (page_token,)
+        )
+        con.execute("COMMIT")
+        con.close()
+
+        dict_drive_mirror_synced_at[account] = time.time()
+
+    return len(ls_changes)
+
+
+def get_file_id_from_drive_mirror(parent_folder_id, name, account="service"):
+    """
+    This function will look up a file by name in a folder from the mirror, mirroring the folder on first use,
+    a name missing from the mirror is looked up live in drive before giving up
+    :param parent_folder_id: the id of the folder
+    :param name: the name of the file
+    :param account: "service" or "oauth", the account whose view of drive is mirrored
+    :return: the id of the most recently modified file with the name, or None if there is none
+    """
+    with drive_mirror_lock:
+        con = get_drive_mirror_db_connection(account)
+        is_mirrored = (
+            con.execute(
+                "SELECT 1 FROM folders WHERE id = ?", (parent_folder_id,)
+            ).fetchone()
+            is not None
+        )
+        con.close()
+
+        if is_mirrored:
+            sync_drive_mirror(account)
+        else:
+            add_drive_mirror_folder(parent_folder_id, account=account)
+
+    con = get_drive_mirror_db_connection(account)
+    row = con.execute(
+        "SELECT id FROM files WHERE parent_id = ? AND name = ? ORDER BY modified_time DESC",
+        (parent_folder_id, name),
+    ).fetchone()
+    con.close()
+    if row is not None or not is_mirrored:
+        return None if row is None else row[0]
+
+    # the mirror syncs at most every drive_mirror_sync_seconds, so a file added since is looked up live
+    escaped_name = name.replace("\\", "\\\\").replace("'", "\\'")
+    ls_files = list_drive_files(
+        f"'{parent_folder_id}' in parents and name = '{escaped_name}' and trashed = false",
+        client=dict_drive_mirror_clients[account],
+    )
+    if not ls_files:
+        return None
+
+    with drive_mirror_lock:
+        con = get_drive_mirror_db_connection(account)
+        con.execute("BEGIN IMMEDIATE")
+        insert_drive_mirror_files(con, ls_files, {parent_folder_id})
+        con.execute("COMMIT")
+        con.close()
+    return max(ls_files, key=lambda file: file.get("modifiedTime") or "")["id"]
+
+
+# %%
+## Fake Backend ##
+
+
+def use_fake_google_backend(backend=None, meter=False):
+    """
+    This function will point gc and gc_oauth at an in process fake of sheets and drive instead of google,
+    for offline tests and benchmarks, the local state of this module like the caches, the name index and
+    the drive mirror is moved under data_dir/fake_google_backend and emptied so it never mixes with the real one,
+    the pydrive functions are not covered
+    :param backend: the google_fake_tools.FakeGoogleBackend to serve requests from, a new empty one when None
+    :param meter: whether the fake clients wait on the rate limiter like the real ones
+    :return: the backend
+    """
+    global loc_rate_limit_db, loc_sheets_read_cache, loc_sheets_output_cache
+    global loc_spreadsheet_name_index, loc_drive_mirror_dir, hardcoded_book_ids_loaded
+    global rate_limit_db_ready, loc_sheets_write_journal, loc_sheets_append_index
+
+    from utils.google_fake_tools import FakeGoogleBackend, get_fake_client
+
+    if backend is None:
+        backend = FakeGoogleBackend()
+
+    def authorize_fake_client():
+        client = instrument_client_requests(get_fake_client(backend))
+        return meter_client_requests(client) if meter else client
+
+    FlushSheetsCache()
+    stop_sheets_write_drainer()
+    gc.reset(authorize_fake_client)
+    gc_oauth.reset(authorize_fake_client)
+
+    loc_fake_backend_dir = os.path.join(data_dir, "fake_google_backend")
+    shutil.rmtree(loc_fake_backend_dir, ignore_errors=True)
+    loc_rate_limit_db = os.path.join(
+        loc_fake_backend_dir, "google_api_rate_limit.sqlite"
+    )
+    rate_limit_db_ready = False
+    loc_sheets_read_cache = os.path.join(loc_fake_backend_dir, "sheets_read_cache")
+    loc_sheets_output_cache = os.path.join(loc_fake_backend_dir, "sheets_output_cache")
+    loc_spreadsheet_name_index = os.path.join(
+        loc_fake_backend_dir, "spreadsheet_name_index.json"
+    )
+    loc_drive_mirror_dir = loc_fake_backend_dir
+    loc_sheets_write_journal = os.path.join(
+        loc_fake_backend_dir, "sheets_write_journal"
+    )
+    loc_sheets_append_index = os.path.join(loc_fake_backend_dir, "sheets_append_index")
+
+    dict_connected_books.clear()
+    dict_connected_sheets.clear()
+    dict_book_name_ids.clear()
+    with spreadsheet_name_index_lock:
+        dict_spreadsheet_name_index.clear()
+    with drive_mirror_lock:
+        dict_drive_mirror_synced_at.clear()
+    with hardcoded_book_ids_lock:
+        dict_hardcoded_book_ids.clear()
+        hardcoded_book_ids_loaded = True
+
+    print_logger(f"Using fake google backend {backend!r}")
+    return backend
+
+
+# GOOGLE_TOOLS_BACKEND=fake runs scripts against an empty fake backend instead of google
+if os.environ.get("GOOGLE_TOOLS_BACKEND", "google") == "fake":
+    use_fake_google_backend()
+
+
 # %%
 
 if __name__ == "__main__":
@@ -0,0 +1,69 @@
+# %%
+## Imports ##
+
+if __name__ != "__main__":
+    print(f"Importing {__name__}")
+
+import config_tests
+
+import copy
+import pytest
+
+from utils.google_fake_tools import (
+    FakeGoogleError,
+    parse_a1_range,
+    parse_user_entered_value,
+    render_value,
+)
+
+# %%
+## Ranges ##
+
+
+def test_parse_a1_range_open_ends():
+    assert parse_a1_range("A1") == (1, 1, 1, 1)
+    assert parse_a1_range("A5:C") == (5, 1, None, 3)
+    assert parse_a1_range("B:D") == (None, 2, None, 4)
+    assert parse_a1_range("2:5") == (2, None, 5, None)
+
+
+@pytest.mark.parametrize("range_string", ["A5:", ":B2", "A0", "A1:B2:C3", "5A"])
+def test_parse_a1_range_rejects_malformed(range_string):
+    with pytest.raises(FakeGoogleError) as info:
+        parse_a1_range(range_string)
+    assert info.value.status == 400
+    assert "Unable to parse range" in info.value.message
+
+
+# %%
+## User Entered Values ##
+
+
+@pytest.mark.parametrize(
+    "text, value",
+    [
+        ("12", 12),
+        ("1.5", 1.5),
+        ("50%", 0.5),
+        ("TRUE", True),
+        ("'12", "12"),
+        ("$1,234.50", 1234.5),
+        ("-$3", -3.0),
+        ("2024-01-05", 45296.0),
+        ("1/5/2024 12:00", 45296.5),
+        ("1,2", "1,2"),
+        ("abc", "abc"),
+    ],
+)
+def test_parse_user_entered_value(text, value):
+    assert parse_user_entered_value(text) == value
+
+
+def test_parsed_dates_and_currency_keep_their_formatted_text():
+    for text in ["2024-01-05", "$1,234.50"]:
+        value = copy.deepcopy(parse_user_entered_value(text))
+        assert render_value(value, "FORMATTED_VALUE") == text
+        assert render_value(value, "UNFORMATTED_VALUE") == float(value)
+
+
+# %%
@@ -0,0 +1,948 @@
+# %%
+## Imports ##
+
+if __name__ != "__main__":
+    print(f"Importing {__name__}")
+
+import config_tests
+
+import os
+import json
+import socket
+import ssl
+import threading
+import time
+import httplib2
+import pandas as pd
+import pytest
+from googleapiclient.errors import HttpError
+
+from utils import doc_tools, google_tools
+from utils.google_fake_tools import FakeGoogleBackend
+
+# %%
+## Fixtures ##
+
+# regression tests of google_tools run against the in process fake of sheets and drive, see google_fake_tools
+
+
+@pytest.fixture
+def backend(monkeypatch, tmp_path):
+    # the caches, journals, exports and the pipeline log of log_data_pipeline are written under tmp_path, not data_dir
+    for name, value in list(vars(google_tools).items()):
+        if name.startswith("loc_") and isinstance(value, str):
+            relative_path = os.path.relpath(value, google_tools.data_dir)
+            if not relative_path.startswith(os.pardir):
+                monkeypatch.setattr(
+                    google_tools, name, os.path.join(tmp_path, relative_path)
+                )
+    monkeypatch.setattr(google_tools, "data_dir", str(tmp_path))
+    monkeypatch.setattr(doc_tools, "data_dir", str(tmp_path))
+    backend = google_tools.use_fake_google_backend(FakeGoogleBackend(seed=0))
+    yield backend
+    google_tools.FlushSheetsCache()
+
+
+def get_column_values(backend, id, sheetName, col=0):
+    return [row[col] for row in backend.get_sheet_values(id, sheetName)[1:]]
+
+
+# %%
+## Rate limiter ##
+
+
+def get_bucket_tokens(bucket):
+    con = google_tools.get_rate_limit_db_connection()
+    (tokens,) = con.execute(
+        "SELECT tokens FROM buckets WHERE name = ?", (bucket,)
+    ).fetchone()
+    con.close()
+    return tokens
+
+
+def test_rate_limiter_waits_once_the_bucket_is_empty(backend, monkeypatch):
+    monkeypatch.setitem(google_tools.dict_api_quotas_per_minute, "sheets_read", 3)
+
+    assert [
+        google_tools.update_api_bucket("sheets_read", lane="interactive")
+        for _ in range(3)
+    ] == [0, 0, 0]
+    # a token comes back every 20 seconds at 3 per minute
+    assert 19 < google_tools.update_api_bucket("sheets_read", lane="interactive") <= 20
+
+
+def test_rate_limiter_bulk_lane_leaves_the_reserve_to_interactive(backend, monkeypatch):
+    monkeypatch.setitem(google_tools.dict_api_quotas_per_minute, "sheets_read", 4)
+    for _ in range(3):
+        assert google_tools.update_api_bucket("sheets_read", lane="bulk") == 0
+
+    # the bulk lane leaves a quarter of the bucket free, one token here
+    assert google_tools.update_api_bucket("sheets_read", lane="bulk") > 0
+    with google_tools.google_api_lane("interactive"):
+        assert google_tools.update_api_bucket("sheets_read") == 0
+
+
+def test_rate_limited_response_drains_the_bucket(backend, monkeypatch):
+    monkeypatch.setitem(google_tools.dict_api_quotas_per_minute, "sheets_read", 60_000)
+    monkeypatch.setitem(google_tools.dict_retry_policy, "base_delay_seconds", 0)
+    google_tools.use_fake_google_backend(backend, meter=True)
+    id = backend.create_spreadsheet("Book", {"Data": [["a"], [1]]})
+
+    backend.fail_next_requests(429)
+    with google_tools.google_api_lane("interactive"):
+        assert google_tools.get_book_from_id(id).id == id
+
+    # every process backs off together, the bucket refills from empty
+    assert get_bucket_tokens("sheets_read") < 60_000 / 2
+
+
+# %%
+## Retries ##
+
+
+def get_http_error(status, content=b"", headers=None):
+    return HttpError(httplib2.Response({"status": status, **(headers or {})}), content)
+
+
+@pytest.mark.parametrize(
+    "error, error_class",
+    [
+        (get_http_error(429), "rate_limited"),
+        (
+            get_http_error(
+                403, b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}'
+            ),
+            "rate_limited",
+        ),
+        (
+            get_http_error(403, b'{"error": {"errors": [{"reason": "forbidden"}]}}'),
+            "fatal",
+        ),
+        (get_http_error(503), "transient"),
+        (get_http_error(404), "not_found"),
+        (get_http_error(400, b"No grid with id: 5"), "not_found"),
+        (get_http_error(400), "fatal"),
+        (socket.timeout(), "transient"),
+        (ssl.SSLCertVerificationError(), "fatal"),
+        (ValueError(), "fatal"),
+    ],
+)
+def test_classify_google_error(error, error_class):
+    assert google_tools.classify_google_error(error) == error_class
+
+
+@pytest.fixture
+def retry_calls(monkeypatch):
+    monkeypatch.setattr(google_tools, "dict_circuit_breakers", {})
+    ls_sleeps = []
+    monkeypatch.setattr(google_tools.time, "sleep", ls_sleeps.append)
+    return ls_sleeps
+
+
+def get_failing_func(ls_errors, result="done"):
+    ls_errors = list(ls_errors)
+    ls_calls = []
+
+    def func():
+        ls_calls.append(len(ls_calls) + 1)
+        if ls_errors:
+            raise ls_errors.pop(0)
+        return result
+
+    return func, ls_calls
+
+
+def test_call_with_retry_retries_transient_errors(retry_calls):
+    func, ls_calls = get_failing_func([get_http_error(503), socket.timeout()])
+
+    assert google_tools.call_with_retry("test", func) == "done"
+    assert ls_calls == [1, 2, 3]
+    assert len(retry_calls) == 2
+
+
+def test_call_with_retry_raises_fatal_errors_at_once(retry_calls):
+    func, ls_calls = get_failing_func([get_http_error(400)])
+
+    with pytest.raises(HttpError):
+        google_tools.call_with_retry("test", func)
+    assert ls_calls == [1]
+
+
+def test_call_with_retry_gives_up_after_max_attempts(retry_calls):
+    error = get_http_error(503)
+    func, ls_calls = get_failing_func([error] * 5)
+
+    with pytest.raises(Exception, match="after 3 attempts") as exc_info:
+        google_tools.call_with_retry("test", func, policy={"max_attempts": 3})
+    assert google_tools.get_root_error(exc_info.value) is error
+    assert ls_calls == [1, 2, 3]
+
+    # not found is only tried again in case it is eventual consistency
+    func, ls_calls = get_failing_func([get_http_error(404)] * 5)
+    with pytest.raises(Exception, match="after 2 attempts"):
+        google_tools.call_with_retry("test", func)
+
+
+def test_call_with_retry_waits_for_retry_after(retry_calls):
+    func, _ = get_failing_func([get_http_error(429, headers={"retry-after": "7"})])
+
+    google_tools.call_with_retry("test", func)
+    assert retry_calls == [7]
+
+
+def test_circuit_breaker_opens_after_consecutive_failures(retry_calls):
+    policy = {"max_attempts": 1, "breaker_failure_threshold": 2}
+    func, ls_calls = get_failing_func([get_http_error(503)] * 2)
+    for _ in range(2):
+        with pytest.raises(Exception, match="after 1 attempts"):
+            google_tools.call_with_retry("test", func, key="book", policy=policy)
+
+    with pytest.raises(Exception, match="Circuit breaker for book is open"):
+        google_tools.call_with_retry("test", func, key="book", policy=policy)
+    assert ls_calls == [1, 2]
+    # other spreadsheets are not affected
+    assert google_tools.call_with_retry("test", func, key="other") == "done"
+
+
+# %%
+## Metrics ##
+
+
+def test_metrics_registry_renders_prometheus_text():
+    registry = google_tools.ApiMetricsRegistry()
+    registry.inc("requests_total", {"sheet": 'a "b"'}, 2)
+    for value in [0.5, 3, 20]:
+        registry.observe("latency_seconds", {}, value, [1, 5])
+
+    assert registry.get_prometheus_text().splitlines() == [
+        "# TYPE requests_total counter",
+        'requests_total{sheet="a \\"b\\""} 2',
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="1"} 1',
+        'latency_seconds_bucket{le="5"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        "latency_seconds_sum 23.5",
+        "latency_seconds_count 3",
+    ]
+
+
+def test_metrics_record_requests_and_retries(backend, monkeypatch, tmp_path):
+    monkeypatch.setattr(google_tools, "api_metrics", google_tools.ApiMetricsRegistry())
+    monkeypatch.setitem(google_tools.dict_retry_policy, "base_delay_seconds", 0)
+    id = backend.create_spreadsheet("Book", {"Data": [["a"]]})
+
+    backend.fail_next_requests(503)
+    google_tools.get_book_from_id(id)
+
+    dict_requests = {
+        counter["labels"]["status"]: counter["value"]
+        for counter in google_tools.get_api_metrics()["counters"]
+        if counter["name"] == "google_api_requests_total"
+        and counter["labels"]["spreadsheet_id"] == id
+    }
+    assert dict_requests == {"503": 1, "200": 1}
+    assert [
+        counter["labels"]["error_class"]
+        for counter in google_tools.get_api_metrics()["counters"]
+        if counter["name"] == "google_api_retries_total"
+    ] == ["transient"]
+
+    path = os.path.join(tmp_path, "calls.jsonl")
+    assert google_tools.export_api_metrics_jsonl(path) == 2
+    with open(path) as f:
+        ls_events = [json.loads(line) for line in f]
+    assert [(event["status"], event["attempt"]) for event in ls_events] == [
+        (503, 1),
+        (200, 2),
+    ]
+    # exported events are not exported again
+    assert google_tools.export_api_metrics_jsonl(path) == 0
+
+
+# %%
+## Writes ##
+
+
+def test_failed_write_drops_delta_baseline(backend):
+    id = backend.create_spreadsheet("Book", {"Data": [["a"]]})
+    google_tools.WriteToSheets("Book", "Data", pd.DataFrame({"a": [1, 2, 3]}))
+
+    backend.fail_next_requests(400)
+    with pytest.raises(Exception):
+        google_tools.WriteToSheets("Book", "Data", pd.DataFrame({"a": [7, 8, 9]}))
+
+    # the failed write never reached the sheet, so a delta against its frame would only send the last cell
+    google_tools.WriteToSheets(
+        "Book", "Data", pd.DataFrame({"a": [7, 8, 10]}), delta=True
+    )
+    assert get_column_values(backend, id, "Data") == [7, 8, 10]
+
+
+def test_write_parses_text_like_a_user_unless_typed_cells(backend):
+    id = backend.create_spreadsheet("Book", {"Data": [["a"]]})
+    df = pd.DataFrame({"a": ["12", "$1,000", "text"]})
+
+    google_tools.WriteToSheets("Book", "Data", df)
+    assert get_column_values(backend, id, "Data") == [12, 1000, "text"]
+
+    google_tools.WriteToSheets("Book", "Data", df, typed_cells=True)
+    assert get_column_values(backend, id, "Data") == ["12", "$1,000", "text"]
+
+
+def test_chunked_write_resumes_after_a_block_runs_out_of_retries(backend, monkeypatch):
+    monkeypatch.setitem(google_tools.dict_retry_policy, "base_delay_seconds", 0)
+    monkeypatch.setitem(google_tools.dict_retry_policy, "max_attempts", 2)
+    id = backend.create_spreadsheet("Book", {"Data": [["a"]]})
+    df = pd.DataFrame({"a": range(100)})
+    ls_progress = []
+
+    def fail_second_block(num_committed, num_chunks):
+        ls_progress.append(num_committed)
+        if num_committed == 1:
+            # every attempt of the block's own retry loop fails
+            backend.fail_next_requests(503, count=2)
+
+    google_tools.WriteToSheets(
+        "Book",
+        "Data",
+        df,
+        chunked=True,
+        chunk_max_bytes=100,
+        progress_callback=fail_second_block,
+    )
+
+    # the retry of the write resumed after the first block instead of failing or sending it again
+    assert ls_progress == list(range(1, len(ls_progress) + 1))
+    assert len(ls_progress) > 2
+    assert get_column_values(backend, id, "Data") == list(range(100))
+
+
+def test_write_replaces_the_sheet_in_one_request(backend):
+    id = backend.create_spreadsheet("Book", {"Data": [["a"], ["old"], ["old"]]})
+    google_tools.get_book("Book")
+    df = pd.DataFrame({"a": ["1,5", 'say "hi"', "two\nlines"], "b": [1.5, None, 3]})
+
+    dict_before = backend.get_stats()["by_endpoint"]
+    google_tools.WriteToSheets("Book", "Data", df)
+    dict_after = backend.get_stats()["by_endpoint"]
+
+    # the values ride in the batchUpdate, so a failure can not leave the sheet resized around its old values
+    assert {
+        endpoint: count - dict_before.get(endpoint, 0)
+        for endpoint, count in dict_after.items()
+        if count != dict_before.get(endpoint, 0)
+    } == {"POST /{id}:batchUpdate": 1}
+    assert backend.get_sheet_values(id, "Data") == [
+        ["a", "b"],
+        ["1,5", 1.5],
+        ['say "hi"'],
+        ["two\nlines", 3],
+    ]
+
+
+def test_get_row_chunks_splits_rows_by_payload_size():
+    ls_row_json = ['["a"]', '["bb"]', '["' + "c" * 50 + '"]', '["d"]', '["e"]']
+
+    ls_chunks = google_tools.get_row_chunks(ls_row_json, 16)
+
+    # consecutive blocks covering every row, a row over the limit is a block of its own
+    assert ls_chunks == [(0, 2), (2, 3), (3, 5)]
+
+
+def test_chunked_write_with_parallel_blocks_replaces_the_sheet(backend):
+    ls_old_rows = [["a", "b", "c"]] + [[i, i, i] for i in range(300)]
+    id = backend.create_spreadsheet("Book", {"Data": ls_old_rows})
+    df = pd.DataFrame({"a": range(120), "b": [f"v{i}" for i in range(120)]})
+    ls_progress = []
+
+    google_tools.WriteToSheets(
+        "Book",
+        "Data",
+        df,
+        chunked=True,
+        chunk_max_bytes=200,
+        chunk_workers=4,
+        progress_callback=lambda num_committed, num_chunks: ls_progress.append(
+            (num_committed, num_chunks)
+        ),
+    )
+
+    num_chunks = ls_progress[-1][1]
+    assert num_chunks > 4
+    assert sorted(ls_progress) == [(i, num_chunks) for i in range(1, num_chunks + 1)]
+    # the grid is resized to the frame, so no old rows or columns are left
+    assert backend.get_sheet_values(id, "Data") == [["a", "b"]] + [
+        [i, f"v{i}"] for i in range(120)
+    ]
+
+
+def test_failed_journaled_write_deletes_its_frame(backend):
+    backend.create_spreadsheet("Book", {"Data": [["a"]]})
+    google_tools.enqueue_sheets_write("Book", "Data", pd.DataFrame({"a": [1]}), {})
+
+    backend.fail_next_requests(400)
+    assert google_tools.drain_sheets_write_journal() == 1
+
+    con = google_tools.get_sheets_write_journal_connection()
+    ls_rows = con.execute("SELECT status, frame_path FROM writes").fetchall()
+    con.close()
+    assert [status for status, _ in ls_rows] == ["failed"]
+    assert not os.path.exists(ls_rows[0][1])
+
+
+def get_journal_statuses():
+    con = google_tools.get_sheets_write_journal_connection()
+    ls_statuses = [status for (status,) in con.execute("SELECT status FROM writes")]
+    con.close()
+    return ls_statuses
+
+
+def test_unusable_journaled_writes_fail_without_retrying(backend):
+    backend.create_spreadsheet("Book", {"Data": [["a"]], "Other": [["a"]]})
+    df = pd.DataFrame({"a": [1]})
+
+    id = google_tools.enqueue_sheets_write("Book", "Data", df, {})
+    con = google_tools.get_sheets_write_journal_connection()
+    frame_path = con.execute(
+        "SELECT frame_path FROM writes WHERE id = ?", (id,)
+    ).fetchone()[0]
+    con.close()
+    os.remove(frame_path)
+    google_tools.enqueue_sheets_write("Book", "Other", df, {"not_a_kwarg": 1})
+
+    assert google_tools.drain_sheets_write_journal() == 2
+    assert get_journal_statuses() == ["failed", "failed"]
+
+
+def test_journaled_write_fails_after_max_attempts(backend, monkeypatch):
+    monkeypatch.setattr(google_tools, "write_behind_max_attempts", 2)
+    monkeypatch.setattr(google_tools, "write_behind_base_delay_seconds", 0)
+
+    def fail_write(*args, **kwargs):
+        raise ConnectionError("network down")
+
+    monkeypatch.setattr(google_tools, "WriteToSheets", fail_write)
+    google_tools.enqueue_sheets_write("Book", "Data", pd.DataFrame({"a": [1]}), {})
+
+    # without a delay the second attempt is due right away
+    assert google_tools.drain_sheets_write_journal() == 2
+    assert get_journal_statuses() == ["failed"]
+
+
+def test_write_drainer_uses_a_client_of_its_own(backend, monkeypatch):
+    id = backend.create_spreadsheet("Book", {"Data": [["a"]]})
+    main_client = google_tools.gc.get()
+
+    ls_drainer_clients = []
+    run_sheets_write_drainer = google_tools.run_sheets_write_drainer
+
+    def record_client(**kwargs):
+        ls_drainer_clients.append(google_tools.gc.get())
+        return run_sheets_write_drainer(**kwargs)
+
+    monkeypatch.setattr(google_tools, "run_sheets_write_drainer", record_client)
+    google_tools.WriteToSheets(
+        "Book", "Data", pd.DataFrame({"a": [1, 2]}), write_behind=True
+    )
+    assert google_tools.stop_sheets_write_drainer(timeout=60)
+
+    assert ls_drainer_clients and ls_drainer_clients[0] is not main_client
+    assert google_tools.gc.get() is main_client
+    assert get_column_values(backend, id, "Data") == [1, 2]
+
+
+def test_upload_columns_keep_types_and_encode_dates_as_serials():
+    df = pd.DataFrame(
+        {
+            "int": [1, 2, 3],
+            "float": [1.5, float("nan"), float("inf")],
+            "bool": [True, False, True],
+            "date": pd.to_datetime(["2024-01-05", None, "2024-01-06"]),
+            "time": pd.to_datetime(
+                ["2024-01-05 06:00", "2024-01-05 00:00", None]
+            ).tz_localize("UTC"),
+            "object": pd.Series([1, 2.5, None], index=[7, 8, 9], dtype=object),
+            "text": ["a", None, "=A1"],
+        },
+        index=pd.Index([7, 8, 9], name="id"),
+    )
+
+    ls_head, ls_columns, ls_kinds, dict_date_formats = (
+        google_tools.get_df_upload_columns(df, indexes=True)
+    )
+
+    assert ls_head == ["id", "int", "float", "bool", "date", "time", "object", "text"]
+    assert ls_kinds == [
+        "number",
+        "number",
+        "number",
+        "bool",
+        "date",
+        "date",
+        "number",
+        "text",
+    ]
+    assert ls_columns[2] == [1.5, "", ""]
+    assert ls_columns[4] == [45296.0, "", 45297.0]
+    assert ls_columns[5] == [45296.25, 45296.0, ""]
+    assert ls_columns[6] == [1.0, 2.5, ""]
+    assert ls_columns[7] == ["a", "", "=A1"]
+    assert dict_date_formats == {
+        4: {"type": "DATE", "pattern": "yyyy-mm-dd"},
+        5: {"type": "DATE_TIME", "pattern": "yyyy-mm-dd hh:mm:ss"},
+    }
+
+    ls_row_json, num_cols, _ = google_tools.get_df_values_json_rows(df)
+    assert num_cols == 7
+    assert [json.loads(row) for row in ls_row_json[:2]] == [
+        ["int", "float", "bool", "date", "time", "object", "text"],
+        [1, 1.5, True, 45296.0, 45296.25, 1.0, "a"],
+    ]
+
+
+def test_cell_data_columns_keep_types_and_formulas():
+    assert list(google_tools.get_cell_data_column_json(["=A1", "x", ""], "text")) == [
+        '{"userEnteredValue":{"formulaValue":"=A1"}}',
+        '{"userEnteredValue":{"stringValue":"x"}}',
+        "{}",
+    ]
+    assert list(google_tools.get_cell_data_column_json([1.5, ""], "number")) == [
+        '{"userEnteredValue":{"numberValue":1.5}}',
+        "{}",
+    ]
+    assert list(google_tools.get_cell_data_column_json([False], "bool")) == [
+        '{"userEnteredValue":{"boolValue":false}}'
+    ]
+
+
+def test_write_many_writes_every_tab_in_two_requests(backend):
+    id = backend.create_spreadsheet("Book", {"Old": [["x"], [1], [2], [3]]})
+    google_tools.get_book("Book")
+
+    backend.reset_stats()
+    dict_results = google_tools.WriteManyToSheets(
+        "Book",
+        {"Old": pd.DataFrame({"a": [1]}), "New": pd.DataFrame({"b": ["x", "y"]})},
+    )
+
+    assert {name: result["status"] for name, result in dict_results.items()} == {
+        "Old": "ok",
+        "New": "ok",
+    }
+    dict_endpoints = backend.get_stats()["by_endpoint"]
+    assert dict_endpoints["POST /{id}:batchUpdate"] == 1
+    assert dict_endpoints["POST /{id}/values:batchUpdate"] == 1
+    assert backend.get_sheet_values(id, "Old") == [["a"], [1]]
+    assert backend.get_sheet_values(id, "New") == [["b"], ["x"], ["y"]]
+
+
+def test_write_many_reports_failed_tabs_and_drops_their_baseline(backend, monkeypatch):
+    id = backend.create_spreadsheet("Book", {"Good": [["a"]], "Bad": [["a"]]})
+    google_tools.WriteManyToSheets(
+        "Book", {"Good": pd.DataFrame({"a": [1]}), "Bad": pd.DataFrame({"a": [1]})}
+    )
+    google_tools.FlushSheetsCache()
+    handle_request = backend.handle_request
+
+    def fail_bad_tab(uri, method, body):
+        if body and b"Bad" in (body if isinstance(body, bytes) else body.encode()):
+            return 400, {}, b"Invalid request"
+        return handle_request(uri, method, body)
+
+    monkeypatch.setattr(backend, "handle_request", fail_bad_tab)
+    dict_results = google_tools.WriteManyToSheets(
+        "Book",
+        {"Good": pd.DataFrame({"a": [2]}), "Bad": pd.DataFrame({"a": [2]})},
+        raise_errors=False,
+    )
+
+    # the batch failed as a whole, then the tabs were written one at a time
+    assert dict_results["Good"]["status"] == "ok"
+    assert dict_results["Bad"]["status"] == "failed"
+    assert get_column_values(backend, id, "Good") == [2]
+    assert get_column_values(backend, id, "Bad") == [1]
+    assert google_tools.LoadFromSheetsCache("Book", "Good")["a"].tolist() == [2]
+    assert google_tools.LoadFromSheetsCache("Book", "Bad") is None
+
+
+def test_write_refreshes_handle_of_recreated_tab(backend):
+    id = backend.create_spreadsheet("Book", {"Keep": [["a"]], "Data": [["a"]]})
+    google_tools.WriteToSheets("Book", "Data", pd.DataFrame({"a": [1, 2]}))
+
+    # another process deletes the tab and adds it back under the same name, so the cached handle has a stale id
+    with backend._lock:
+        spreadsheet = backend.get_spreadsheet(id)
+        sheet_id = spreadsheet.get_sheet(title="Data").properties["sheetId"]
+        backend.apply_deleteSheet(spreadsheet, {"sheetId": sheet_id})
+        backend.add_sheet(spreadsheet, {"title": "Data"})
+
+    google_tools.WriteToSheets("Book", "Data", pd.DataFrame({"a": [3, 4]}))
+    assert get_column_values(backend, id, "Data") == [3, 4]
+
+
+def test_failed_copy_leaves_no_partial_copies(backend):
+    backend.create_spreadsheet("Source", {"A": [["a"], [1]]})
+    dest_id = backend.create_spreadsheet("Dest", {"A": [["a"], [2]], "B": [["b"]]})
+    Workbook_src = google_tools.get_book("Source")
+    Workbook_dest = google_tools.get_book("Dest")
+
+    # the second tab does not exist in the source, so its copyTo fails after the first one was copied
+    with pytest.raises(Exception):
+        google_tools.copy_sheets_to_book(
+            Workbook_src,
+            {"A": Workbook_src.worksheet_by_title("A").id, "B": 987654},
+            Workbook_dest,
+        )
+
+    ls_titles = [
+        sheet.properties["title"]
+        for sheet in backend.get_spreadsheet(dest_id).ls_sheets
+    ]
+    assert ls_titles == ["A", "B"]
+    assert get_column_values(backend, dest_id, "A") == [2]
+
+
+def test_copy_formulas_quotes_sheet_names(backend):
+    id = backend.create_spreadsheet(
+        "Book",
+        {"Bob's": [["=1+1", "x"], ["y"]], "Ann's": [["old", "old"], ["old", "old"]]},
+    )
+    google_tools.copy_formulas_range_to_range(
+        "Book", "Bob's", ("A1", "B2"), "Ann's", "A1:B2"
+    )
+    assert backend.get_sheet_values(id, "Ann's") == [["=1+1", "x"], ["y"]]
+
+
+def test_append_dedups_against_keys_indexed_from_the_sheet(backend):
+    id = backend.create_spreadsheet("Book", {"Log": [["a"]]})
+    df = pd.DataFrame(
+        {
+            "a": [2.0, 2.5, 3.0],
+            "d": pd.to_datetime(["2024-01-05", "2024-01-06", "2024-01-05"]),
+        }
+    )
+    google_tools.WriteToSheets("Book", "Log", df.iloc[:2])
+
+    # nothing was appended from this machine, so the index is built from the rows on the sheet
+    dict_result = google_tools.AppendToSheets("Book", "Log", df, key_columns=["a", "d"])
+
+    assert (dict_result["appended"], dict_result["duplicates"]) == (1, 2)
+    assert backend.get_sheet_values(id, "Log")[-1] == [3, 45296]
+
+
+def test_append_whose_response_was_lost_is_not_sent_again(backend, monkeypatch):
+    monkeypatch.setitem(google_tools.dict_retry_policy, "base_delay_seconds", 0)
+    id = backend.create_spreadsheet("Book", {"Log": [["a"]]})
+    google_tools.WriteToSheets("Book", "Log", pd.DataFrame({"a": [1]}))
+    handle_request = backend.handle_request
+    ls_lost = []
+
+    def lose_first_append_response(uri, method, body):
+        response = handle_request(uri, method, body)
+        if ":append" in uri and not ls_lost:
+            ls_lost.append(uri)
+            return 503, {}, b"Backend Error"
+        return response
+
+    monkeypatch.setattr(backend, "handle_request", lose_first_append_response)
+    google_tools.AppendToSheets("Book", "Log", pd.DataFrame({"a": [2, 3]}))
+
+    assert ls_lost
+    assert get_column_values(backend, id, "Log") == [1, 2, 3]
+
+
+def test_append_lock_is_per_sheet(backend, monkeypatch):
+    monkeypatch.setattr(google_tools, "append_lock_max_wait_seconds", 0)
+    backend.create_spreadsheet("Book", {"Log": [["a"]], "Other": [["a"]]})
+    df = pd.DataFrame({"a": [1]})
+
+    con = google_tools.get_sheets_append_index_connection()
+    google_tools.acquire_append_lock(con, "Book", "Other")
+    assert google_tools.AppendToSheets("Book", "Log", df)["appended"] == 1
+    with pytest.raises(Exception, match="append lock"):
+        google_tools.AppendToSheets("Book", "Other", df)
+    con.close()
+
+
+# %%
+## Lookups ##
+
+
+def test_get_book_falls_back_to_drive_for_deleted_indexed_book(backend):
+    old_id = backend.create_spreadsheet("Book")
+    assert google_tools.get_spreadsheet_ids_by_name("Book") == [old_id]
+
+    # the book is replaced after the name index was refreshed
+    with backend._lock:
+        del backend.dict_files[old_id]
+        del backend.dict_spreadsheets[old_id]
+    new_id = backend.create_spreadsheet("Book")
+
+    assert google_tools.get_book("Book").id == new_id
+    assert google_tools.get_spreadsheet_ids_by_name("Book", refresh=False) == [new_id]
+
+
+def test_name_index_lists_duplicates_most_recently_modified_first(backend):
+    old_id = backend.create_spreadsheet("Book")
+    time.sleep(0.01)
+    new_id = backend.create_spreadsheet("Book")
+
+    assert google_tools.get_spreadsheet_ids_by_name("Book") == [new_id, old_id]
+    dict_duplicates = google_tools.get_duplicate_spreadsheet_names()
+    assert sorted(dict_duplicates["Book"]) == sorted([old_id, new_id])
+    assert google_tools.get_book("Book").id == new_id
+    assert google_tools.get_spreadsheet_ids_by_name("Book", refresh=False) == [new_id]
+
+
+def test_name_index_lists_duplicates_most_recently_modified_first(backend):
+    old_id = backend.create_spreadsheet("Book")
+    time.sleep(0.01)
+    new_id = backend.create_spreadsheet("Book")
+
+    assert google_tools.get_spreadsheet_ids_by_name("Book") == [new_id, old_id]
+    assert google_tools.get_duplicate_spreadsheet_names() == {
+        "Book": [old_id, new_id]
+    } or google_tools.get_duplicate_spreadsheet_names() == {"Book": [new_id, old_id]}
+    assert google_tools.get_book("Book").id == new_id
+
+
+def test_name_index_refresh_drops_trashed_spreadsheets(backend):
+    id = backend.create_spreadsheet("Book")
+    assert google_tools.get_spreadsheet_ids_by_name("Book") == [id]
+
+    time.sleep(0.01)
+    with backend._lock:
+        backend.dict_files[id]["trashed"] = True
+    backend.touch_drive_file(id)
+    google_tools.refresh_spreadsheet_name_index()
+
+    assert google_tools.get_spreadsheet_ids_by_name("Book", refresh=False) == []
+
+
+def test_get_book_keeps_name_index_entries_saved_by_other_processes(backend):
+    backend.create_spreadsheet("Book")
+    google_tools.get_spreadsheet_ids_by_name("Book")
+
+    # another process saves an entry after this one loaded the index
+    dict_saved = google_tools.read_spreadsheet_name_index_file()
+    dict_saved["files"]["other-id"] = {"name": "Other", "modifiedTime": "2024"}
+    with open(google_tools.loc_spreadsheet_name_index, "w") as f:
+        json.dump(dict_saved, f)
+
+    # the name is new to the index, so the book is opened by name and saved to the index
+    backend.reset_stats()
+    id = backend.create_spreadsheet("New")
+    assert google_tools.get_book("New").id == id
+    # the modified time of the book is not read from drive
+    assert "GET /files/{id}" not in backend.get_stats()["by_endpoint"]
+
+    dict_files = google_tools.read_spreadsheet_name_index_file()["files"]
+    assert dict_files["other-id"]["name"] == "Other"
+    assert dict_files[id]["name"] == "New"
+
+
+def test_drive_mirror_miss_falls_back_to_drive(backend):
+    folder_id = backend.create_folder("Folder")
+    backend.create_spreadsheet("Old", parent_id=folder_id)
+    assert google_tools.get_file_id_from_drive_mirror(folder_id, "New") is None
+    google_tools.sync_drive_mirror(force=True)
+
+    # added within drive_mirror_sync_seconds of the last sync, so the next lookup does not sync
+    new_id = backend.create_spreadsheet("New", parent_id=folder_id)
+    assert google_tools.get_file_id_from_drive_mirror(folder_id, "New") == new_id
+
+
+def test_oauth_folder_lookup_lists_with_pydrive_by_default(backend, monkeypatch):
+    folder_id = backend.create_folder("Folder")
+    mirror_id = backend.create_spreadsheet("Book", parent_id=folder_id)
+    monkeypatch.setattr(
+        google_tools,
+        "get_file_list_from_folder_id_oauth",
+        lambda folder_id: [{"id": "pydrive-id", "title": "Book"}],
+    )
+
+    assert (
+        google_tools.get_book_id_from_parent_folder_id_oauth(folder_id, "Book")
+        == "pydrive-id"
+    )
+    assert (
+        google_tools.get_book_id_from_parent_folder_id_oauth(
+            folder_id, "Book", use_mirror=True
+        )
+        == mirror_id
+    )
+
+
+def test_pydrive_folder_walk_lists_with_a_client_per_thread(backend, monkeypatch):
+    dict_folder_files = {
+        "root": [
+            {"id": "a", "title": "A", "mimeType": google_tools.drive_folder_mime_type},
+            {"id": "f", "title": "F", "mimeType": "text/plain"},
+        ],
+        "a": [{"id": "b", "title": "B", "mimeType": "text/plain"}],
+    }
+    dict_thread_clients = {}
+    monkeypatch.setattr(google_tools, "authorize_thread_google_drive", object)
+
+    def list_folder(folder_id):
+        # the shared pydrive client would authorize with the credentials file
+        client = google_tools.get_google_drive_obj()
+        assert dict_thread_clients.setdefault(threading.get_ident(), client) is client
+        return dict_folder_files[folder_id]
+
+    monkeypatch.setattr(google_tools, "get_file_list_from_folder_id_oauth", list_folder)
+    dict_root = google_tools.list_files_recursively("root")
+
+    assert [file["name"] for _, file in google_tools.iter_drive_tree(dict_root)] == [
+        "F",
+        "A",
+        "B",
+    ]
+    assert dict_thread_clients
+
+
+# %%
+## Reads ##
+
+
+def test_iter_sheet_chunks_quotes_sheet_name(backend):
+    id = backend.create_spreadsheet(
+        "Book", {"Bob's": [["a", "b"]] + [[i, i * 2] for i in range(500)]}
+    )
+    df = pd.concat(google_tools.iter_sheet_chunks(id, "Bob's", rows_per_chunk=200))
+    assert df["b"].tolist() == [i * 2 for i in range(500)]
+
+
+def test_get_many_dfs_open_ended_and_quoted_ranges(backend):
+    ls_rows = [["a", "b"]] + [[i, i * 2] for i in range(5)]
+    id = backend.create_spreadsheet("Book", {"S1": ls_rows, "Bob's": ls_rows})
+    df_open, df_quoted, df_closed = google_tools.get_many_dfs(
+        id, [("S1", "A3", None), ("Bob's", None, None), ("S1", None, "B3")]
+    )
+    # the first row of the range is the header
+    assert list(df_open.columns) == ["1", "2"]
+    assert df_open["2"].tolist() == [4, 6, 8]
+    assert df_quoted["b"].tolist() == [0, 2, 4, 6, 8]
+    assert df_closed["b"].tolist() == [0, 2]
+
+
+def test_typed_read_converts_columns_with_the_schema(backend):
+    backend.create_spreadsheet("Book", {"Data": [["a"]]})
+    df = pd.DataFrame(
+        {
+            "date": pd.to_datetime(["2024-01-05 06:00", "2024-02-29 00:00"]),
+            "count": [3, None],
+            "code": ["007", "12"],
+            "flag": [True, False],
+            "amount": [1.5, 2],
+        }
+    )
+    google_tools.WriteToSheets("Book", "Data", df, typed_cells=True)
+
+    df_read = google_tools.get_book_sheet_df(
+        "Book",
+        "Data",
+        typed=True,
+        dict_schema={
+            "date": "datetime64",
+            "count": "int64",
+            "code": "string",
+            "flag": "bool",
+        },
+    )
+
+    assert df_read["date"].tolist() == df["date"].tolist()
+    assert str(df_read["count"].dtype) == "Int64"
+    assert df_read["count"].isna().tolist() == [False, True]
+    assert df_read["code"].tolist() == ["007", "12"]
+    assert df_read["flag"].tolist() == [True, False]
+    # columns without a schema become numeric when every value is a number
+    assert df_read["amount"].tolist() == [1.5, 2]
+
+
+def test_convert_sheet_column_parses_serials_and_text_dates():
+    ser = pd.Series([45296.25, "2024-01-06", ""], dtype=object)
+
+    assert google_tools.convert_sheet_column(ser, "datetime64").tolist()[:2] == [
+        pd.Timestamp("2024-01-05 06:00"),
+        pd.Timestamp("2024-01-06"),
+    ]
+    assert google_tools.convert_sheet_column(ser, "datetime64").isna().tolist() == [
+        False,
+        False,
+        True,
+    ]
+    with pytest.raises(ValueError):
+        google_tools.convert_sheet_column(ser, "decimal")
+
+
+def get_sheet_read_count(backend):
+    return sum(
+        count
+        for endpoint, count in backend.get_stats()["by_endpoint"].items()
+        if "/values" in endpoint
+    )
+
+
+def test_read_cache_serves_unmodified_sheets_and_revalidates(backend):
+    id = backend.create_spreadsheet("Book", {"Data": [["a"], [1]]})
+    google_tools.WriteToSheets("Book", "Data", pd.DataFrame({"a": [1, 2]}))
+
+    df = google_tools.get_book_sheet_df("Book", "Data", use_cache=True)
+    num_reads = get_sheet_read_count(backend)
+    assert google_tools.get_book_sheet_df("Book", "Data", use_cache=True).equals(df)
+    assert get_sheet_read_count(backend) == num_reads
+
+    # drive keeps the modified time to the millisecond
+    time.sleep(0.01)
+    google_tools.WriteToSheets("Book", "Data", pd.DataFrame({"a": [3]}))
+    df = google_tools.get_book_sheet_df("Book", "Data", use_cache=True)
+    assert df["a"].tolist() == [3]
+    assert get_sheet_read_count(backend) == num_reads + 1
+
+    # an expired entry is downloaded again
+    google_tools.get_book_sheet_df("Book", "Data", use_cache=True, cache_ttl_seconds=0)
+    assert get_sheet_read_count(backend) == num_reads + 2
+
+
+def test_read_cache_evicts_past_its_size_limit(backend):
+    backend.create_spreadsheet("Book", {"Data": [["a"], [1]], "Other": [["b"], [2]]})
+    google_tools.get_book_sheet_df("Book", "Data", use_cache=True)
+    google_tools.get_book_sheet_df("Book", "Other", use_cache=True)
+
+    con = google_tools.get_read_cache_db_connection()
+    ls_entries = con.execute(
+        "SELECT sheet_name, path, size_bytes FROM entries ORDER BY last_access"
+    ).fetchall()
+    # room for the most recently used entry only
+    google_tools.evict_read_cache(con, max_bytes=ls_entries[-1][2])
+    ls_kept = [name for (name,) in con.execute("SELECT sheet_name FROM entries")]
+    con.close()
+
+    assert ls_kept == ["Other"]
+    assert not os.path.exists(ls_entries[0][1])
+
+
+def test_get_workbook_dfs_reads_the_export_and_the_name_only(backend):
+    id = backend.create_spreadsheet("Book", {"S1": [["a"], [1]]})
+
+    dict_dfs = google_tools.get_workbook_dfs(id)
+
+    assert list(dict_dfs) == ["S1"]
+    assert backend.get_stats()["by_endpoint"] == {
+        "GET /files/{id}/export": 1,
+        "GET /files/{id}": 1,
+    }
+
+
+def test_get_workbook_dfs_process_pool_matches_serial_read(backend, monkeypatch):
+    ls_rows = [["a", "b"]] + [[i, f"v{i}"] for i in range(50)]
+    id = backend.create_spreadsheet("Book", {"S1": ls_rows, "S2": ls_rows[:10]})
+    dict_serial = google_tools.get_workbook_dfs(id, max_workers=1)
+
+    monkeypatch.setattr(google_tools, "workbook_export_pool_min_bytes", 0)
+    dict_pool = google_tools.get_workbook_dfs(id, max_workers=2)
+    assert all(dict_pool[name].equals(df) for name, df in dict_serial.items())
+
+
+# %%